@@ -0,0 +1,76 @@
+"""
+Benchmark of the construction of the content tree from an index file.
+
+A synthetic index with the given number of lines is generated in memory,
+parsed and turned into the content tree and the map of the file system
+paths. The tree has 'fanout' sub dirs per dir and 'files_per_dir' files in
+each dir, the time of each step should grow linearly with the number of
+lines.
+
+usage:
+
+    ~> python benchmarks/index_tree.py [n_lines [fanout [files_per_dir]]]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+# the benchmark runs from a checkout of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytest_ds.tree import Query, parse_index_line
+
+
+def generate_index(n_lines, fanout=10, files_per_dir=100):
+    """
+    generate the lines of a synthetic index file, each dir is listed before
+    its content as find does
+
+    :param int n_lines: the number of lines
+    :param int fanout: the number of sub dirs of each dir
+    :param int files_per_dir: the number of files of each dir
+    :return: generator of lines
+    """
+    count = 0
+    dirs = ['data']
+    while count < n_lines:
+        dirname = dirs.pop(0)
+        yield '##directory##4096##1489485000##{}##'.format(dirname)
+        count += 1
+        for index in range(files_per_dir):
+            if count >= n_lines:
+                return
+            yield '##regular file##{}##1489485000##{}/file_{}.dat##'.format(
+                index, dirname, index)
+            count += 1
+        dirs.extend('{}/dir_{}'.format(dirname, index)
+                    for index in range(fanout))
+
+
+def main(n_lines=10 ** 6, fanout=10, files_per_dir=100):
+    """run the benchmark and print the duration of each step"""
+    query = Query(setup_cache=False)
+    query._url = 'https://example.org/index.php/s/token'
+
+    start = time.time()
+    lines = list(generate_index(n_lines, fanout, files_per_dir))
+    print('generated {} lines in {:.2f} s'.format(len(lines),
+                                                  time.time() - start))
+
+    start = time.time()
+    flat_content = [parse_index_line(line) for line in lines]
+    print('parsed in {:.2f} s'.format(time.time() - start))
+
+    start = time.time()
+    query.contents = query.crawl_fs_info(flat_content)
+    print('built the tree in {:.2f} s'.format(time.time() - start))
+
+    start = time.time()
+    query.hash()
+    print('mapped {} paths in {:.2f} s'.format(len(query.fs_paths),
+                                               time.time() - start))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
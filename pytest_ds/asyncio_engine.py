@@ -0,0 +1,125 @@
+"""
+Event loop driven sync engine.
+
+A single event loop walks the transfers of the sync plan and keeps up to
+max_in_flight of them running. The bookkeeping (summary and state updates)
+runs on the loop, the blocking http transfers and disk writes are handed to
+an executor whose size is the in-flight limit.
+
+The engine only limits the number of transfers in flight, it does not
+reduce the number of threads: each running transfer still occupies a
+thread of the executor, so max_in_flight transfers cost as many OS threads
+as the thread engine with max_in_flight threads. A transfer that waits
+before a retry does not hold a slot.
+
+On python 2 the asyncio api is provided by trollius (and the executor by the
+futures backport), the engine is disabled if it is not installed.
+"""
+from __future__ import print_function
+
+try:
+    import trollius as asyncio
+    from trollius import From
+    from concurrent.futures import ThreadPoolExecutor
+    ASYNCIO_IS_AVAILABLE = True
+except ImportError:
+    print("can not import trollius, the asyncio sync engine will be disabled")
+    ASYNCIO_IS_AVAILABLE = False
+
+if ASYNCIO_IS_AVAILABLE:
+    coroutine = asyncio.coroutine
+else:
+    def coroutine(func):
+        return func
+
+
+class AsyncioSyncEngine(object):
+    """
+    Sync the content of a Query object from an event loop.
+    """
+    def __init__(self, query, max_in_flight=10, policy=None, plan=None):
+        """
+        constructor
+
+        :param query: the Query object whose content is synced
+        :param int max_in_flight: the maximum number of simultaneous
+         downloads
+        :param str policy: the scheduling policy of the downloads
+        :param plan: the SyncPlan of the content, by default it is made from
+         the query
+        """
+        if not ASYNCIO_IS_AVAILABLE:
+            raise RuntimeError(
+                'the asyncio sync engine requires trollius and futures')
+
+        self.query = query
+        """the Query object whose content is synced"""
+
+        self.max_in_flight = max_in_flight
+        """the maximum number of simultaneous downloads"""
+
+        self.policy = policy
+        """the scheduling policy of the downloads"""
+
+        self.plan = plan if plan is not None else query.make_plan()
+        """the SyncPlan whose transfers are executed"""
+
+    def run(self):
+        """sync the content of the query, return when all the transfers are
+        done"""
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        loop.set_default_executor(executor)
+        try:
+            loop.run_until_complete(self._sync_all(loop))
+        finally:
+            executor.shutdown(wait=True)
+            loop.close()
+
+    @coroutine
+    def _sync_all(self, loop):
+        """schedule a task per item to sync, at most max_in_flight of them
+        are transferring at any time"""
+        semaphore = asyncio.Semaphore(self.max_in_flight, loop=loop)
+        tasks = set()
+
+        items = self.query.scheduled_items(self.plan, self.policy)
+        self.query.make_parent_dirs(fs_path for _, fs_path, _, _ in items)
+
+        for _, fs_path, url, content in items:
+            # do not walk further than the transfers, the pending items stay
+            # in the generator instead of piling up as tasks
+            yield From(semaphore.acquire())
+            task = asyncio.ensure_future(
+                self._sync_file(loop, semaphore, fs_path, url, content),
+                loop=loop)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            yield From(asyncio.wait(list(tasks), loop=loop))
+
+    @coroutine
+    def _sync_file(self, loop, semaphore, fs_path, url, content):
+        """download a single item in the executor, retry it with a growing
+        delay if it fails and record the result. The slot of the semaphore
+        acquired by the caller is released during the delays."""
+        attempt = 0
+        while True:
+            try:
+                success = yield From(loop.run_in_executor(
+                    None, self.query._download, fs_path, url, content))
+            except Exception as e:
+                print('download failed...')
+                print(e)
+                success = False
+            finally:
+                semaphore.release()
+            if success or attempt >= self.query._retries:
+                break
+            attempt += 1
+            delay = self.query.retry_delay(attempt)
+            print('retrying {} in {:.0f}s'.format(fs_path, delay))
+            yield From(asyncio.sleep(delay, loop=loop))
+            yield From(semaphore.acquire())
+        self.query._record_download(fs_path, content, success)
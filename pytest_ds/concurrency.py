@@ -0,0 +1,172 @@
+"""
+Adaptive number of simultaneous downloads.
+
+The number of downloads that saturates the link without overloading the
+server depends on the site and on the sizes of the files. The controller
+below adjusts it during the sync the way tcp adjusts its congestion window
+(additive increase, multiplicative decrease): the limit grows by one per
+measurement interval as long as the aggregate throughput grows, it is cut
+when the server signals that it is overloaded (http 429 or 503, failed
+downloads) or when the latency of the downloads degrades without any gain in
+throughput.
+"""
+from __future__ import print_function
+import threading
+import time
+
+
+CONGESTION_STATUS_CODES = (429, 503)
+"""the http status codes of an overloaded server"""
+
+
+class AIMDController(object):
+    """
+    Thread safe counting semaphore whose limit is adjusted from the
+    measured throughput, latency and errors of the downloads.
+    """
+    def __init__(self, initial=4, min_limit=1, max_limit=64, interval=5.0,
+                 decrease=0.5, tolerance=0.05, latency_factor=4.0):
+        """
+        constructor
+
+        :param int initial: the initial number of simultaneous downloads
+        :param int min_limit: the lower bound of the limit
+        :param int max_limit: the upper bound of the limit
+        :param float interval: the measurement interval in seconds
+        :param float decrease: the factor applied to the limit on congestion
+        :param float tolerance: the relative change of throughput between
+         two intervals that is considered significant
+        :param float latency_factor: a window whose median latency is that
+         many times the best median latency is considered congested unless
+         its throughput improved
+        """
+        self.min_limit = max(1, min_limit)
+        """the lower bound of the limit"""
+
+        self.max_limit = max(self.min_limit, max_limit)
+        """the upper bound of the limit"""
+
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        """the current number of allowed simultaneous downloads"""
+
+        self.interval = interval
+        """the measurement interval in seconds"""
+
+        self.decrease = decrease
+        """the multiplicative decrease factor"""
+
+        self.tolerance = tolerance
+        """the significant relative change of throughput"""
+
+        self.latency_factor = latency_factor
+        """the latency degradation that is considered as congestion"""
+
+        self.history = []
+        """list of (limit, throughput in bytes/s) of the past intervals"""
+
+        self._condition = threading.Condition()
+        """guards the counters and wakes up the waiting workers"""
+
+        self._in_flight = 0
+        """the number of running downloads"""
+
+        self._last_throughput = None
+        """the throughput of the previous interval"""
+
+        self._best_latency = None
+        """the smallest median latency of an interval"""
+
+        self._reset_window(time.time())
+
+    def _reset_window(self, now):
+        """start a new measurement interval"""
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_latencies = []
+        self._window_congested = False
+
+    def acquire(self):
+        """wait until the number of running downloads is below the limit
+        and count one more"""
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def try_acquire(self):
+        """
+        count one more running download if the number of running downloads
+        is below the limit, without waiting
+
+        :return: True if the download was counted
+        """
+        with self._condition:
+            if self._in_flight >= self.limit:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        """count one running download less"""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def record(self, n_bytes, latency, status_code=None, success=True):
+        """
+        record a finished download and adjust the limit if the measurement
+        interval is over
+
+        :param int n_bytes: the number of bytes downloaded
+        :param float latency: the duration of the download in seconds
+        :param int status_code: the http status code of the response
+        :param bool success: False if the download failed
+        """
+        with self._condition:
+            self._window_bytes += n_bytes
+            self._window_latencies.append(latency)
+            if status_code in CONGESTION_STATUS_CODES or not success:
+                self._window_congested = True
+
+            now = time.time()
+            if now - self._window_start >= self.interval:
+                self._adjust(now)
+                self._condition.notify_all()
+
+    def _adjust(self, now):
+        """compute the limit of the next interval"""
+        throughput = self._window_bytes / max(now - self._window_start, 1e-6)
+        latencies = sorted(self._window_latencies)
+        latency = latencies[len(latencies) // 2]
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+
+        improved = (self._last_throughput is None or
+                    throughput > self._last_throughput * (1 + self.tolerance))
+        degraded = (self._last_throughput is not None and
+                    throughput < self._last_throughput * (1 - self.tolerance))
+        slow = latency > self.latency_factor * self._best_latency
+
+        if self._window_congested or (slow and not improved):
+            limit = int(self.limit * self.decrease)
+        elif degraded:
+            # the last increase did not pay off
+            limit = self.limit - 1
+        else:
+            limit = self.limit + 1
+
+        self.history.append((self.limit, throughput))
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        self._last_throughput = throughput
+        self._reset_window(now)
+
+    def settled_limit(self):
+        """
+        return the limit that was used during the intervals with the best
+        throughput, or the current limit if no interval is over
+
+        :return: int
+        """
+        if not self.history:
+            return self.limit
+        return max(self.history, key=lambda item: item[1])[0]
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import os
-import re
+import threading
+import Queue
 import requests
 from lxml import etree
 
@@ -13,19 +14,39 @@ requests.packages.urllib3.disable_warnings(InsecurePlatformWarning)
 requests.packages.urllib3.disable_warnings(SNIMissingWarning)
 
 from .interface import DataSourceBase
-from ..utils import Content, sort_dict_by_key
+from ..utils import Content
+
+DAV_NS = 'DAV:'
+"""the webdav xml namespace"""
+
+OC_NS = 'http://owncloud.org/ns'
+"""the owncloud xml namespace"""
+
+RESPONSE_TAG = '{{{}}}response'.format(DAV_NS)
+HREF_TAG = '{{{}}}href'.format(DAV_NS)
+PROPSTAT_TAG = '{{{}}}propstat'.format(DAV_NS)
+STATUS_TAG = '{{{}}}status'.format(DAV_NS)
+PROP_TAG = '{{{}}}prop'.format(DAV_NS)
+GETLASTMODIFIED_TAG = '{{{}}}getlastmodified'.format(DAV_NS)
+GETETAG_TAG = '{{{}}}getetag'.format(DAV_NS)
+GETCONTENTLENGTH_TAG = '{{{}}}getcontentlength'.format(DAV_NS)
+OC_SIZE_TAG = '{{{}}}size'.format(OC_NS)
+OC_CHECKSUM_PATH = '{{{0}}}checksums/{{{0}}}checksum'.format(OC_NS)
 
 
 class WebdavDataSource(DataSourceBase):
     """
     Query an owncloud folder through its webdav API.
     """
-    def __init__(self, url=None, token=None, dirname=None, *args, **kwargs):
+    def __init__(self, url=None, token=None, dirname=None, session=None,
+                 *args, **kwargs):
         """
         constructor
 
         :param url: the root url of the owncloud server 
         :param token: the access token of the publicly shared folder
+        :param session: the Transport (or requests.Session) used to send the
+         requests, by default a new connection is opened for each request
         :param args: None
         :param kwargs: None
         """
@@ -42,7 +63,14 @@ class WebdavDataSource(DataSourceBase):
             """xmlns:oc="http://owncloud.org/ns"><d:prop>"""
             """<d:getlastmodified/><d:getetag/><d:getcontenttype/>"""
             """<d:resourcetype/><oc:fileid/><oc:permissions/><oc:size/>"""
-            """"<d:getcontentlength/></d:prop></d:propfind>""")
+            """<d:getcontentlength/><oc:checksums/></d:prop>"""
+            """</d:propfind>""")
+
+        self._session = requests if session is None else session
+        """The object used to send the requests"""
+
+        self.dir_etags = {}
+        """The etags of the collections found by the last listing"""
 
         self._headers = {
             'Authorization': 'Basic {}'.format(token),
@@ -51,31 +79,188 @@ class WebdavDataSource(DataSourceBase):
             'Depth': '3'
         }
 
-    def ls(self, recursive=False):
-        """return a flat list of Content object of the files in the specified
-        url
-
-        :param recursive: if True the all files at infinite depth are returned 
-        :return: a flat list of Content objects
+    def ls(self, recursive=False, crawl_threads=None, known=None, skip=None):
+        """generate Content objects of the files in the specified url as they
+        are parsed from the (streamed) PROPFIND response.
+
+        The etags of the collections that are encountered are stored in
+        self.dir_etags. If a previous listing is provided through 'known',
+        the etag of the root collection is checked first and if it did not
+        change the previous listing is returned as is. When crawling, the
+        collections whose etag did not change are not listed and their
+        content is taken from the previous listing.
+
+        :param recursive: if True the all files at infinite depth are returned
+        :param crawl_threads: if set (and recursive is True) the tree is
+         crawled breadth first with Depth: 1 requests using that many
+         threads instead of sending a single Depth: infinity request.
+        :param SyncState known: the previous listing
+        :param skip: a callable that is passed the Content objects of the
+         collections found by the crawl, the collections for which it
+         returns True are neither listed nor returned
+        :return: a generator of Content objects
+        """
+        self.dir_etags = {}
+
+        if recursive and known is not None:
+            root = next(self.ls_dir('', depth=0))
+            if known.unchanged(root):
+                print('the etag of the root collection did not change')
+                for content in self._expand(known, ''):
+                    yield content
+                return
+
+        if recursive and crawl_threads:
+            prune = known.unchanged if known is not None else None
+            contents = self.crawl(n_threads=crawl_threads, prune=prune,
+                                  skip=skip)
+        else:
+            depth = 'infinity' if recursive else self._headers['Depth']
+            contents = self.ls_dir('', depth=depth)
+            prune = None
+
+        for content in contents:
+            if content.type == 'dir':
+                self.dir_etags[content.name] = content.etag
+                if prune is not None and prune(content):
+                    for _content in self._expand(known, content.name):
+                        yield _content
+            else:
+                yield content
+
+    def _expand(self, known, dirname):
+        """generate the files below dirname from the previous listing
+        'known' and keep the etags of the collections below it.
+        """
+        for content in known.subtree(dirname):
+            if content.type == 'dir':
+                self.dir_etags[content.name] = content.etag
+            else:
+                yield content
+
+    def ls_dir(self, dirname, depth=1):
+        """generate the Content objects (files and dirs) in the collection
+        dirname, including the collection itself.
+
+        :param dirname: the path of the collection relative to the root
+        :param depth: the value of the Depth header
+        :return: a generator of Content objects
+        """
+        request = self.propfind(depth, dirname)
+        try:
+            for content in self.generate_flat_content(
+                    self.parse_xml_content(request.raw)):
+                yield content
+        finally:
+            request.close()
+
+    def crawl(self, n_threads=4, prune=None, skip=None):
+        """crawl the tree breadth first by sending a Depth: 1 PROPFIND
+        request per collection.
+
+        A pool of n_threads workers pulls collections from a work queue and
+        puts back the subdirectories they discover, the content is generated
+        as soon as it is found. The first failed request aborts the crawl
+        and its exception is re-raised. Once the crawl is aborted (or the
+        generator is closed) the workers stop and drop the pending
+        collections without listing them.
+
+        :param n_threads: the number of simultaneous PROPFIND requests
+        :param prune: a callable that is passed each discovered subdirectory
+         Content object, the subdirectory is not listed if it returns True
+        :param skip: a callable that is passed each discovered subdirectory
+         Content object, the subdirectory is neither listed nor generated if
+         it returns True
+        :return: a generator of Content objects (files and dirs)
         """
-        if recursive:
-            old_depth = self._headers['Depth']
-            self._headers['Depth'] = 'infinity'
+        work = Queue.Queue()
+        found = Queue.Queue()
+        done = object()
+        stop = threading.Event()
+
+        def worker():
+            while True:
+                dirname = work.get()
+                if dirname is None:
+                    work.task_done()
+                    break
+                if stop.is_set():
+                    work.task_done()
+                    continue
+                try:
+                    for content in self.ls_dir(dirname, depth=1):
+                        if stop.is_set():
+                            break
+                        if content.name == dirname:
+                            # the collection itself, new only for the root
+                            if dirname == '':
+                                found.put(content)
+                            continue
+                        if content.type == 'dir':
+                            if skip is not None and skip(content):
+                                continue
+                            if prune is None or not prune(content):
+                                work.put(content.name)
+                        found.put(content)
+                except Exception as exc:
+                    found.put(exc)
+                finally:
+                    work.task_done()
+
+        def monitor():
+            work.join()
+            found.put(done)
+
+        threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        work.put('')
+        monitor_thread = threading.Thread(target=monitor)
+        monitor_thread.daemon = True
+        monitor_thread.start()
+
+        try:
+            while True:
+                item = found.get()
+                if item is done:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            for _ in threads:
+                work.put(None)
+
+    def propfind(self, depth, dirname=''):
+        """send a PROPFIND request to the webdav endpoint and return the
+        response without reading its body. The body of the response is
+        meant to be consumed incrementally through request.raw
+
+        :param depth: the value of the Depth header
+        :param dirname: the path of the collection relative to the root
+        :return: requests.Response
+        """
+        headers = dict(self._headers)
+        headers['Depth'] = str(depth)
 
-        request = requests.request(
+        request = self._session.request(
             'PROPFIND',
-            '{}/public.php/webdav/'.format(self._headers['Origin']),
+            '{}/public.php/webdav/{}'.format(
+                self._headers['Origin'],
+                dirname + '/' if dirname else ''),
             data=self._xml_payload,
-            headers=self._headers,
+            headers=headers,
+            stream=True
         )
+        request.raise_for_status()
 
-        flat_contents = self.generate_flat_content(
-            self.parse_xml_content(request.content))
-
-        if recursive:
-            self._headers['Depth'] = old_depth
+        # let urllib3 handle gzip/deflate transfer encodings of the stream
+        request.raw.decode_content = True
 
-        return flat_contents
+        return request
 
     def ls_url(self, **kwargs):
         """
@@ -85,105 +270,84 @@ class WebdavDataSource(DataSourceBase):
         :param kwargs: The recursive keyword is passed to self.ls() 
         :return: dict
         """
-        flat_contnet = self.ls(**kwargs)
-        download_urls = self.get_download_urls(flat_contnet)
-
-        hashed = {
-            content.name: (content, url) for
-            content, url in zip(flat_contnet, download_urls)
+        return {
+            content.name: (content, self.get_download_url(content))
+            for content in self.ls(**kwargs)
         }
 
-        return sort_dict_by_key(hashed)
-
     @staticmethod
-    def strip_namespaces(xml_str):
-        """find namespaces in the xml str and remove them from xml_str and
-        return the string without all namespaces and the namespace prefixes.
-
-          <d:multistatus xmlns:d="DAV:" xmlns:s="http://sabredav.org/ns" xmlns:oc="http://owncloud.org/ns">
-
-        - search for line that contains xmlns
-        - namespaces are the stuff between "xmlns:" and "="
-        - remove them from all the file 
-        - for each namespace "X" replace all matches "</X:" with "</:" and
-          "<oc:" by "<:"
-
-        :param xml_str: the xml string
-        :return: the xml string without the namespaces
+    def parse_xml_content(xml_stream):
+        """incrementally parse the multistatus xml response of webdav and
+        generate pairs of [href, xml_owncloud_props_element] of the responses
+        that have an OK status.
+
+        Each <d:response> element is yielded as soon as it is parsed and it
+        is cleared afterwards, along with its already processed siblings, so
+        the memory footprint does not grow with the size of the response.
+        The prop element is only valid until the next item is requested.
+
+        :param xml_stream: a file like object of the xml response
+        :return: generator of (href, prop) pairs
         """
-        namespaces = map(lambda x: x.replace('xmlns:', ''),
-                         filter(lambda x: 'xmlns:' in x,
-                                re.split('(xmlns:\w+)', xml_str)))
-
-        # remove namespaces from top the xml string
-        xml_str = xml_str.replace(re.split('(xmlns.*)', xml_str)[1], '>')
-
-        with open('foo.xml', 'w') as fobj:
-            fobj.write(xml_str)
-
-        # remove the namespace prefix from all elements
-        for namespace in namespaces:
-            xml_str = xml_str.replace('<{}:'.format(namespace), '<')
-            xml_str = xml_str.replace('</{}:'.format(namespace), '</')
-
-        return xml_str
-
-    def parse_xml_content(self, webdave_response_content):
-        """generate a list of files only from the xml response of webdav
-
-        :return: list of file content [[href, xml_owncloud_props_element]]
-        """
-        root = etree.fromstring(
-            self.strip_namespaces(webdave_response_content)
-        )
-
-        # keep file_elements that have an OK status (that refer to files)
-        xml_content_elements = []
-        for element in root.xpath('//response'):
-            matches = element.xpath(".//*[contains(text(), '200 OK')]")
-            if len(matches) > 0:
-                match = matches[0]
-                prop = match.getparent().xpath('.//prop')[0]
-                href = match.getparent().getparent().xpath('.//href/text()')[0]
-                xml_content_elements.append((href, prop))
-
-        # generate the flat list of Content object, keep files, exclude dirs
-        # everything ending with a / is assumed to be a dir
-        return filter(lambda x: not x[0].endswith('/'), xml_content_elements)
+        for _, element in etree.iterparse(xml_stream,
+                                          events=('end',),
+                                          tag=RESPONSE_TAG):
+            href = element.findtext(HREF_TAG)
+            for propstat in element.iterfind(PROPSTAT_TAG):
+                status = propstat.findtext(STATUS_TAG) or ''
+                if ' 200 ' in status:
+                    yield href, propstat.find(PROP_TAG)
+                    break
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
 
     @staticmethod
     def generate_flat_content(parsed_xml_content):
-        """given a list of pairs of [href, xml_owncloud_pros] return a flat
-        list of Content objects
+        """given pairs of [href, xml_owncloud_pros] generate Content objects.
+        Everything ending with a / is assumed to be a dir.
 
-        :param parsed_xml_content: array returned by parse_xml_content 
-        :return: list of Content objects
+        :param parsed_xml_content: generator returned by parse_xml_content
+        :return: generator of Content objects
         """
-        return [
-            Content(
-                content_type='file',
-                name=href.replace('/public.php/webdav/', ''),
-                mtime=str(prop.xpath('.//getlastmodified/text()')[0])
+        for href, prop in parsed_xml_content:
+            name = href.replace('/public.php/webdav/', '')
+            if href.endswith('/'):
+                content_type = 'dir'
+                name = name.rstrip('/')
+            else:
+                content_type = 'file'
+
+            size = prop.findtext(OC_SIZE_TAG)
+            if size is None:
+                size = prop.findtext(GETCONTENTLENGTH_TAG)
+
+            yield Content(
+                content_type=content_type,
+                name=name,
+                mtime=prop.findtext(GETLASTMODIFIED_TAG),
+                etag=prop.findtext(GETETAG_TAG),
+                size=size,
+                checksum=prop.findtext(OC_CHECKSUM_PATH)
             )
-            for href, prop in parsed_xml_content
-        ]
+
+    def get_download_url(self, content):
+        """
+        generate the owncloud download url of a Content object
+        """
+        dir_path = os.path.dirname(content.name)
+        basename = os.path.basename(content.name)
+
+        return '{}/index.php/s/{}//download?path={}&files={}'.format(
+            self._url,
+            self.dirname,
+            dir_path.replace('/', '%2F'),
+            basename
+        )
 
     def get_download_urls(self, flat_contnet):
         """
         generate the owncloud download urls for a list of Content objects
         """
-        download_urls = []
-
-        for content in flat_contnet:
-            dir_path = os.path.dirname(content.name)
-            basename = os.path.basename(content.name)
-
-            download_url = 'download?path={dir_path}&files={fname}'.format(
-                dir_path=dir_path.replace('/', '%2F'),
-                fname=basename
-            )
-            download_urls.append(download_url)
-
-        url = '{}/index.php/s/{}/'.format(self._url, self.dirname)
-
-        return map(lambda x: url + '/' + x, download_urls)
+        return [self.get_download_url(content) for content in flat_contnet]
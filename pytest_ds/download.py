@@ -0,0 +1,678 @@
+"""
+Download engine.
+
+Files are downloaded into a '.part' file next to their destination and moved
+into place only once they are complete. If a previous download left a
+'.part' file behind, the download is resumed from its last byte with an
+http Range request. The validator (etag or mtime) of the version of the file
+a '.part' file was started from is recorded next to it, the '.part' file is
+restarted if the listing holds another version of the file. The If-Range
+header makes the server send the whole file instead if it changed since the
+listing.
+
+Files larger than a threshold are split into byte ranges that are fetched in
+parallel, each over its own connection, into a preallocated file.
+
+The response bodies are read with readinto() into a large buffer that is
+allocated once per thread and written without intermediate copies.
+
+The requests time out if the server does not accept the connection or stops
+sending data, and a transfer whose throughput stays below a minimum for too
+long is aborted, so a stalled connection does not block a worker forever.
+
+The digests of the file (md5, sha1...) are updated with each buffer as it is
+written, so checking the integrity of a downloaded file does not require
+reading it back from disk. They are compared to the checksums published by
+the server, if any.
+"""
+from __future__ import print_function
+import io
+import os
+import threading
+import time
+import email.utils
+import hashlib
+import ctypes
+import ctypes.util
+
+import requests
+
+
+PART_SUFFIX = '.part'
+"""the suffix of the files being downloaded"""
+
+VALIDATOR_SUFFIX = '.validator'
+"""the suffix of the file next to a partial file that holds the validator of
+the version of the file it was started from"""
+
+BUFFER_SIZE = 1024 ** 2
+"""the default size of the read buffer in bytes"""
+
+TIMEOUT = (10, 60)
+"""the default (connect, read) timeouts of the requests in seconds"""
+
+_buffers = threading.local()
+"""the read buffers of the threads"""
+
+
+def get_buffer(size):
+    """
+    return the read buffer of the calling thread, it is re-used by all the
+    downloads of the thread
+
+    :param int size: the size of the buffer in bytes
+    :return: memoryview of a bytearray
+    """
+    view = getattr(_buffers, 'view', None)
+    if view is None or len(view) != size:
+        view = _buffers.view = memoryview(bytearray(size))
+    return view
+
+
+def parse_checksums(checksums):
+    """
+    parse checksums in the owncloud format, e.g 'SHA1:abcd MD5:ef01'
+
+    :param str checksums: space separated ALGORITHM:hexdigest pairs, may be
+     None
+    :return: dict that maps the upper case names of the algorithms to the
+     hex digests
+    """
+    retval = dict()
+    for item in (checksums or '').split():
+        algorithm, _, digest = item.partition(':')
+        if digest:
+            retval[algorithm.upper()] = digest.lower()
+    return retval
+
+
+def format_checksums(checksums):
+    """
+    the inverse of parse_checksums
+
+    :param dict checksums: map of the names of the algorithms to hex digests
+    :return: str or None if checksums is empty
+    """
+    if not checksums:
+        return None
+    return ' '.join(
+        '{}:{}'.format(algorithm.upper(), checksums[algorithm])
+        for algorithm in sorted(checksums))
+
+
+class StalledError(IOError):
+    """raised when the throughput of a transfer stays below the minimum"""
+    pass
+
+
+class CancelledError(IOError):
+    """raised when a download is cancelled, e.g because a duplicate
+    download of the same file completed first"""
+    pass
+
+
+def _libc_fallocate():
+    """return posix_fallocate of the C library (os.posix_fallocate exists
+    only on python >= 3.3), or None if it is not available"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    # posix_fallocate64 takes 64 bits offsets on 32 bits platforms too
+    for name in ['posix_fallocate64', 'posix_fallocate']:
+        function = getattr(libc, name, None)
+        if function is not None:
+            function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            function.restype = ctypes.c_int
+            return function
+    return None
+
+
+_fallocate = _libc_fallocate()
+"""posix_fallocate of the C library, None if it is not available"""
+
+
+def preallocate(fobj, offset, length):
+    """
+    reserve the disk blocks of length bytes starting at offset of the file
+    fobj, the file is extended if needed. This is a no-op if posix_fallocate
+    is not available (e.g on macOS) or not supported by the file system.
+
+    :param fobj: a file object opened for writing
+    :param int offset: the offset in bytes
+    :param int length: the number of bytes
+    """
+    if length <= 0:
+        return
+    fallocate = getattr(os, 'posix_fallocate', None)
+    if fallocate is not None:
+        try:
+            fallocate(fobj.fileno(), offset, length)
+        except OSError:
+            pass
+    elif _fallocate is not None:
+        # the error number is returned, e.g EOPNOTSUPP, errno is not set
+        _fallocate(fobj.fileno(), offset, length)
+
+
+class Download(object):
+    """
+    Download of a url to a local file that can be resumed.
+    """
+    def __init__(self, url, local_path, auth=None, session=None, etag=None,
+                 mtime=None, size=None, segments=1, segment_threshold=None,
+                 buffer_size=BUFFER_SIZE, digests=(), checksum=None,
+                 timeout=TIMEOUT, min_speed=None, stall_window=60,
+                 part_path=None, claim=None):
+        """
+        constructor
+
+        :param url: the url of the file
+        :param local_path: the path of the downloaded file
+        :param auth: the authentication passed to requests
+        :param session: the Transport (or requests.Session) used to send the
+         request, by default a new connection is opened
+        :param etag: the etag of the remote file, used to validate that a
+         partial download is of the same version of the file
+        :param mtime: the modification time of the remote file in seconds
+         since the epoch, used as the validator if the etag is not known
+        :param size: the expected size of the file in bytes
+        :param int segments: the number of byte ranges fetched in parallel
+         for files whose size is at least segment_threshold
+        :param int segment_threshold: the minimum size in bytes of the files
+         that are downloaded in segments, None disables segmented downloads
+        :param int buffer_size: the size of the read buffer in bytes
+        :param digests: the names of the hashlib algorithms whose digests
+         are computed while the file is downloaded, e.g ['md5', 'sha1']
+        :param checksum: the checksums of the remote file in the owncloud
+         format (e.g 'SHA1:abcd MD5:ef01'), the download fails if a computed
+         digest does not match
+        :param timeout: the (connect, read) timeouts of the requests in
+         seconds, None waits forever
+        :param int min_speed: the minimum throughput of a transfer in
+         bytes/s, a transfer that is slower than that over stall_window
+         seconds is aborted with a StalledError. None disables the check.
+        :param stall_window: the duration in seconds over which the
+         throughput is measured
+        :param part_path: the path of the file while it is downloaded, by
+         default local_path with the '.part' suffix
+        :param claim: a callable that is passed the download once it is
+         complete and before it is moved to local_path, the download is
+         cancelled if it returns False
+        """
+        self.url = url
+        """the url of the file"""
+
+        self.local_path = local_path
+        """the path of the downloaded file"""
+
+        self.part_path = local_path + PART_SUFFIX if part_path is None \
+            else part_path
+        """the path of the file while it is being downloaded"""
+
+        self.validator_path = self.part_path + VALIDATOR_SUFFIX
+        """the path of the validator the partial file was started with"""
+
+        self.auth = auth
+        """the authentication passed to requests"""
+
+        self.session = requests if session is None else session
+        """the object used to send the requests"""
+
+        self.etag = etag
+        """the etag of the remote file"""
+
+        self.mtime = mtime
+        """the modification time of the remote file"""
+
+        self.size = size
+        """the expected size of the file"""
+
+        self.offset = 0
+        """the number of bytes that were already downloaded"""
+
+        self.status_code = None
+        """the http status code of the response"""
+
+        self.segments = segments
+        """the number of byte ranges of segmented downloads"""
+
+        self.segment_threshold = segment_threshold
+        """the minimum size of the files downloaded in segments"""
+
+        self.buffer_size = buffer_size
+        """the size of the read buffer in bytes"""
+
+        self.digests = [digest.lower() for digest in digests]
+        """the names of the algorithms of the computed digests"""
+
+        self.expected_checksums = parse_checksums(checksum)
+        """the checksums of the remote file by algorithm"""
+
+        self.checksums = dict()
+        """the digests of the downloaded file by (upper case) algorithm"""
+
+        self._hashes = []
+        """the hash objects updated with the downloaded data"""
+
+        self.timeout = timeout
+        """the (connect, read) timeouts of the requests"""
+
+        self.min_speed = min_speed
+        """the minimum throughput of a transfer in bytes/s"""
+
+        self.stall_window = stall_window
+        """the duration over which the throughput is measured"""
+
+        self.claim = claim
+        """called before the complete file is moved into place"""
+
+        self.started = None
+        """the time the download started at"""
+
+        self.transferred = 0
+        """the number of bytes received so far (excluding the resumed
+        ones)"""
+
+        self._cancelled = threading.Event()
+        """set when the download is cancelled"""
+
+    @property
+    def validator(self):
+        """the value of the If-Range header, None if there is none"""
+        if self.etag is not None:
+            return self.etag
+        if self.mtime is not None:
+            return email.utils.formatdate(self.mtime, usegmt=True)
+        return None
+
+    def run(self):
+        """
+        download the file
+
+        :return: True if the file was downloaded successfully
+        """
+        print('downloading {} to {}'.format(self.url, self.local_path))
+        try:
+            self._download()
+        except CancelledError as e:
+            print(e)
+            self._remove_part()
+            return False
+        except Exception as e:
+            print('download failed...')
+            print(e)
+            return False
+        else:
+            return True
+
+    def _download(self):
+        """download the file, raise an exception on failure"""
+        self.started = time.time()
+        self._hashes = [hashlib.new(digest) for digest in self.digests]
+        if self.segmented:
+            self._download_segments()
+        else:
+            self._download_stream()
+        self._check_checksums()
+        if self.claim is not None and not self.claim(self):
+            raise CancelledError('the download of {} was superseded'.format(
+                self.url))
+        os.rename(self.part_path, self.local_path)
+        if os.path.isfile(self.validator_path):
+            os.remove(self.validator_path)
+        if self.mtime is not None:
+            # the mtime of the remote file lets verify skip unchanged files
+            os.utime(self.local_path, (self.mtime, self.mtime))
+
+    def cancel(self):
+        """abort the download, run() returns False (from another thread)"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        """True if the download was cancelled"""
+        return self._cancelled.is_set()
+
+    @property
+    def throughput(self):
+        """the average throughput of the download so far in bytes/s"""
+        if self.started is None:
+            return 0.0
+        return self.transferred / max(time.time() - self.started, 1e-6)
+
+    @property
+    def segmented(self):
+        """True if the file is downloaded in segments. A partial download
+        left by a previous single stream download is resumed instead."""
+        return (
+            self.segments > 1 and
+            self.segment_threshold is not None and
+            self.size is not None and
+            self.size >= self.segment_threshold and
+            not os.path.isfile(self.part_path)
+        )
+
+    def _download_stream(self):
+        """download (or resume) the file over a single stream"""
+        headers = {}
+
+        self.offset = 0
+        if os.path.isfile(self.part_path):
+            saved = self._saved_validator()
+            if saved is None or saved != self.validator:
+                # the partial file is of another version of the file
+                self._remove_part()
+            else:
+                self.offset = os.path.getsize(self.part_path)
+                if self.offset > 0:
+                    headers['Range'] = 'bytes={}-'.format(self.offset)
+                    headers['If-Range'] = saved
+
+        request = self._get(headers)
+        try:
+            self.status_code = request.status_code
+            if request.status_code == 416:
+                # the partial file is not a prefix of the remote file
+                self._remove_part()
+            request.raise_for_status()
+
+            if request.status_code == 206:
+                content_range = request.headers.get('Content-Range', '')
+                if not content_range.startswith(
+                        'bytes {}-'.format(self.offset)):
+                    self._remove_part()
+                    raise IOError(
+                        'unexpected Content-Range {} for {}'.format(
+                            content_range, self.url))
+                print('resuming {} from byte {}'.format(
+                    self.url, self.offset))
+                mode = 'r+b'
+            else:
+                # the server does not support ranges or the file changed
+                self.offset = 0
+                mode = 'wb'
+                self._save_validator()
+
+            expected_size = None
+            if ('Content-Length' in request.headers and
+                    'Content-Encoding' not in request.headers):
+                expected_size = self.offset + int(
+                    request.headers['Content-Length'])
+
+            with io.open(self.part_path, mode, buffering=0) as fobj:
+                if self.offset > 0 and self._hashes:
+                    # the digests must include the already downloaded data
+                    self._hash_file(fobj, self.offset)
+                fobj.seek(self.offset)
+                # the file is not preallocated, the download is resumed from
+                # its size which must be the number of bytes written even if
+                # the process is killed
+                self._write(request, fobj, self._hashes)
+        finally:
+            # release the connection back to the pool
+            request.close()
+
+        self._check_size(expected_size)
+
+    def _download_segments(self):
+        """download the file in byte ranges fetched in parallel and
+        written at their offset in the preallocated partial file"""
+        step = -(-self.size // self.segments)
+        bounds = [
+            (start, min(start + step, self.size) - 1)
+            for start in range(0, self.size, step)
+        ]
+
+        # the first range is requested first, if the server ignores the
+        # range the whole file is downloaded from that response instead. The
+        # partial file is sized only once the server accepted the range, a
+        # full size partial file can not be resumed.
+        first = self._get_range(*bounds[0])
+        if first.status_code != 206:
+            print('ranges are not supported for {}'.format(self.url))
+            try:
+                self.status_code = first.status_code
+                first.raise_for_status()
+                self._save_validator()
+                with io.open(self.part_path, 'wb', buffering=0) as fobj:
+                    self._write(first, fobj, self._hashes)
+            finally:
+                first.close()
+            self._check_size(None)
+            return
+
+        print('downloading {} in {} segments'.format(self.url, len(bounds)))
+        self.status_code = first.status_code
+        try:
+            with io.open(self.part_path, 'wb', buffering=0) as fobj:
+                fobj.truncate(self.size)
+                preallocate(fobj, 0, self.size)
+        except Exception:
+            first.close()
+            raise
+        errors = []
+
+        def fetch(start, end, request=None):
+            try:
+                if request is None:
+                    request = self._get_range(start, end)
+                try:
+                    if request.status_code != 206 or not request.headers.get(
+                            'Content-Range', '').startswith(
+                                'bytes {}-{}/'.format(start, end)):
+                        raise IOError('unexpected response {} {} for the '
+                                      'range {}-{} of {}'.format(
+                                          request.status_code,
+                                          request.headers.get('Content-Range'),
+                                          start, end, self.url))
+                    with io.open(self.part_path, 'r+b', buffering=0) as fobj:
+                        fobj.seek(start)
+                        written = self._write(request, fobj, ())
+                finally:
+                    request.close()
+                if written != end - start + 1:
+                    raise IOError('incomplete range {}-{} of {}: {} bytes'.format(
+                        start, end, self.url, written))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=fetch, args=(start, end))
+            for start, end in bounds[1:]
+        ]
+        for thread in threads:
+            thread.start()
+        fetch(bounds[0][0], bounds[0][1], first)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            # the preallocated file can not be resumed
+            self._remove_part()
+            raise errors[0]
+
+        self._check_size(None)
+
+        if self._hashes:
+            # the segments are written out of order, the digests are computed
+            # from the file once it is complete (it is likely to still be in
+            # the page cache)
+            with io.open(self.part_path, 'rb', buffering=0) as fobj:
+                self._hash_file(fobj, self.size)
+
+    def _saved_validator(self):
+        """return the validator the partial file was started with, None if
+        it was not recorded"""
+        try:
+            with open(self.validator_path, 'rb') as fobj:
+                return fobj.read()
+        except IOError:
+            return None
+
+    def _save_validator(self):
+        """record the validator of the version of the file that is written
+        to the partial file, a partial file without validator is not
+        resumed"""
+        validator = self.validator
+        if validator is None:
+            if os.path.isfile(self.validator_path):
+                os.remove(self.validator_path)
+            return
+        if isinstance(validator, unicode):
+            validator = validator.encode('utf-8')
+        with open(self.validator_path, 'wb') as fobj:
+            fobj.write(validator)
+
+    def _remove_part(self):
+        """remove the partial file and its validator"""
+        for path in (self.part_path, self.validator_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _get(self, headers):
+        """send the GET request of the file"""
+        return self.session.get(self.url, stream=True, auth=self.auth,
+                                headers=headers, verify=False,
+                                timeout=self.timeout)
+
+    def _get_range(self, start, end):
+        """send the GET request of the byte range start-end (inclusive)"""
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        if self.validator is not None:
+            headers['If-Range'] = self.validator
+        return self._get(headers)
+
+    def _write(self, request, fobj, hashes):
+        """write the body of the response to fobj and update the hash
+        objects 'hashes' with it
+
+        :return: the number of bytes written
+        """
+        written = 0
+        watchdog = self._watchdog()
+        watchdog.next()
+
+        if 'Content-Encoding' in request.headers:
+            # decoded chunks do not have a bounded size, they can not be
+            # read into the buffer
+            for chunk in request.iter_content(chunk_size=self.buffer_size):
+                fobj.write(chunk)
+                for _hash in hashes:
+                    _hash.update(chunk)
+                written += len(chunk)
+                self.transferred += len(chunk)
+                watchdog.send(written)
+            return written
+
+        raw = request.raw
+        view = get_buffer(self.buffer_size)
+        while True:
+            n_read = raw.readinto(view)
+            if not n_read:
+                break
+            fobj.write(view[:n_read])
+            for _hash in hashes:
+                _hash.update(view[:n_read])
+            written += n_read
+            self.transferred += n_read
+            watchdog.send(written)
+        return written
+
+    def _watchdog(self):
+        """coroutine that is sent the number of bytes written so far and
+        raises a StalledError if less than min_speed * stall_window bytes
+        were written during the last stall_window seconds"""
+        window_start, window_written = time.time(), 0
+        while True:
+            written = yield
+            if self.cancelled:
+                raise CancelledError('the download of {} was cancelled'.format(
+                    self.url))
+            if self.min_speed is None:
+                continue
+            now = time.time()
+            if now - window_start >= self.stall_window:
+                speed = (written - window_written) / (now - window_start)
+                if speed < self.min_speed:
+                    raise StalledError(
+                        'the download of {} stalled at {:.0f} bytes/s'.format(
+                            self.url, speed))
+                window_start, window_written = now, written
+
+    def _hash_file(self, fobj, length):
+        """update the digests with the first length bytes of fobj"""
+        fobj.seek(0)
+        view = get_buffer(self.buffer_size)
+        while length > 0:
+            n_read = fobj.readinto(view[:min(length, len(view))])
+            if not n_read:
+                break
+            for _hash in self._hashes:
+                _hash.update(view[:n_read])
+            length -= n_read
+
+    def _check_checksums(self):
+        """set self.checksums from the computed digests and raise an
+        exception if one of them does not match the checksum of the server.
+        The partial file is removed since it can not be resumed."""
+        self.checksums = {
+            _hash.name.upper(): _hash.hexdigest() for _hash in self._hashes
+        }
+        for algorithm, digest in self.checksums.items():
+            expected = self.expected_checksums.get(algorithm)
+            if expected is not None and expected != digest:
+                self._remove_part()
+                raise IOError(
+                    'the {} checksum of {} does not match: {} instead of '
+                    '{}'.format(algorithm, self.url, digest, expected))
+
+    def _check_size(self, expected_size):
+        """raise an exception if the size of the downloaded data is not the
+        expected one. The partial file is kept to be resumed."""
+        for size in (expected_size, self.size):
+            if size is not None and os.path.getsize(self.part_path) != size:
+                raise IOError(
+                    'incomplete download of {}: {} bytes instead of {}'.format(
+                        self.url, os.path.getsize(self.part_path), size))
+
+
+def download_file_to_buffer(url, auth=None, session=None, timeout=TIMEOUT):
+    """
+    taken from http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
+
+    :param session: the Transport (or requests.Session) used to send the
+     request, by default a new connection is opened
+    :param timeout: the (connect, read) timeouts in seconds
+    """
+    print('downloading {}'.format(url))
+    session = requests if session is None else session
+    request = None
+    try:
+        # the body is read in one go into a single buffer
+        request = session.get(url, auth=auth, verify=False, timeout=timeout)
+        content = request.content
+    except Exception as e:
+        print('download failed...')
+        print(e)
+        return None
+    else:
+        return content
+    finally:
+        # release the connection back to the pool
+        if request is not None:
+            request.close()
+
+
+def download_file(url, local_url, auth=None, session=None, **kwargs):
+    """
+    download url to the local file local_url, resuming a previous partial
+    download if possible.
+
+    :param session: the Transport (or requests.Session) used to send the
+     request, by default a new connection is opened
+    :param kwargs: passed to Download (etag, mtime, size, digests...)
+    :return: True if the file was downloaded successfully
+    """
+    return Download(url, local_url, auth=auth, session=session,
+                    **kwargs).run()
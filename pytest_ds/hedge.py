@@ -0,0 +1,193 @@
+"""
+Hedged downloads of the stragglers at the tail of a sync.
+
+Once the work queue is empty the idle sync workers look for transfers that
+run well below the median throughput, e.g because they hit a slow backend
+node or a congested connection. A duplicate download of such a file is
+started over a fresh connection into its own partial file, the first of the
+two that completes is moved into place and the other one is cancelled.
+"""
+import threading
+import time
+
+
+HEDGE_SUFFIX = '.hedge'
+"""the suffix of the partial files of the hedged downloads"""
+
+
+class Race(object):
+    """
+    The downloads of the same file, the first one that completes wins.
+    """
+    def __init__(self):
+        """
+        constructor
+        """
+        self.downloads = []
+        """the competing Download objects"""
+
+        self.winner = None
+        """the download that completed first"""
+
+        self.success = False
+        """True if the winner was moved into place successfully"""
+
+        self.hedged = False
+        """True if a duplicate download was started"""
+
+        self._lock = threading.Lock()
+        """serializes the claims"""
+
+        self._pending = 0
+        """the number of downloads that did not finish"""
+
+        self._finished = threading.Event()
+        """set when the winner or all the downloads finished"""
+
+    def add(self, download):
+        """
+        add a download to the race
+
+        :param download: a Download object that was not started
+        :return: False if the race is already over, the download must not
+         be started then
+        """
+        with self._lock:
+            if self.winner is not None or self._finished.is_set():
+                return False
+            download.claim = self.claim
+            self.downloads.append(download)
+            self._pending += 1
+            return True
+
+    def claim(self, download):
+        """
+        called by a download once it is complete, the other downloads are
+        cancelled
+
+        :param download: the complete Download object
+        :return: True if download is the first one to complete
+        """
+        with self._lock:
+            if self.winner is not None:
+                return False
+            self.winner = download
+            for other in self.downloads:
+                if other is not download:
+                    other.cancel()
+            return True
+
+    def finish(self, download, success):
+        """
+        record the end of a download
+
+        :param download: the Download object
+        :param bool success: the return value of download.run()
+        """
+        with self._lock:
+            self._pending -= 1
+            if download is self.winner:
+                self.success = success
+                self._finished.set()
+            elif self._pending == 0:
+                self._finished.set()
+
+    def wait(self):
+        """
+        wait until the winner or all the downloads finished
+
+        :return: True if the file was downloaded by one of the downloads
+        """
+        self._finished.wait()
+        return self.success
+
+
+class Hedger(object):
+    """
+    Registry of the running downloads of a sync that picks the stragglers.
+    """
+    def __init__(self, factor=0.25, min_elapsed=10.0):
+        """
+        constructor
+
+        :param float factor: a download whose throughput is below factor
+         times the median throughput is a straggler
+        :param float min_elapsed: the minimum duration of a download in
+         seconds before it can be considered a straggler
+        """
+        self.factor = factor
+        """the fraction of the median throughput of a straggler"""
+
+        self.min_elapsed = min_elapsed
+        """the minimum duration of a straggler"""
+
+        self.n_hedged = 0
+        """the number of hedged downloads that were started"""
+
+        self._lock = threading.Lock()
+        """guards the registry"""
+
+        self._running = {}
+        """map of the paths being downloaded to (download, race, args)"""
+
+        self._throughputs = []
+        """the throughputs of the completed downloads"""
+
+    def start(self, fs_path, download, args):
+        """
+        register a download that is about to start
+
+        :param fs_path: the path relative to the data dir
+        :param download: the Download object
+        :param args: the arguments needed to start a duplicate download
+        :return: the Race object of the file
+        """
+        race = Race()
+        race.add(download)
+        with self._lock:
+            self._running[fs_path] = (download, race, args)
+        return race
+
+    def stop(self, fs_path, download, success):
+        """
+        unregister a finished download
+
+        :param fs_path: the path relative to the data dir
+        :param download: the Download object
+        :param bool success: True if the download succeeded
+        """
+        with self._lock:
+            self._running.pop(fs_path, None)
+            if success and download.transferred > 0:
+                self._throughputs.append(download.throughput)
+
+    def running(self):
+        """return True if downloads are running"""
+        with self._lock:
+            return len(self._running) > 0
+
+    def straggler(self):
+        """
+        pick a running download that is much slower than the median and
+        that was not hedged already
+
+        :return: (fs_path, race, args) or None
+        """
+        with self._lock:
+            throughputs = sorted(
+                self._throughputs or
+                [download.throughput
+                 for download, _, _ in self._running.values()])
+            if not throughputs:
+                return None
+            median = throughputs[len(throughputs) // 2]
+
+            now = time.time()
+            for fs_path, (download, race, args) in self._running.items():
+                if (not race.hedged and download.started is not None and
+                        now - download.started >= self.min_elapsed and
+                        download.throughput < self.factor * median):
+                    race.hedged = True
+                    self.n_hedged += 1
+                    return fs_path, race, args
+        return None
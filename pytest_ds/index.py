@@ -0,0 +1,336 @@
+"""
+Index files of the remote content.
+
+An index file lists the content of the remote folder, one line per file or
+dir, as printed by the command:
+
+      ~> find test_data -exec stat --format="##%F##%s##%Y##%n##" '{}' \;
+
+Large trees have indexes of hundreds of MB, so the index is read line by
+line straight from the http response instead of being loaded into memory.
+It may be compressed with gzip or zstd (the compression is detected from the
+first bytes of the body). The index is fetched with a conditional GET using
+the ETag and Last-Modified headers of the previous response, an unchanged
+index costs a single '304 Not Modified' response.
+
+write_index() generates an index without forking a stat process per file:
+the tree is listed by parallel scandir workers and the optional checksums
+of the files are computed by a pool of processes. The checksums are written
+in an extra field after the path (in the owncloud format):
+
+      ##regular file##1024##1489485001##dir/foo.bin##MD5:abcd... SHA1:ef01...##
+
+An index with a '.gz' (or '.zst') extension is compressed. A previous index
+can be passed to regenerate it incrementally, the checksums of the files
+whose size and mtime did not change are copied from it. An index written
+inside the directory it lists does not list itself.
+"""
+from __future__ import print_function
+import os
+import re
+import gzip
+import zlib
+import multiprocessing
+
+import requests
+
+from pytest_ds.download import TIMEOUT, format_checksums, parse_checksums
+from pytest_ds.utils import Content
+from pytest_ds.scan import scan_tree
+from pytest_ds.verify import hash_file
+
+try:
+    import zstandard
+    ZSTD_IS_AVAILABLE = True
+except ImportError:
+    ZSTD_IS_AVAILABLE = False
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+"""the first bytes of a gzip stream"""
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+"""the first bytes of a zstd frame"""
+
+CHUNK_SIZE = 1024 ** 2
+"""the size of the chunks of the body that are read at once"""
+
+INDEX_FILE_TYPES = {'directory': 'dir', 'regular file': 'file'}
+"""map of the file types printed by stat to the Content types"""
+
+CONTENT_FILE_TYPES = {value: key for key, value in INDEX_FILE_TYPES.items()}
+"""map of the Content types to the file types printed by stat"""
+
+CHECKSUM_FIELD = re.compile(r'^(.*)##((?:[A-Z0-9]+:[0-9a-f]+ ?)+)$')
+"""matches the path and the checksums field of a line"""
+
+
+def parse_index_line(line):
+    """
+    parse a line of an index file, i.e a line printed by
+
+          ~> stat --format="##%F##%s##%Y##%n##" <path>
+
+    optionally followed by the checksums of the file
+
+    :param str line: the line without the trailing newline
+    :return: Content object whose name is the path
+    """
+    ftype, size, mtime, fs_path = line.strip('#').split('##', 3)
+    checksum = None
+    match = CHECKSUM_FIELD.match(fs_path)
+    if match is not None:
+        fs_path, checksum = match.groups()
+    return Content(INDEX_FILE_TYPES.get(ftype, ftype), fs_path, mtime,
+                   size=int(size), checksum=checksum)
+
+
+def format_index_line(content):
+    """
+    the inverse of parse_index_line
+
+    :param content: Content object whose name is the path
+    :return: str without the trailing newline
+    """
+    fields = [CONTENT_FILE_TYPES.get(content.type, content.type),
+              str(content.size or 0),
+              str(content.mtime),
+              content.name]
+    if content.checksum:
+        fields.append(content.checksum)
+    return '##{}##'.format('##'.join(fields))
+
+
+def _decompressor(head):
+    """
+    return an object whose decompress() method decodes the chunks of a
+    stream that starts with the bytes 'head'
+
+    :param bytes head: the first bytes of the stream
+    :return: decompressor or None if the stream is not compressed
+    """
+    if head.startswith(GZIP_MAGIC):
+        # 16 + MAX_WBITS expects the gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if head.startswith(ZSTD_MAGIC):
+        if not ZSTD_IS_AVAILABLE:
+            raise IOError('the index is compressed with zstd, the zstandard '
+                          'package is required to read it')
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def iter_lines(chunks):
+    """
+    generate the non empty lines of a possibly compressed stream
+
+    :param chunks: iterable of the bytes of the stream
+    :return: generator of str without the trailing newline
+    """
+    decompressor = None
+    head = b''
+    remainder = b''
+    for chunk in chunks:
+        if head is not None:
+            # the compression is detected once the magic bytes are read
+            head += chunk
+            if len(head) < len(ZSTD_MAGIC):
+                continue
+            decompressor = _decompressor(head)
+            chunk, head = head, None
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if head:
+        # the stream is shorter than the magic bytes
+        remainder = head
+    elif decompressor is not None and hasattr(decompressor, 'flush'):
+        remainder += decompressor.flush()
+    for line in remainder.split(b'\n'):
+        if line:
+            yield line
+
+
+def fetch_index(url, auth=None, session=None, etag=None, last_modified=None,
+                timeout=TIMEOUT):
+    """
+    send a conditional GET request of an index file
+
+    :param url: the url of the index file
+    :param session: the Transport (or requests.Session) used to send the
+     request, by default a new connection is opened
+    :param etag: the ETag of the previous response, sent as If-None-Match
+    :param last_modified: the Last-Modified header of the previous response,
+     sent as If-Modified-Since
+    :param timeout: the (connect, read) timeouts in seconds
+    :return: (lines, validators) where lines is a generator of the lines of
+     the index, or None if the index did not change, and validators is a
+     dict with the 'etag' and 'last_modified' of the response. The
+     connection is released once lines is exhausted or closed.
+    """
+    print('downloading {}'.format(url))
+    session = requests if session is None else session
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    request = session.get(url, stream=True, auth=auth, headers=headers,
+                          verify=False, timeout=timeout)
+    if request.status_code == 304:
+        request.close()
+        return None, dict(etag=etag, last_modified=last_modified)
+    try:
+        request.raise_for_status()
+    except Exception:
+        request.close()
+        raise
+
+    validators = dict(etag=request.headers.get('ETag'),
+                      last_modified=request.headers.get('Last-Modified'))
+
+    def lines():
+        try:
+            # a Content-Encoding of the response is decoded by requests,
+            # a compressed index file is decoded by iter_lines
+            for line in iter_lines(request.iter_content(CHUNK_SIZE)):
+                yield line
+        finally:
+            request.close()
+
+    return lines(), validators
+
+
+def read_index(path):
+    """
+    read a local index file, possibly compressed
+
+    :param path: the path of the index file
+    :return: generator of Content objects whose names are the paths
+    """
+    with open(path, 'rb') as fobj:
+        chunks = iter(lambda: fobj.read(CHUNK_SIZE), b'')
+        for line in iter_lines(chunks):
+            yield parse_index_line(line)
+
+
+def _open_output(path, compression_path):
+    """open the file path for writing, it is compressed according to the
+    extension of compression_path"""
+    if compression_path.endswith('.gz'):
+        return gzip.GzipFile(path, 'wb')
+    if compression_path.endswith('.zst'):
+        if not ZSTD_IS_AVAILABLE:
+            raise IOError('the zstandard package is required to write {}'
+                          .format(compression_path))
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+def _hash_entry(args):
+    """compute the checksums of a file in a worker process
+
+    :param args: the tuple (abs_path, algorithms)
+    :return: the checksums in the owncloud format or None if the file can
+     not be read
+    """
+    abs_path, algorithms = args
+    try:
+        return format_checksums(hash_file(abs_path, algorithms))
+    except EnvironmentError:
+        return None
+
+
+def write_index(root, path, n_threads=8, algorithms=(), n_processes=None,
+                previous=None):
+    """
+    write the index of the content of a local directory
+
+    :param root: the path of the directory
+    :param path: the path of the index file, it is compressed if its
+     extension is '.gz' or '.zst'. It is replaced atomically.
+    :param int n_threads: the number of threads that list the directories
+    :param algorithms: the names of the checksums of the files e.g
+     ['md5'], no checksum is computed if it is empty
+    :param int n_processes: the number of processes that compute the
+     checksums, by default the number of cores
+    :param previous: the path of a previous index of the same directory,
+     the checksums of the files whose size and mtime did not change are
+     copied from it
+    :return: dict with the number of 'dirs' and 'files' and the number of
+     files that were 'hashed'
+    """
+    algorithms = [algorithm.upper() for algorithm in algorithms]
+
+    known = {}
+    if algorithms and previous is not None and os.path.isfile(previous):
+        known = {
+            content.name: content for content in read_index(previous)
+            if content.type == 'file' and content.checksum
+        }
+
+    # the index (and its temporary file) may be published in the dir it
+    # lists, its size changes once it is written
+    real_root = os.path.realpath(root)
+    excluded = set()
+    for output_path in (path, path + '.tmp'):
+        rel_path = os.path.relpath(os.path.realpath(output_path), real_root)
+        if rel_path.split(os.sep)[0] != os.pardir:
+            excluded.add(rel_path)
+
+    contents = []
+    to_hash = []
+    for rel_path, is_dir, stat_result in scan_tree(root, n_threads):
+        if rel_path in excluded:
+            continue
+        content = Content('dir' if is_dir else 'file', rel_path,
+                          int(stat_result.st_mtime),
+                          size=stat_result.st_size)
+        contents.append(content)
+        if is_dir or not algorithms:
+            continue
+
+        old = known.get(rel_path)
+        if (old is not None and old.size == content.size and
+                old.mtime == content.mtime and
+                set(parse_checksums(old.checksum)).issuperset(algorithms)):
+            content.checksum = old.checksum
+        else:
+            to_hash.append(content)
+
+    if to_hash:
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            checksums = pool.imap(
+                _hash_entry,
+                [(os.path.join(root, content.name), algorithms)
+                 for content in to_hash],
+                chunksize=16)
+            for content, checksum in zip(to_hash, checksums):
+                content.checksum = checksum
+        finally:
+            pool.close()
+            pool.join()
+
+    # the dirs come before their content when sorted by path
+    contents.sort(key=lambda content: content.name)
+
+    tmp_path = path + '.tmp'
+    fobj = _open_output(tmp_path, path)
+    try:
+        for content in contents:
+            fobj.write(format_index_line(content) + '\n')
+    finally:
+        fobj.close()
+    os.rename(tmp_path, path)
+
+    return dict(
+        dirs=sum(1 for content in contents if content.type == 'dir'),
+        files=sum(1 for content in contents if content.type == 'file'),
+        hashed=len(to_hash),
+    )
@@ -12,6 +12,7 @@ from argparse import RawTextHelpFormatter
 import pytest_ds
 from pytest_ds import metadata, logger
 from pytest_ds.tree import Query
+from pytest_ds.index import write_index
 
 
 DEFAULT_CONFIG_DIR = '~/.config/pytest_ds'
@@ -31,6 +32,26 @@ usage:
     # sync content as described in the specified config file
     ~> pytest_ds_cli --config=/path/to/my/config.ini
 
+    # check the synced files against the sync state (--deep hashes all
+    # the files, not only the ones whose size or mtime changed)
+    ~> pytest_ds_cli verify --config=/path/to/my/config.ini [--deep]
+
+    # rebuild a lost sync state from the files already in the data dir
+    # (--deep also compares the checksums of the files whose mtime differs)
+    ~> pytest_ds_cli reindex --config=/path/to/my/config.ini [--deep]
+
+    # sync one of N disjoint slices of the content (0 <= i < N), e.g from
+    # N nodes into a shared data dir, then merge the state fragments of the
+    # shards into the sync state once all the N shards are synced
+    ~> pytest_ds_cli --config=/path/to/my/config.ini --shard=i/N
+    ~> pytest_ds_cli merge-state --config=/path/to/my/config.ini
+
+    # write the index file of a directory to be published (read by the
+    # 'index_file' option), with the md5 checksums of the files, re-using
+    # the checksums of the unchanged files of the previous index
+    ~> pytest_ds_cli index /path/to/dir -o /path/to/dir/index.txt.gz \
+           --checksums md5 --previous /path/to/dir/index.txt.gz
+
 """
 
 
@@ -69,6 +90,18 @@ URL: <{url}>
                         version='{0} {1}'.format(metadata.project,
                                                  metadata.version))
 
+    parser.add_argument('command',
+                        nargs='?',
+                        choices=['sync', 'verify', 'reindex', 'index',
+                                 'merge-state'],
+                        default='sync',
+                        help="[sync by default] the operation to perform")
+
+    parser.add_argument('path',
+                        nargs='?',
+                        default='.',
+                        help="index: the directory to index")
+
     parser.add_argument('-c', '--config',
                         type=str,
                         default=None,
@@ -84,6 +117,64 @@ URL: <{url}>
                         "[off by default] when specified the files are listed ")
                         )
 
+    parser.add_argument("--shard",
+                        type=str,
+                        default=None,
+                        help=(
+                        "sync: i/N to sync only the i-th of N disjoint slices "
+                        "of the content (0 <= i < N)")
+                        )
+
+    parser.add_argument("--deep",
+                        action="store_true",
+                        default=False,
+                        help=(
+                        "[off by default] verify: hash all the files instead "
+                        "of only those whose size or mtime changed. reindex: "
+                        "compare the checksums of the files whose mtime "
+                        "changed")
+                        )
+
+    parser.add_argument("-j", "--processes",
+                        type=int,
+                        default=None,
+                        help=(
+                        "verify, index: the number of processes that hash "
+                        "the files, by default the number of cores")
+                        )
+
+    parser.add_argument("-o", "--output",
+                        type=str,
+                        default=None,
+                        help=(
+                        "index: the path of the index file, compressed if it "
+                        "ends with .gz or .zst")
+                        )
+
+    parser.add_argument("--checksums",
+                        nargs='+',
+                        default=[],
+                        help=(
+                        "index: the checksums written for each file e.g md5 "
+                        "sha1, none by default")
+                        )
+
+    parser.add_argument("--previous",
+                        type=str,
+                        default=None,
+                        help=(
+                        "index: a previous index of the directory, the "
+                        "checksums of the unchanged files are taken from it")
+                        )
+
+    parser.add_argument("--threads",
+                        type=int,
+                        default=8,
+                        help=(
+                        "index: the number of threads that list the "
+                        "directories")
+                        )
+
     parser.add_argument("--debug", "-dbg",
                         action="count",
                         default=0,
@@ -117,15 +208,32 @@ def _main(args):
     logger.info('using pytest_ds')
     logger.info('\t\t{}'.format(pytest_ds.__file__))
 
+    if args.command == 'index':
+        _index(args)
+        return
+
     config_path = find_config_file(args.config)
 
-    syncer = Query(config=config_path, index_webdav_enabled=True)
+    if args.command == 'verify':
+        _verify(config_path, args)
+        return
+    elif args.command == 'reindex':
+        _reindex(config_path, args)
+        return
+    elif args.command == 'merge-state':
+        _merge_state(config_path)
+        return
+
+    syncer = Query(config=config_path,
+                   index_url_enabled=True,
+                   index_webdav_enabled=True,
+                   shard=args.shard)
 
     if args.dry == 0:
-        syncer.sync(dry=False)
+        syncer.sync(n_threads=syncer._download_threads, dry=False)
     elif args.dry == 1:
         syncer.ls_url()
-        syncer.sync(dry=True)
+        syncer.sync(n_threads=syncer._download_threads, dry=True)
 
         logger.info(
             'new items to be downloaded = {}'.format(
@@ -135,11 +243,77 @@ def _main(args):
             'modified items to be download = {}'.format(
                 len(syncer.summary['modified']))
         )
+        logger.info(
+            'missing items to be downloaded = {}'.format(
+                len(syncer.summary['missing']))
+        )
+        logger.info(
+            'items deleted on the remote = {}'.format(
+                len(syncer.sync_plan.deleted))
+        )
     else:
         msg = '--dry is specified more than once. unknown behavior.'
         raise ValueError(msg)
 
 
+def _verify(config_path, args):
+    """check the local data dir against the sync state, raise an exception
+    if files are missing or corrupted"""
+    syncer = Query(config=config_path)
+
+    report = syncer.verify(deep=args.deep, n_processes=args.processes)
+
+    for status in ['missing', 'corrupted', 'unverified']:
+        for fs_path in report[status]:
+            logger.info('{}: {}'.format(status, fs_path))
+    for status in ['ok', 'missing', 'corrupted', 'unverified']:
+        logger.info('{} files = {}'.format(status, len(report[status])))
+
+    n_bad = len(report['missing']) + len(report['corrupted'])
+    if n_bad > 0:
+        raise ValueError('{} files are missing or corrupted'.format(n_bad))
+
+
+def _reindex(config_path, args):
+    """rebuild the sync state from the local data dir"""
+    syncer = Query(config=config_path,
+                   index_url_enabled=True,
+                   index_webdav_enabled=True)
+
+    report = syncer.reindex(checksums=args.deep)
+
+    for status in ['adopted', 'modified', 'missing']:
+        logger.info('{} files = {}'.format(status, len(report[status])))
+
+
+def _merge_state(config_path):
+    """merge the state fragments of the shards into the sync state"""
+    syncer = Query(config=config_path)
+
+    report = syncer.merge_state()
+
+    for fragment in report['fragments']:
+        logger.info('merged {}'.format(fragment))
+    logger.info('merged {} files from {} fragments'.format(
+        report['files'], len(report['fragments'])))
+
+
+def _index(args):
+    """write the index file of a directory"""
+    if args.output is None:
+        raise ValueError('the path of the index file is required (-o)')
+
+    report = write_index(args.path,
+                         args.output,
+                         n_threads=args.threads,
+                         algorithms=args.checksums,
+                         n_processes=args.processes,
+                         previous=args.previous)
+
+    logger.info('indexed {} dirs and {} files ({} hashed) in {}'.format(
+        report['dirs'], report['files'], report['hashed'], args.output))
+
+
 def find_config_file(config_file):
     """
     given a name of a configuration it is checked at the specified path, if 
@@ -0,0 +1,286 @@
+"""
+Compact columnar listing of content.
+
+The listing of the content read from an index file is kept in a sorted
+Manifest, ManifestPaths exposes it as the map of the paths to (content, url)
+of Query.fs_paths without holding a Content object and a url per file.
+"""
+from array import array
+import collections
+import os
+
+from pytest_ds.utils import Content
+
+
+class Manifest(object):
+    """
+    Array backed listing of Content objects.
+
+    The attributes of the content are stored column wise, the integer
+    attributes in typed arrays and the parent directory of each item as an
+    index into a list of interned directory prefixes. Content objects are
+    only created on access, so a listing of millions of items takes a
+    fraction of the memory of the equivalent list of Content objects.
+    """
+    UNSET = -1
+    """the value stored in the integer columns for None"""
+
+    def __init__(self):
+        """
+        constructor
+        """
+        self.dirs = []
+        """the unique parent directories"""
+
+        self._dir_ids = {}
+        """map of the parent directories to their index in self.dirs"""
+
+        self.types = []
+        """the unique content types"""
+
+        self._type_ids = {}
+        """map of the content types to their index in self.types"""
+
+        self.dir_ids = array('l')
+        """the index of the parent directory of each item in self.dirs"""
+
+        self.type_ids = array('b')
+        """the index of the type of each item in self.types"""
+
+        self.basenames = []
+        """the base names of the items"""
+
+        self.mtimes = array('l')
+        """the modification times of the items"""
+
+        self.sizes = array('l')
+        """the sizes of the items in bytes"""
+
+        self.etags = []
+        """the etags of the items"""
+
+        self.checksums = []
+        """the checksums of the items"""
+
+    @staticmethod
+    def from_contents(contents):
+        """
+        create a manifest from Content objects whose names are paths
+
+        :param contents: iterable of Content objects
+        :return: Manifest
+        """
+        retval = Manifest()
+        for content in contents:
+            retval.append(content)
+        return retval
+
+    @staticmethod
+    def _intern(value, values, ids):
+        """return the index of value in values, append it if it is new"""
+        index = ids.get(value)
+        if index is None:
+            index = ids[value] = len(values)
+            values.append(value)
+        return index
+
+    def append(self, content, path=None):
+        """
+        append a Content object to the manifest
+
+        :param content: a Content object whose name is the path of the item
+        :param path: the path of the item if the name of content is not the
+         path (e.g it is a node of a content tree)
+        """
+        dirname, basename = os.path.split(
+            content.name if path is None else path)
+        self.dir_ids.append(self._intern(dirname, self.dirs, self._dir_ids))
+        self.type_ids.append(
+            self._intern(content.type, self.types, self._type_ids))
+        self.basenames.append(basename)
+        self.mtimes.append(
+            self.UNSET if content.mtime is None else content.mtime)
+        self.sizes.append(self.UNSET if content.size is None else content.size)
+        self.etags.append(content.etag)
+        self.checksums.append(content.checksum)
+
+    def __len__(self):
+        return len(self.basenames)
+
+    def path(self, index):
+        """
+        return the path of the item at index
+
+        :param int index: the index of the item
+        :return: str
+        """
+        return os.path.join(self.dirs[self.dir_ids[index]],
+                            self.basenames[index])
+
+    def paths(self):
+        """generate the paths of the items"""
+        for index in range(len(self)):
+            yield self.path(index)
+
+    def __getitem__(self, index):
+        mtime = self.mtimes[index]
+        size = self.sizes[index]
+        return Content(
+            self.types[self.type_ids[index]],
+            self.path(index),
+            None if mtime == self.UNSET else mtime,
+            etag=self.etags[index],
+            size=None if size == self.UNSET else size,
+            checksum=self.checksums[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def take(self, indexes):
+        """
+        return a new manifest with the items at indexes, in that order. The
+        columns are copied without creating Content objects.
+
+        :param indexes: iterable of the indexes of the items
+        :return: Manifest
+        """
+        indexes = list(indexes)
+        retval = Manifest()
+        retval.dirs = list(self.dirs)
+        retval._dir_ids = dict(self._dir_ids)
+        retval.types = list(self.types)
+        retval._type_ids = dict(self._type_ids)
+        for name in ['dir_ids', 'type_ids', 'mtimes', 'sizes']:
+            column = getattr(self, name)
+            setattr(retval, name,
+                    array(column.typecode, (column[index]
+                                            for index in indexes)))
+        for name in ['basenames', 'etags', 'checksums']:
+            column = getattr(self, name)
+            setattr(retval, name, [column[index] for index in indexes])
+        return retval
+
+    def sorted(self):
+        """
+        return a new manifest with the items sorted by path
+
+        :return: Manifest
+        """
+        return self.take(sorted(range(len(self)), key=self.path))
+
+    def bisect(self, path):
+        """
+        return the index of the first item whose path is not smaller than
+        path. The manifest must be sorted.
+
+        :param path: the path to look up
+        :return: int
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.path(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def below(self, dirname):
+        """
+        generate the Content objects of the items below dirname. The manifest
+        must be sorted.
+
+        :param dirname: the path of a dir, '' for all the items
+        :return: generator of Content objects
+        """
+        if dirname == '':
+            lo, hi = 0, len(self)
+        else:
+            # '0' is the character that follows '/'
+            lo, hi = self.bisect(dirname + '/'), self.bisect(dirname + '0')
+        for index in range(lo, hi):
+            yield self[index]
+
+
+class ManifestPaths(collections.Mapping):
+    """
+    Read only map of the paths of the items of a sorted Manifest to
+    (content, url) pairs, as Query.fs_paths. The Content objects and the
+    urls are created on access and the items are iterated sorted by path.
+    """
+    def __init__(self, manifest, get_url):
+        """
+        constructor
+
+        :param manifest: a Manifest sorted by path
+        :param get_url: function that returns the download url of a path
+        """
+        self.manifest = manifest
+        """the listing sorted by path"""
+
+        self.get_url = get_url
+        """returns the download url of a path"""
+
+    def _index(self, fs_path):
+        """return the index of fs_path in the manifest, raise KeyError if it
+        is not there"""
+        index = self.manifest.bisect(fs_path)
+        if index == len(self.manifest) or \
+                self.manifest.path(index) != fs_path:
+            raise KeyError(fs_path)
+        return index
+
+    def __getitem__(self, fs_path):
+        return self.manifest[self._index(fs_path)], self.get_url(fs_path)
+
+    def __contains__(self, fs_path):
+        try:
+            self._index(fs_path)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return self.manifest.paths()
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def iteritems(self):
+        """generate the (fs_path, (content, url)) items sorted by path"""
+        for content in self.manifest:
+            yield content.name, (content, self.get_url(content.name))
+
+    def items(self):
+        return list(self.iteritems())
+
+    def select(self, predicate):
+        """
+        return the items for which predicate is True
+
+        :param predicate: function of (fs_path, (content, url))
+        :return: ManifestPaths
+        """
+        return ManifestPaths(
+            self.manifest.take(
+                index for index, item in enumerate(self.iteritems())
+                if predicate(*item)),
+            self.get_url)
+
+
+def select_items(fs_paths, predicate):
+    """
+    return the items of a map of the paths to (content, url) for which
+    predicate is True
+
+    :param fs_paths: dict or ManifestPaths, see Query.fs_paths
+    :param predicate: function of (fs_path, (content, url))
+    :return: a map of the same kind as fs_paths
+    """
+    if isinstance(fs_paths, ManifestPaths):
+        return fs_paths.select(predicate)
+    return {
+        fs_path: item for fs_path, item in fs_paths.items()
+        if predicate(fs_path, item)
+    }
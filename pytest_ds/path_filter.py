@@ -0,0 +1,226 @@
+"""
+Selection of the synced content by path, size and modification time.
+
+All the include patterns are compiled into a single regular expression (and
+so are the exclude patterns) so each path is matched once whatever the
+number of patterns. The literal prefixes of the include patterns tell which
+collections can contain selected files, the other collections do not need
+to be listed at all.
+"""
+import re
+
+from pytest_ds.utils import to_epoch
+
+
+REGEX_SPECIAL_CHARS = set('.^$*+?{}[]()|\\')
+"""the characters that end the literal prefix of a pattern"""
+
+REGEX_QUANTIFIERS = set('*?{')
+"""the quantifiers that make the preceding character optional"""
+
+
+def literal_prefix(pattern):
+    """
+    return the literal prefix of a regular expression, i.e the string every
+    match of the pattern (with re.match) starts with
+
+    :param str pattern: a regular expression
+    :return: str
+    """
+    if '|' in pattern:
+        # the alternatives may not share the prefix
+        return ''
+
+    prefix = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            if index + 1 < len(pattern) and \
+                    not pattern[index + 1].isalnum():
+                # escaped special character e.g '\.'
+                char = pattern[index + 1]
+                index += 1
+            else:
+                # character class e.g '\d'
+                break
+        elif char in REGEX_SPECIAL_CHARS:
+            if char in REGEX_QUANTIFIERS and prefix:
+                # the last character may be repeated zero times
+                prefix.pop()
+            break
+        prefix.append(char)
+        index += 1
+
+    return ''.join(prefix)
+
+
+def compile_patterns(patterns):
+    """
+    compile a list of regular expressions into one that matches if any of
+    them matches
+
+    :param patterns: list of regular expressions
+    :return: compiled regular expression or None if patterns is empty
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(pattern)
+                               for pattern in patterns))
+
+
+def split_patterns(value):
+    """return the non empty lines of a multi-line configuration value"""
+    if value is None:
+        return []
+    return [line.strip() for line in value.split('\n') if line.strip()]
+
+
+class PathFilter(object):
+    """
+    Predicate on the Content objects of the remote files.
+    """
+    def __init__(self, include=None, exclude=None, min_size=None,
+                 max_size=None, newer_than=None, older_than=None):
+        """
+        constructor
+
+        :param include: list of regular expressions, a file is selected if
+         its path relative to the data dir matches one of them (with
+         re.match). All files are selected if it is empty.
+        :param exclude: list of regular expressions, a file is not selected
+         if its path matches one of them
+        :param int min_size: the minimum size of the selected files in bytes
+        :param int max_size: the maximum size of the selected files in bytes
+        :param newer_than: the minimum mtime of the selected files, seconds
+         since the epoch or a http date
+        :param older_than: the maximum mtime of the selected files
+        """
+        self.include = list(include or [])
+        """the include patterns"""
+
+        self.exclude = list(exclude or [])
+        """the exclude patterns"""
+
+        self.min_size = min_size
+        """the minimum size of the selected files"""
+
+        self.max_size = max_size
+        """the maximum size of the selected files"""
+
+        self.newer_than = to_epoch(newer_than)
+        """the minimum mtime of the selected files"""
+
+        self.older_than = to_epoch(older_than)
+        """the maximum mtime of the selected files"""
+
+        self._include = compile_patterns(self.include)
+        """the compiled include patterns"""
+
+        self._exclude = compile_patterns(self.exclude)
+        """the compiled exclude patterns"""
+
+        self.prefixes = sorted(set(literal_prefix(pattern)
+                                   for pattern in self.include))
+        """the literal prefixes of the include patterns"""
+
+    @staticmethod
+    def from_config(config, section='RemoteDataSource'):
+        """
+        create a PathFilter from the 'include_regex', 'exclude_regex',
+        'min_size', 'max_size', 'newer_than' and 'older_than' options of a
+        section of the configuration
+
+        :param config: the ConfigParser object
+        :param section: the name of the section
+        :return: PathFilter or None if none of the options is set
+        """
+        def get(option):
+            if config.has_option(section, option):
+                return config.get(section, option)
+            return None
+
+        kwargs = dict(
+            include=split_patterns(get('include_regex')),
+            exclude=split_patterns(get('exclude_regex')),
+            min_size=get('min_size'),
+            max_size=get('max_size'),
+            newer_than=get('newer_than'),
+            older_than=get('older_than'),
+        )
+        if not any(kwargs.values()):
+            return None
+        for key in ['min_size', 'max_size']:
+            if kwargs[key] is not None:
+                kwargs[key] = int(kwargs[key])
+        return PathFilter(**kwargs)
+
+    def key(self):
+        """
+        return a string that identifies the selection, it is the include
+        patterns alone if no other criterion is set
+
+        :return: str
+        """
+        retval = '\n'.join(self.include)
+        for name in ['exclude', 'min_size', 'max_size', 'newer_than',
+                     'older_than']:
+            value = getattr(self, name)
+            if value:
+                if isinstance(value, list):
+                    value = '\n'.join(value)
+                retval += '\n#{}={}'.format(name, value)
+        return retval
+
+    def match_path(self, fs_path):
+        """
+        return True if the path is selected by the patterns
+
+        :param fs_path: the path relative to the data dir
+        :return: bool
+        """
+        if self._include is not None and not self._include.match(fs_path):
+            return False
+        if self._exclude is not None and self._exclude.match(fs_path):
+            return False
+        return True
+
+    def __call__(self, content):
+        """
+        return True if the file 'content' is selected
+
+        :param content: a Content object whose name is the path relative to
+         the data dir
+        :return: bool
+        """
+        if not self.match_path(content.name):
+            return False
+        if self.min_size is not None and content.size is not None and \
+                content.size < self.min_size:
+            return False
+        if self.max_size is not None and content.size is not None and \
+                content.size > self.max_size:
+            return False
+        if self.newer_than is not None and content.mtime is not None and \
+                content.mtime < self.newer_than:
+            return False
+        if self.older_than is not None and content.mtime is not None and \
+                content.mtime > self.older_than:
+            return False
+        return True
+
+    def may_contain(self, dirname):
+        """
+        return False if no file below the collection dirname can be
+        selected by the include patterns
+
+        :param dirname: the path of the collection relative to the data dir
+        :return: bool
+        """
+        if not self.prefixes:
+            return True
+        dir_prefix = dirname + '/'
+        for prefix in self.prefixes:
+            if dir_prefix.startswith(prefix) or prefix.startswith(dir_prefix):
+                return True
+        return False
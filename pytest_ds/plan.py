@@ -0,0 +1,124 @@
+"""
+Sync plan: the difference between the remote content and the sync state.
+
+The remote content and the synced files are both sorted by path and
+compared in a single merge-join pass before any download starts, and the
+local data dir is scanned once instead of checking the existence of each
+file on its own. The sync workers only execute the transfers of the plan
+and a dry run stops once the plan is made.
+"""
+
+
+CHANGE_TYPES = ('new', 'modified', 'missing')
+"""the kinds of files that are downloaded"""
+
+
+class SyncPlan(object):
+    """
+    The files to download, classified by the reason why they are
+    downloaded, and the synced files that are no longer on the remote.
+    """
+    def __init__(self):
+        """
+        constructor
+        """
+        self.new = []
+        """the (fs_path, url, content) of the files not in the sync state"""
+
+        self.modified = []
+        """the (fs_path, url, content) of the files whose mtime changed"""
+
+        self.missing = []
+        """the (fs_path, url, content) of the unchanged files that are not
+        in the local data dir"""
+
+        self.deleted = []
+        """the paths of the synced files that are not on the remote"""
+
+        self.n_unchanged = 0
+        """the number of files that are up to date"""
+
+    def __len__(self):
+        """the number of files to download"""
+        return sum(len(getattr(self, change_type))
+                   for change_type in CHANGE_TYPES)
+
+    def n_bytes(self, change_type):
+        """
+        return the total size of the files of a kind
+
+        :param str change_type: one of CHANGE_TYPES
+        :return: int
+        """
+        return sum(content.size or 0
+                   for _, _, content in getattr(self, change_type))
+
+    def transfers(self):
+        """
+        return the files to download sorted by path
+
+        :return: list of (fs_path, (content, url)) as in Query.fs_paths
+        """
+        retval = [
+            (fs_path, (content, url))
+            for change_type in CHANGE_TYPES
+            for fs_path, url, content in getattr(self, change_type)
+        ]
+        retval.sort(key=lambda item: item[0])
+        return retval
+
+    def report(self):
+        """
+        return a human readable summary of the plan
+
+        :return: str
+        """
+        lines = [
+            '{}: {} files, {} bytes'.format(change_type,
+                                            len(getattr(self, change_type)),
+                                            self.n_bytes(change_type))
+            for change_type in CHANGE_TYPES
+        ]
+        lines.append('deleted on the remote: {} files'.format(
+            len(self.deleted)))
+        lines.append('unchanged: {} files'.format(self.n_unchanged))
+        return '\n'.join(lines)
+
+
+def diff(remote, synced, local_paths=None):
+    """
+    compare the remote content to the sync state with a merge-join
+
+    :param remote: iterable of (fs_path, (content, url)) sorted by path
+    :param synced: iterable of the Content objects of the sync state sorted
+     by path, their names are the paths
+    :param local_paths: set of the paths of the files of the local data dir,
+     if None the files are assumed to be there
+    :return: SyncPlan
+    """
+    plan = SyncPlan()
+    synced = iter(synced)
+    state = next(synced, None)
+
+    for fs_path, (content, url) in remote:
+        while state is not None and state.name < fs_path:
+            plan.deleted.append(state.name)
+            state = next(synced, None)
+
+        if state is None or state.name != fs_path:
+            plan.new.append((fs_path, url, content))
+            continue
+
+        if state.mtime != content.mtime:
+            plan.modified.append((fs_path, url, content))
+        elif local_paths is not None and fs_path not in local_paths:
+            plan.missing.append((fs_path, url, content))
+        else:
+            plan.n_unchanged += 1
+        state = next(synced, None)
+
+    while state is not None:
+        plan.deleted.append(state.name)
+        state = next(synced, None)
+
+    return plan
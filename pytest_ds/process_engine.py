@@ -0,0 +1,148 @@
+"""
+Multi-process sync engine.
+
+The thread engine runs the downloads, the hashing of the downloaded data and
+the bookkeeping in a single process, whose cores are serialized by the GIL.
+Here the downloads (and the digests computed along with them) run in a pool
+of worker processes, each one with its own pool of http connections. The
+outcome of each download (status, digests, bytes) is sent back to the
+parent process over the result pipe of the pool, the parent alone updates
+the sync state and the summary so the workers share no lock.
+"""
+from __future__ import print_function
+import os
+import time
+import multiprocessing
+
+from pytest_ds.download import Download, parse_checksums, format_checksums
+from pytest_ds.transport import Transport
+from pytest_ds.state import STATE_BATCH_SIZE
+from pytest_ds.utils import safe_makedirs
+
+
+_transport = None
+"""the Transport of the worker process"""
+
+
+def _init_worker(transport_options):
+    """create the pool of http connections of a worker process"""
+    global _transport
+    _transport = Transport(**transport_options)
+
+
+def download_item(args):
+    """
+    download a file in a worker process, a failed download is retried after
+    a delay
+
+    :param args: the tuple (fs_path, url, local_abs_path, options, delays)
+     where options are the keyword arguments of Download and delays the
+     delays before the retries
+    :return: (fs_path, success, checksums, number of bytes transferred)
+    """
+    fs_path, url, local_abs_path, options, delays = args
+    safe_makedirs(os.path.dirname(local_abs_path))
+
+    transferred = 0
+    for attempt in range(len(delays) + 1):
+        if attempt > 0:
+            print('retrying {} in {:.0f}s'.format(fs_path, delays[attempt - 1]))
+            time.sleep(delays[attempt - 1])
+        download = Download(url, local_abs_path, session=_transport,
+                            **options)
+        success = download.run()
+        transferred += download.transferred
+        if success:
+            return fs_path, True, download.checksums, transferred
+    return fs_path, False, {}, transferred
+
+
+class ProcessSyncEngine(object):
+    """
+    Sync the transfers of a plan with a pool of worker processes.
+    """
+    def __init__(self, query, plan, n_processes=None, policy=None):
+        """
+        constructor
+
+        :param query: the Query object whose content is synced
+        :param plan: the SyncPlan whose transfers are executed
+        :param int n_processes: the number of worker processes, by default
+         the number of cores
+        :param str policy: the scheduling policy of the downloads
+        """
+        self.query = query
+        """the Query object whose content is synced"""
+
+        self.plan = plan
+        """the SyncPlan whose transfers are executed"""
+
+        self.n_processes = n_processes
+        """the number of worker processes"""
+
+        self.policy = policy
+        """the scheduling policy of the downloads"""
+
+        self.transferred = 0
+        """the number of bytes downloaded by the workers"""
+
+    def _arguments(self, items, contents):
+        """generate the arguments of download_item for the scheduled items
+        and keep the content objects of the files in 'contents'"""
+        query = self.query
+        local_data_dir = os.path.expanduser(
+            query.config.get('LocalStorage', 'datadir'))
+        delays = [query.retry_delay(attempt)
+                  for attempt in range(1, query._retries + 1)]
+
+        for _, fs_path, url, content in items:
+            local_abs_path = os.path.join(local_data_dir, fs_path)
+            if content.type == 'dir':
+                safe_makedirs(local_abs_path)
+                continue
+            contents[fs_path] = content
+            options = dict(query.download_options,
+                           etag=content.etag,
+                           mtime=content.mtime,
+                           size=content.size,
+                           checksum=content.checksum)
+            yield fs_path, url, local_abs_path, options, delays
+
+    def run(self):
+        """sync the transfers of the plan, return when all of them are
+        done"""
+        query = self.query
+        items = query.scheduled_items(self.plan, self.policy)
+        query.make_parent_dirs(fs_path for _, fs_path, _, _ in items)
+
+        transport_options = dict(pool_size=query.transport.pool_size,
+                                 max_retries=query.transport.max_retries,
+                                 keep_alive=query.transport.keep_alive)
+        contents = dict()
+        synced = []
+
+        pool = multiprocessing.Pool(self.n_processes, _init_worker,
+                                    (transport_options,))
+        try:
+            # chunksize=1 keeps the order of the schedule
+            results = pool.imap_unordered(download_item,
+                                          self._arguments(items, contents),
+                                          chunksize=1)
+            for fs_path, success, checksums, transferred in results:
+                content = contents.pop(fs_path)
+                self.transferred += transferred
+                if success:
+                    # the digests computed by the worker along with the ones
+                    # published by the server
+                    merged = parse_checksums(content.checksum)
+                    merged.update(checksums)
+                    content.checksum = format_checksums(merged)
+                query._record_download(fs_path, content, success,
+                                       synced=synced)
+                if len(synced) >= STATE_BATCH_SIZE:
+                    query.cache.upsert_many(synced)
+                    del synced[:]
+        finally:
+            pool.close()
+            pool.join()
+            query.cache.upsert_many(synced)
@@ -0,0 +1,125 @@
+"""
+Fast scan of the files of a local directory tree.
+
+os.scandir (python >= 3.5, or the scandir package) returns the type of the
+directory entries along with their names, so the tree is walked without a
+stat call per entry to tell the files from the directories. Without it
+os.listdir and os.lstat are used instead.
+
+scan_tree() lists the directories with a pool of threads, the system calls
+release the GIL so the latency of the file system (e.g a network file
+system) is overlapped.
+"""
+import os
+import stat
+import threading
+import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def _scan_dir(abs_dir, stat_dirs=False, stat_files=True):
+    """generate the (name, is_dir, stat_result) of the entries of abs_dir,
+    the stat_result of the directories is None unless stat_dirs is True and
+    the one of the files is None if stat_files is False (and os.scandir is
+    available)"""
+    if scandir is not None:
+        for entry in scandir(abs_dir):
+            if entry.is_dir(follow_symlinks=False):
+                yield (entry.name, True,
+                       entry.stat(follow_symlinks=False) if stat_dirs else None)
+            elif entry.is_file():
+                yield entry.name, False, entry.stat() if stat_files else None
+    else:
+        for name in os.listdir(abs_dir):
+            stat_result = os.lstat(os.path.join(abs_dir, name))
+            if stat.S_ISDIR(stat_result.st_mode):
+                yield name, True, stat_result if stat_dirs else None
+            elif stat.S_ISREG(stat_result.st_mode):
+                yield name, False, stat_result
+            elif stat.S_ISLNK(stat_result.st_mode):
+                try:
+                    stat_result = os.stat(os.path.join(abs_dir, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(stat_result.st_mode):
+                    yield name, False, stat_result
+
+
+def scan_files(root, stat=True):
+    """
+    generate the regular files below root
+
+    :param root: the path of the directory to scan
+    :param bool stat: if False only the paths are needed, the files are not
+     stat'ed (with os.scandir the type of an entry is known from the
+     directory listing) and the stat_result is None
+    :return: generator of (path relative to root, stat_result) pairs
+    """
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = list(_scan_dir(os.path.join(root, rel_dir),
+                                     stat_files=stat))
+        except OSError:
+            continue
+        for name, is_dir, stat_result in entries:
+            rel_path = os.path.join(rel_dir, name)
+            if is_dir:
+                stack.append(rel_path)
+            else:
+                yield rel_path, stat_result
+
+
+def scan_tree(root, n_threads=8):
+    """
+    generate the directories and the regular files below root, the
+    directories are listed by n_threads threads in parallel. A directory is
+    generated before its content, the order is not deterministic otherwise.
+
+    :param root: the path of the directory to scan
+    :param int n_threads: the number of threads that list the directories
+    :return: generator of (path relative to root, is_dir, stat_result)
+    """
+    todo = Queue.Queue()
+    done = Queue.Queue()
+
+    def worker():
+        while True:
+            rel_dir = todo.get()
+            if rel_dir is None:
+                return
+            try:
+                entries = list(_scan_dir(os.path.join(root, rel_dir),
+                                         stat_dirs=True))
+            except OSError:
+                entries = []
+            done.put((rel_dir, entries))
+
+    threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        todo.put('')
+        pending = 1
+        while pending > 0:
+            rel_dir, entries = done.get()
+            pending -= 1
+            for name, is_dir, stat_result in entries:
+                rel_path = os.path.join(rel_dir, name)
+                if is_dir:
+                    todo.put(rel_path)
+                    pending += 1
+                yield rel_path, is_dir, stat_result
+    finally:
+        for _ in threads:
+            todo.put(None)
@@ -0,0 +1,63 @@
+"""
+Size aware ordering of the downloads.
+
+The order in which the files are handed to the download workers matters
+when their sizes are very different: if the largest file is started last the
+sync waits for it on a single connection while the other workers are idle.
+
+supported policies:
+   - 'lpt': longest processing time first, the largest files are downloaded
+     first which minimizes the total duration of the sync.
+   - 'spt': shortest processing time first, the smallest files are
+     downloaded first which maximizes the number of files that are synced
+     early.
+   - 'mixed': the largest and the smallest remaining files alternate, the
+     large files keep the link busy while the small ones complete steadily.
+   - 'path': the files are downloaded in the order of their paths.
+"""
+
+POLICIES = ('lpt', 'spt', 'mixed', 'path')
+"""the names of the scheduling policies"""
+
+
+def _size(item):
+    """the size of the content of an (fs_path, (content, url)) item, 0 if it
+    is unknown"""
+    return item[1][0].size or 0
+
+
+def schedule(items, policy='lpt'):
+    """
+    order download items according to a scheduling policy
+
+    :param items: iterable of (fs_path, (content, url)) items sorted by path
+    :param str policy: one of POLICIES
+    :return: list of (priority, fs_path, url, content) tuples sorted by
+     priority, the priorities are unique integers (lower is first) so the
+     tuples can be put in a Queue.PriorityQueue
+    """
+    if policy not in POLICIES:
+        raise ValueError('unknown scheduling policy {}'.format(policy))
+
+    items = list(items)
+    if policy == 'lpt':
+        # sorted() is stable, items of the same size stay in path order
+        items.sort(key=_size, reverse=True)
+    elif policy == 'spt':
+        items.sort(key=_size)
+    elif policy == 'mixed':
+        items.sort(key=_size, reverse=True)
+        ordered = []
+        lo, hi = 0, len(items) - 1
+        while lo <= hi:
+            ordered.append(items[lo])
+            if lo != hi:
+                ordered.append(items[hi])
+            lo += 1
+            hi -= 1
+        items = ordered
+
+    return [
+        (priority, fs_path, url, content)
+        for priority, (fs_path, (content, url)) in enumerate(items)
+    ]
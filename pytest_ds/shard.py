@@ -0,0 +1,122 @@
+"""
+Partition of the content between the shards of a sync.
+
+Several processes (or nodes) can sync the same content into a shared data
+dir, each one downloading a disjoint slice of the files. The slices are
+computed independently by each shard from the listing of the content, so
+the partition must be deterministic:
+
+   - 'hash': a file belongs to the shard md5(path) mod n_shards, the slice of
+     a file does not depend on the other files.
+   - 'size': the files are packed into the shards largest first, each one
+     into the shard that holds the least bytes so far, which balances the
+     bytes downloaded by each shard. All the shards must see the same
+     listing.
+
+Each shard records the files of its slice in its own state fragment, the
+fragments of all the shards are merged into the sync state with
+Query.merge_state once they are all synced.
+"""
+import re
+import heapq
+import hashlib
+
+from pytest_ds.manifest import select_items
+
+
+SHARD_METHODS = ('hash', 'size')
+"""the names of the partition methods"""
+
+FRAGMENT_SUFFIX = '.shard-{}-of-{}'
+"""the suffix of the path of the state fragment of a shard"""
+
+FRAGMENT_REGEX = re.compile(r'\.shard-(\d+)-of-(\d+)$')
+"""matches the paths of the state fragments, the groups are the index of the
+shard and the number of shards"""
+
+FRAGMENT_META = ('shard', 'shard_method', 'listing')
+"""the meta data that describe the shard of a state fragment"""
+
+
+def parse_shard(value):
+    """
+    parse the specification of a shard
+
+    :param str value: 'i/N' where N is the number of shards and i the index
+     of the shard, 0 <= i < N
+    :return: (i, N)
+    """
+    try:
+        index, n_shards = [int(item) for item in value.split('/')]
+    except ValueError:
+        raise ValueError('invalid shard {}, expected i/N'.format(value))
+    if not 0 <= index < n_shards:
+        raise ValueError('invalid shard {}, the index must be between 0 and '
+                         '{}'.format(value, n_shards - 1))
+    return index, n_shards
+
+
+def hash_shard(fs_path, n_shards):
+    """
+    return the shard of a path with the 'hash' method
+
+    :param fs_path: the path relative to the data dir
+    :param int n_shards: the number of shards
+    :return: int
+    """
+    if isinstance(fs_path, unicode):
+        fs_path = fs_path.encode('utf-8')
+    return int(hashlib.md5(fs_path).hexdigest()[:8], 16) % n_shards
+
+
+def listing_digest(fs_paths):
+    """
+    return a digest of the paths and sizes of a listing, the shards that
+    packed the same listing by size hold disjoint slices of it
+
+    :param dict fs_paths: map of the paths to (content, url), see
+     Query.fs_paths
+    :return: str
+    """
+    digest = hashlib.md5()
+    for fs_path, (content, _) in sorted(fs_paths.iteritems(),
+                                        key=lambda item: item[0]):
+        if isinstance(fs_path, unicode):
+            digest.update(fs_path.encode('utf-8'))
+        else:
+            digest.update(fs_path)
+        digest.update(b'\0{}\n'.format(content.size or 0))
+    return digest.hexdigest()
+
+
+def select_shard(fs_paths, index, n_shards, method='hash'):
+    """
+    return the items of a shard
+
+    :param dict fs_paths: map of the paths to (content, url), see
+     Query.fs_paths
+    :param int index: the index of the shard
+    :param int n_shards: the number of shards
+    :param str method: one of SHARD_METHODS
+    :return: the subset of fs_paths, of the same kind
+    """
+    if method not in SHARD_METHODS:
+        raise ValueError('unknown shard method {}'.format(method))
+
+    if method == 'hash':
+        return select_items(
+            fs_paths,
+            lambda fs_path, item: hash_shard(fs_path, n_shards) == index)
+
+    # ties are broken by path so that all the shards pack the same way
+    ordered = sorted((-(content.size or 0), fs_path)
+                     for fs_path, (content, _) in fs_paths.iteritems())
+    loads = [(0, shard) for shard in range(n_shards)]
+    selected = set()
+    for negative_size, fs_path in ordered:
+        load, shard = heapq.heappop(loads)
+        if shard == index:
+            selected.add(fs_path)
+        heapq.heappush(loads, (load - negative_size, shard))
+    return select_items(fs_paths,
+                        lambda fs_path, item: fs_path in selected)
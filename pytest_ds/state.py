@@ -0,0 +1,316 @@
+"""
+Indexed on-disk sync state.
+
+The state of the synced content is kept in an sqlite database keyed by the
+path of the content relative to the data dir. Lookups of single paths are
+index point queries and every synced file is committed on its own, so the
+cost of loading and updating the state does not grow with the size of the
+synced tree.
+"""
+import sqlite3
+import threading
+
+from pytest_ds.utils import Content
+
+
+STATE_BATCH_SIZE = 100
+"""the number of synced files a sync worker records in the state at once"""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    fs_path TEXT PRIMARY KEY,
+    type TEXT,
+    mtime INTEGER,
+    etag TEXT,
+    size INTEGER,
+    checksum TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS dirs (
+    fs_path TEXT PRIMARY KEY,
+    etag TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+
+class SyncState(object):
+    """
+    Path indexed store of the mtime, etag, size and checksum of the synced
+    files and of the etags of the synced remote collections.
+
+    A single connection is shared by all the threads and the access to it is
+    serialized by a lock. It is passed directly as the previous listing to
+    WebdavDataSource.ls() (see unchanged and subtree).
+    """
+    def __init__(self, path):
+        """
+        constructor
+
+        :param path: the path to the database file, it is created if it does
+         not exist
+        """
+        self.path = path
+        """the path to the database file"""
+
+        self._lock = threading.Lock()
+        """lock that serializes the access to the connection"""
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        """the connection to the database"""
+
+        self._connection.text_factory = str
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(SCHEMA)
+
+    def __len__(self):
+        return self._fetchone('SELECT COUNT(*) FROM files')[0]
+
+    def __contains__(self, fs_path):
+        return self.get(fs_path) is not None
+
+    def empty(self):
+        """return True if no file is recorded in the state"""
+        return self._fetchone('SELECT 1 FROM files LIMIT 1') is None
+
+    def _fetchone(self, query, args=()):
+        with self._lock:
+            return self._connection.execute(query, args).fetchone()
+
+    def _fetchall(self, query, args=()):
+        with self._lock:
+            return self._connection.execute(query, args).fetchall()
+
+    def _execute(self, query, args=(), many=False):
+        """execute a statement in its own transaction"""
+        with self._lock, self._connection:
+            if many:
+                self._connection.executemany(query, args)
+            else:
+                self._connection.execute(query, args)
+
+    @staticmethod
+    def _to_content(row):
+        fs_path, content_type, mtime, etag, size, checksum = row
+        return Content(content_type, fs_path, mtime, etag=etag, size=size,
+                       checksum=checksum)
+
+    @staticmethod
+    def _to_row(fs_path, content):
+        return (fs_path, content.type, content.mtime, content.etag,
+                content.size, content.checksum)
+
+    def get(self, fs_path):
+        """
+        return the Content object of the synced file fs_path
+
+        :param fs_path: the path relative to the data dir
+        :return: Content or None if fs_path is not in the state
+        """
+        row = self._fetchone('SELECT * FROM files WHERE fs_path = ?',
+                             (fs_path,))
+        return None if row is None else self._to_content(row)
+
+    def upsert(self, fs_path, content):
+        """
+        insert or update the state of the file fs_path
+
+        :param fs_path: the path relative to the data dir
+        :param content: the Content object of the file
+        """
+        self._execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                      self._to_row(fs_path, content))
+
+    def upsert_many(self, items):
+        """
+        insert or update the state of many files in one transaction
+
+        :param items: iterable of (fs_path, Content) pairs
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            (self._to_row(fs_path, content) for fs_path, content in items),
+            many=True)
+
+    def delete_many(self, fs_paths):
+        """
+        remove files from the state in one transaction
+
+        :param fs_paths: iterable of paths relative to the data dir
+        """
+        self._execute('DELETE FROM files WHERE fs_path = ?',
+                      ((fs_path,) for fs_path in fs_paths), many=True)
+
+    def contents(self, dirname=''):
+        """
+        return the Content objects of the files below dirname sorted by path
+
+        :param dirname: the path of a dir relative to the data dir, '' for
+         all the files
+        :return: list of Content objects
+        """
+        where, args = self._below(dirname)
+        return [
+            self._to_content(row) for row in
+            self._fetchall(
+                'SELECT * FROM files{} ORDER BY fs_path'.format(where), args)
+        ]
+
+    @staticmethod
+    def _below(dirname):
+        """return the where clause and its arguments that select the paths
+        that are below dirname"""
+        if dirname == '':
+            return '', ()
+        # '0' is the character that follows '/'
+        return ' WHERE fs_path >= ? AND fs_path < ?', (dirname + '/',
+                                                       dirname + '0')
+
+    @property
+    def dir_etags(self):
+        """dict of the etags of the synced remote collections"""
+        return dict(self._fetchall('SELECT fs_path, etag FROM dirs'))
+
+    def set_dir_etags(self, dir_etags):
+        """
+        replace the etags of the synced remote collections
+
+        :param dir_etags: dict that maps the path of the collections to their
+         etags
+        """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM dirs')
+            self._connection.executemany('INSERT INTO dirs VALUES (?, ?)',
+                                         dir_etags.items())
+
+    def unchanged(self, content):
+        """
+        return True if the etag of the collection 'content' is the same as
+        the one of the synced collection
+
+        :param content: a Content object of a collection
+        :return: bool
+        """
+        row = self._fetchone('SELECT etag FROM dirs WHERE fs_path = ?',
+                             (content.name,))
+        return row is not None and row[0] is not None and \
+            row[0] == content.etag
+
+    def subtree(self, dirname):
+        """
+        generate the Content objects of the synced collections and files
+        below dirname
+
+        :param dirname: the path of the collection, '' for the root
+        :return: generator of Content objects
+        """
+        where, args = self._below(dirname)
+        for name, etag in self._fetchall(
+                'SELECT fs_path, etag FROM dirs{}'.format(where), args):
+            yield Content('dir', name, None, etag=etag)
+
+        for content in self.contents(dirname):
+            yield content
+
+    def clear(self):
+        """remove the files and the collections from the state"""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM files')
+            self._connection.execute('DELETE FROM dirs')
+
+    def merge_fragments(self, paths, owns=None, keep_dir_etags=True,
+                        exclude_meta=()):
+        """
+        merge the state fragments written by the shards of a sync into this
+        state. The files of the state are replaced by the files of the
+        fragments. The etag of a collection (and a meta data) is recorded
+        only if all the fragments agree on it, a collection that one of the
+        shards did not sync completely is listed again by the next sync.
+        The state is replaced in a single transaction, it is left unchanged
+        if the merge fails.
+
+        :param paths: the paths of the fragment databases
+        :param owns: function of (the position of a fragment in paths, a
+         path) that returns True if the file belongs to the shard of the
+         fragment, the other files of the fragment are not merged. By default
+         all the files of the fragments are merged.
+        :param bool keep_dir_etags: if False the etags of the collections are
+         removed from the state
+        :param exclude_meta: the keys of the meta data of the fragments that
+         are not merged
+        :return: the number of files merged
+        """
+        n_files = 0
+        dir_etags = None
+        meta = None
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM files')
+            for position, path in enumerate(paths):
+                fragment = SyncState(path)
+                try:
+                    rows = fragment._fetchall('SELECT * FROM files')
+                    fragment_dirs = set(fragment._fetchall(
+                        'SELECT fs_path, etag FROM dirs'))
+                    fragment_meta = set(fragment._fetchall(
+                        'SELECT key, value FROM meta'))
+                finally:
+                    fragment.close()
+
+                if owns is not None:
+                    rows = [row for row in rows if owns(position, row[0])]
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                    rows)
+                n_files += len(rows)
+                dir_etags = fragment_dirs if dir_etags is None else \
+                    dir_etags & fragment_dirs
+                meta = fragment_meta if meta is None else \
+                    meta & fragment_meta
+
+            if dir_etags is not None:
+                self._connection.execute('DELETE FROM dirs')
+                if keep_dir_etags:
+                    self._connection.executemany(
+                        'INSERT INTO dirs VALUES (?, ?)', dir_etags)
+                self._connection.execute('DELETE FROM meta')
+                self._connection.executemany(
+                    'INSERT INTO meta VALUES (?, ?)',
+                    [(key, value) for key, value in meta
+                     if key not in exclude_meta])
+        return n_files
+
+    def get_meta(self, key, default=None):
+        """
+        return the value of the key 'key' in the meta data of the state
+
+        :param key: the name of the meta data
+        :param default: the value returned if key is not set
+        :return: str
+        """
+        row = self._fetchone('SELECT value FROM meta WHERE key = ?', (key,))
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        """
+        set the value of the key 'key' in the meta data of the state
+
+        :param key: the name of the meta data
+        :param value: the value, None removes the key
+        """
+        if value is None:
+            self._execute('DELETE FROM meta WHERE key = ?', (key,))
+        else:
+            self._execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                          (key, value))
+
+    def close(self):
+        """close the connection to the database"""
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,111 @@
+"""
+Pooled keep-alive http connections shared by the listing and the download
+workers.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Transport(object):
+    """
+    Thread safe pool of keep-alive http connections.
+
+    Each thread gets its own requests.Session (sessions are not meant to be
+    shared between threads) but all the sessions are mounted on the same
+    http adapter, i.e they share the same urllib3 connection pool. A
+    connection is thus re-used by the next request of any thread once it is
+    released and the tcp/tls handshake is paid once per connection instead
+    of once per request. The pool does not block, pool_size bounds the
+    number of idle connections that are kept open, not the number of open
+    connections.
+    """
+    def __init__(self, pool_size=10, max_retries=0, keep_alive=True):
+        """
+        constructor
+
+        :param int pool_size: the maximum number of connections kept open per
+         host. When all of them are in use extra connections are opened but
+         they are closed once released (waiting for a free connection could
+         deadlock segmented downloads that need several connections).
+        :param int max_retries: the number of times failed connections are
+         retried
+        :param bool keep_alive: if False the connections are closed after each
+         request
+        """
+        self.pool_size = pool_size
+        """the maximum number of connections per host"""
+
+        self.keep_alive = keep_alive
+        """if False, connections are not re-used"""
+
+        self.max_retries = max_retries
+        """the number of times failed connections are retried"""
+
+        self._adapter = HTTPAdapter(pool_connections=pool_size,
+                                    pool_maxsize=pool_size,
+                                    pool_block=False,
+                                    max_retries=max_retries)
+        """the adapter that holds the connection pool"""
+
+        self._local = threading.local()
+        """per thread storage of the sessions"""
+
+    @staticmethod
+    def from_config(config):
+        """
+        create a Transport object from the [Download] section of the
+        configuration. The recognized options are 'pool_size' (defaults to
+        'threads'), 'max_retries' and 'keep_alive'.
+
+        :param config: the ConfigParser object, may be None
+        :return: Transport
+        """
+        kwargs = dict()
+        if config is not None and config.has_section('Download'):
+            if config.has_option('Download', 'pool_size'):
+                kwargs['pool_size'] = config.getint('Download', 'pool_size')
+            elif config.has_option('Download', 'threads'):
+                kwargs['pool_size'] = config.getint('Download', 'threads')
+            if config.has_option('Download', 'max_retries'):
+                kwargs['max_retries'] = config.getint(
+                    'Download', 'max_retries')
+            if config.has_option('Download', 'keep_alive'):
+                kwargs['keep_alive'] = config.getboolean(
+                    'Download', 'keep_alive')
+        return Transport(**kwargs)
+
+    @property
+    def session(self):
+        """the session of the calling thread"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        send a request through the connection pool, the arguments are the
+        same as those of requests.request
+
+        :return: requests.Response
+        """
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """
+        send a GET request through the connection pool
+
+        :return: requests.Response
+        """
+        return self.request('GET', url, **kwargs)
+
+    def close(self):
+        """close all the pooled connections"""
+        self._adapter.close()
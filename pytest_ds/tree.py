@@ -4,9 +4,11 @@ supported:
    - if a file is modified on remote it is synced.
    - if a file does not exist on local it is synced from remote.
    - if cache file is missing but the data dir has the same content as the
-      remtoe everything needs to be synced again.
-     .. todo:: maybe used md5 sums in this case to avoid re-dwon
+      remtoe everything needs to be synced again, unless the state is
+      rebuilt from the data dir first with Query.reindex().
    - empty dirctories on remote are not created on local
+   - the remote collections whose etag did not change since the last sync
+     are not listed again, the listing in the cache is used instead.
 
 # not supported
    - .. todo:: if a file is deleted on remote, it should be deleted also locally
@@ -19,14 +21,44 @@ import stat
 import cPickle as pickle
 import ConfigParser
 import threading
-import re
+import Queue
+import hashlib
+import time
 
-from pytest_ds.utils import (
-    ElementsFinder, download_file, download_file_to_buffer, Content,
-    sort_dict_by_key)
+from pytest_ds.utils import ElementsFinder, Content, safe_makedirs
+from pytest_ds.download import (
+    Download,
+    parse_checksums,
+    format_checksums,
+    TIMEOUT)
 
 from pytest_ds.data_sources.owncloud import WebdavDataSource
-
+from pytest_ds.state import SyncState, STATE_BATCH_SIZE
+from pytest_ds.manifest import Manifest, ManifestPaths, select_items
+from pytest_ds.transport import Transport
+from pytest_ds.asyncio_engine import AsyncioSyncEngine
+from pytest_ds.process_engine import ProcessSyncEngine
+from pytest_ds.verify import verify as verify_files, hash_file
+from pytest_ds.scan import scan_files
+from pytest_ds.scheduler import schedule
+from pytest_ds.concurrency import AIMDController
+from pytest_ds.hedge import Hedger, HEDGE_SUFFIX
+from pytest_ds.path_filter import PathFilter
+from pytest_ds.index import fetch_index, parse_index_line
+from pytest_ds.plan import diff, CHANGE_TYPES
+from pytest_ds.shard import (
+    parse_shard,
+    hash_shard,
+    select_shard,
+    listing_digest,
+    FRAGMENT_SUFFIX,
+    FRAGMENT_REGEX,
+    FRAGMENT_META)
+
+
+HEDGE_POLL_INTERVAL = 0.2
+"""the delay between two looks for stragglers (or for a retry that is due)
+of an idle sync worker"""
 
 class Query(object):
     """
@@ -41,7 +73,8 @@ class Query(object):
                  index_url_enabled=False,
                  index_webdav_enabled=False,
                  setup_cache=True,
-                 config=None):
+                 config=None,
+                 shard=None):
         """
         constructor
 
@@ -56,6 +89,9 @@ class Query(object):
          of the webdav server is fetched. if False content info from the webdav
          server is disabled even if it is enabled in the config file.
         :param setup_cache: if True read the cache from disk
+        :param str shard: 'i/N' to sync only the i-th of N disjoint slices of
+         the content (0 <= i < N), see shard.select_shard. The synced files
+         are recorded in a state fragment of the shard.
         """
         self._url = root_url
         """.. todo:: """
@@ -88,37 +124,191 @@ class Query(object):
         """condition used for parallel downloads in updating cache"""
 
         self._download_threads = None
-        """number of threads used to download, one thread per file"""
+        """number of threads used to download, one thread per file, 10 by
+        default as in sync()"""
+
+        self._sync_engine = 'thread'
+        """the default engine of self.sync()"""
+
+        self._max_in_flight = None
+        """the maximum number of simultaneous downloads of the asyncio
+        engine"""
+
+        self._schedule = 'lpt'
+        """the policy that orders the downloads, see scheduler.POLICIES"""
+
+        self._adaptive = False
+        """if True the number of simultaneous downloads is adjusted during
+        the sync"""
+
+        self._min_threads = 1
+        """the lower bound of the adaptive number of downloads"""
+
+        self._max_threads = None
+        """the upper bound of the adaptive number of downloads"""
+
+        self._retries = 3
+        """the number of times a failed download is retried during a sync"""
+
+        self._backoff = 1.0
+        """the delay before the first retry of a download in seconds, it
+        doubles at each retry"""
+
+        self._max_backoff = 60.0
+        """the upper bound of the delay before a retry"""
+
+        self._hedge = True
+        """if True the stragglers at the tail of a sync are hedged"""
+
+        self._hedge_options = dict()
+        """keyword arguments passed to Hedger"""
+
+        self.download_options = dict()
+        """keyword arguments passed to Download, set from the
+        [Download] section of the configuration"""
+
+        self.summary = dict(new=[], modified=[], missing=[], failed=[])
+        """dict that contains the list of new and modified files, of the
+        files missing from the local data dir and the paths of the files that
+        failed to sync"""
+
+        self.sync_plan = None
+        """the SyncPlan of the last sync"""
+
+        self.dir_etags = {}
+        """the etags of the remote collections (dirs) of the content"""
+
+        self.include_regex = None
+        """the key of the filter of the content (the value of
+        'include_regex' if no other criterion is set), see PathFilter.key"""
+
+        self.path_filter = None
+        """the PathFilter that selects the content"""
+
+        self.index_validators = None
+        """the 'etag' and 'last_modified' of the index file that was read,
+        they are recorded in the sync state once it is synced"""
+
+        self.transport = None
+        """the pool of http connections shared by all the requests"""
 
-        self.summary = dict(new=[], modified=[])
-        """dict that contains the list of new and modified files"""
+        self.shard = parse_shard(shard) if shard is not None else None
+        """the (index, number of shards) of the shard that is synced"""
+
+        self.listing_digest = None
+        """the digest of the listing the shard was selected from, see
+        shard.listing_digest"""
+
+        self._shard_method = 'hash'
+        """the partition of the content between the shards, see
+        shard.SHARD_METHODS"""
 
         if self.config_path is not None:
             assert os.path.isfile(self.config_path)
             self.config = self.setup_configuration(self.config_path)
             self._check_set_attributes_from_config()
 
-        if index_webdav_enabled:
+        self.transport = Transport.from_config(self.config)
+
+        if setup_cache:
+            self.setup_cache()
+
+        if index_url_enabled or index_webdav_enabled:
+            self.path_filter = PathFilter.from_config(self.config)
+            if self.path_filter is not None:
+                self.include_regex = self.path_filter.key()
+
+        if index_url_enabled and self.config.has_option('RemoteDataSource',
+                                                        'index_file'):
+            contents = self._setup_content_from_index_url()
+            if contents is None:
+                # nothing changed since the last complete sync
+                self.fs_paths = ManifestPaths(
+                    Manifest.from_contents(self.cache.contents()),
+                    self._get_download_url)
+            else:
+                self.contents = contents
+                self.hash()
+
+            if self.path_filter is not None:
+                self.fs_paths = self.filter_paths(self.path_filter)
+            if self.shard is not None:
+                self._select_shard()
+            print('found {} files in the index'.format(len(self.fs_paths)))
+
+            # the files are held once, in the manifest
+            self.contents = self.fs_paths.manifest
+
+        elif index_webdav_enabled:
             webdav_content = WebdavDataSource(
                 self._url,
                 self.config.get('RemoteDataSource', 'webdav_token'),
                 self.config.get('RemoteDataSource', 'owncloud_dirname'),
+                session=self.transport
             )
 
-            self.fs_paths = webdav_content.ls_url(recursive=True)
-
-            if self.config.has_option('RemoteDataSource', 'include_regex'):
-                self.fs_paths = self.filter_paths(
-                    self.config.get('RemoteDataSource', 'include_regex')
-                )
+            crawl_threads = None
+            if self.config.has_option('RemoteDataSource', 'crawl_threads'):
+                crawl_threads = self.config.getint(
+                    'RemoteDataSource', 'crawl_threads')
+
+            skip = None
+            if self.path_filter is not None:
+                skip = lambda content: not self.path_filter.may_contain(
+                    content.name)
+
+            # the previous listing can be re-used only if it was filtered
+            # in the same way. The fragment of a shard holds only its own
+            # files while packing by size needs the whole listing.
+            known = None
+            if (self.cache is not None and
+                    not (self.shard and self._shard_method == 'size') and
+                    self.cache.get_meta('include_regex') ==
+                    self.include_regex):
+                known = self.cache
+
+            self.fs_paths = webdav_content.ls_url(
+                recursive=True,
+                crawl_threads=crawl_threads,
+                known=known,
+                skip=skip)
+            self.dir_etags = webdav_content.dir_etags
+
+            if self.path_filter is not None:
+                self.fs_paths = self.filter_paths(self.path_filter)
+
+            if self.shard is not None:
+                self._select_shard()
 
             self.contents = [
                 content
-                for _, (content, _) in self.fs_paths.items()
+                for _, (content, _) in self.sorted_fs_paths()
             ]
 
-        if setup_cache:
-            self.setup_cache()
+    def _select_shard(self):
+        """
+        keep only the files of the shard in self.fs_paths. A new state
+        fragment starts from the files of the shard recorded in the sync
+        state of the whole content, the files of the other shards are not
+        copied.
+        """
+        self.listing_digest = listing_digest(self.fs_paths)
+        self.fs_paths = select_shard(self.fs_paths, *self.shard,
+                                     method=self._shard_method)
+
+        base_path = self.get_state_path(fragment=False)
+        if (self.cache is None or not self.cache.empty() or
+                not os.path.isfile(base_path)):
+            return
+        print('copying the files of the shard from the sync state {}'.format(
+            base_path))
+        base = SyncState(base_path)
+        try:
+            self.cache.upsert_many(
+                (content.name, content) for content in base.contents()
+                if content.name in self.fs_paths)
+        finally:
+            base.close()
 
     def absolute_fs_paths(self):
         """
@@ -130,10 +320,26 @@ class Query(object):
         """
         local_data_dir = expanduser(self.config.get('LocalStorage', 'datadir'))
 
-        return [os.path.join(local_data_dir, fpath) for fpath in self.fs_paths]
+        return [os.path.join(local_data_dir, fpath)
+                for fpath in sorted(self.fs_paths)]
 
+    def sorted_fs_paths(self):
+        """
+        generate the items of self.fs_paths sorted by path. self.fs_paths is
+        either a plain dict, it is sorted only when the order matters, or a
+        ManifestPaths that is already sorted.
 
-    def update_summary(self, change_type, item_name):
+        :return: generator of (fs_path, (content, download_url))
+        """
+        if isinstance(self.fs_paths, ManifestPaths):
+            for item in self.fs_paths.iteritems():
+                yield item
+            return
+        for fs_path in sorted(self.fs_paths):
+            yield fs_path, self.fs_paths[fs_path]
+
+
+    def update_summary(self, change_type, item_name, summary=None):
         """
         insert an item into the attribute self.summary
 
@@ -142,29 +348,42 @@ class Query(object):
         "new" with the item "item_name".
 
         :param str change_type: one of the keys of self.summary, e.g. either
-         'modified' or 'new'
+         'modified', 'new', 'missing' or 'failed'
         :param str item_name: the name of the item, e.g. a path or a relative
          path
+        :param dict summary: the summary of a single sync worker that is
+         merged into self.summary later, it is updated without locking
         """
+        if summary is not None:
+            summary[change_type].append(item_name)
+            return
         self._condition.acquire()
         assert change_type in self.summary.keys()
         self.summary[change_type].append(item_name)
         self._condition.release()
 
-    def filter_paths(self, regex_config):
-        """given the value of the 'include_regex' key of the configuration file
-        keep only the paths that match the regex 
-        
-        :param regex_config: value of 'include_regex'
-        :return: self.fs_paths without the items that do not match the regex'es
+    def merge_summary(self, summary):
         """
-        retval = dict()
-        for expr_str in regex_config.split('\n'):
-            regex = re.compile(expr_str)
-            for fs_path in self.fs_paths:
-                if regex.match(fs_path):
-                    retval[fs_path] = self.fs_paths[fs_path]
-        return sort_dict_by_key(retval)
+        merge the summary of a sync worker into self.summary
+
+        :param dict summary: a dict with the same keys as self.summary
+        """
+        self._condition.acquire()
+        for change_type, items in summary.items():
+            self.summary[change_type].extend(items)
+        self._condition.release()
+
+    def filter_paths(self, path_filter):
+        """keep only the paths selected by a PathFilter, the paths are
+        matched in a single pass
+
+        :param path_filter: a PathFilter or the value of 'include_regex'
+        :return: self.fs_paths without the items that are not selected
+        """
+        if not isinstance(path_filter, PathFilter):
+            path_filter = PathFilter(include=path_filter.split('\n'))
+        return select_items(self.fs_paths,
+                            lambda fs_path, item: path_filter(item[0]))
 
     def _check_set_attributes_from_config(self):
         """
@@ -177,7 +396,70 @@ class Query(object):
         if self.config.has_option('Download', 'threads'):
             self._download_threads = int(self.config.get('Download', 'threads'))
         else:
-            self._download_threads = 1
+            self._download_threads = 10
+
+        if self.config.has_option('Download', 'engine'):
+            self._sync_engine = self.config.get('Download', 'engine')
+
+        if self.config.has_option('Download', 'adaptive'):
+            self._adaptive = self.config.getboolean('Download', 'adaptive')
+
+        if self.config.has_option('Download', 'min_threads'):
+            self._min_threads = self.config.getint('Download', 'min_threads')
+
+        if self.config.has_option('Download', 'max_threads'):
+            self._max_threads = self.config.getint('Download', 'max_threads')
+
+        if self.config.has_option('Download', 'schedule'):
+            self._schedule = self.config.get('Download', 'schedule')
+
+        if self.config.has_option('Download', 'max_in_flight'):
+            self._max_in_flight = self.config.getint('Download',
+                                                     'max_in_flight')
+
+        if self.config.has_option('Download', 'shard_method'):
+            self._shard_method = self.config.get('Download', 'shard_method')
+
+        if self.config.has_option('Download', 'hedge'):
+            self._hedge = self.config.getboolean('Download', 'hedge')
+
+        for option, key in [('hedge_factor', 'factor'),
+                            ('hedge_after', 'min_elapsed')]:
+            if self.config.has_option('Download', option):
+                self._hedge_options[key] = self.config.getfloat(
+                    'Download', option)
+
+        if self.config.has_option('Download', 'retries'):
+            self._retries = self.config.getint('Download', 'retries')
+
+        for option in ['backoff', 'max_backoff']:
+            if self.config.has_option('Download', option):
+                setattr(self, '_' + option,
+                        self.config.getfloat('Download', option))
+
+        self.download_options = dict(
+            segments=4,
+            segment_threshold=256 * 1024 ** 2,
+            digests=['md5'],
+            timeout=(10, 60),
+            min_speed=1024,
+            stall_window=60,
+        )
+        if self.config.has_option('Download', 'digests'):
+            self.download_options['digests'] = self.config.get(
+                'Download', 'digests').split()
+        for option in ['segments', 'segment_threshold', 'buffer_size',
+                       'min_speed', 'stall_window']:
+            if self.config.has_option('Download', option):
+                self.download_options[option] = self.config.getint(
+                    'Download', option)
+        if self.download_options['min_speed'] <= 0:
+            self.download_options['min_speed'] = None
+        timeout = list(self.download_options['timeout'])
+        for index, option in enumerate(['connect_timeout', 'read_timeout']):
+            if self.config.has_option('Download', option):
+                timeout[index] = self.config.getfloat('Download', option)
+        self.download_options['timeout'] = tuple(timeout)
 
     @staticmethod
     def setup_configuration(config_path):
@@ -192,68 +474,94 @@ class Query(object):
         """try to obtain the file index from the remote folder through http
         and parse it and return the content tree, the content that would be
         returned by crawling the root_url
+
+        The index is parsed line by line as it is downloaded. It is requested
+        with the validators of the index of the last complete sync (if the
+        content is filtered in the same way), None is returned if it did not
+        change since then.
+
+        :return: list of Content objects or None
         """
         index_file_url = expanduser(
             self.config.get('RemoteDataSource', 'index_file'))
 
-        fsinfo = download_file_to_buffer(
+        # the state fragment of a shard does not hold the whole content
+        etag = last_modified = None
+        if (self.cache is not None and self.shard is None and
+                self.cache.get_meta('include_regex') == self.include_regex):
+            etag = self.cache.get_meta('index_etag')
+            last_modified = self.cache.get_meta('index_last_modified')
+
+        lines, self.index_validators = fetch_index(
             self.get_owncloud_download_url_from_fs_path(
                 self._url,
-                index_file_url))
-
-        assert fsinfo is not None
-
-        flat_content = []
-        for line in filter(lambda x: x != '', fsinfo.split('\n')):
-            ftype, size, mtime, fs_path = filter(lambda x: not x == '',
-                                                 line.split('##'))
-            ftype = ftype.replace('directory', 'dir')
-            ftype = ftype.replace('regular file', 'file')
-            flat_content.append(Content(ftype, fs_path, mtime))
-            # print(ftype, mtime, fs_path)
+                index_file_url),
+            session=self.transport,
+            etag=etag,
+            last_modified=last_modified,
+            timeout=self.download_options.get('timeout', TIMEOUT))
 
-        print('found {} items in the index:\n\t'.format(
-            len(flat_content), index_file_url))
+        if lines is None:
+            print('the index did not change:\n\t{}'.format(index_file_url))
+            return None
 
-        return self.crawl_fs_info(flat_content)
+        return self.crawl_fs_info(parse_index_line(line) for line in lines)
 
     def crawl_fs_info(self, flat_content):
         """Generate the contents tree by parsing the content of a file that
         is dumped by the command:
         
               ~> find test_data -exec stat --format="##%F##%s##%Y##%n##" '{}' \;
-        """
-        contents = []
-
-        # add contents that is at the current depth
-        contents.extend(
-            filter(
-                lambda x: os.path.dirname(x.name) == '',
-                flat_content))
 
-        # handle the remaining flat contents
-        flat_content_remaining = filter(
-            lambda x: os.path.dirname(x.name) != '',
-            flat_content)
+        The tree is built in a single pass over the flat content with a dict
+        that maps the path of each dir to the list of its children. The names
+        of the Content objects of the tree are base names, the objects of
+        flat_content are not modified. The dirs whose lines are missing, or
+        come after the lines of their content, are created on the fly.
 
-        if flat_content_remaining:
-            for content in contents:
-                if content.type == 'dir':
-                    dirname = content.name
-
-                    this_dir_content_flat = []
+        :param flat_content: iterable of Content objects whose names are
+         paths
+        :return: list of the Content objects at the top level
+        """
+        contents = []
 
-                    # remove dirname from the prefix on the content of dirname
-                    for _content in flat_content_remaining:
-                        if _content.name.startswith(dirname + '/'):
-                            _content.name = _content.name.split(
-                                dirname + '/')[-1]
-                            this_dir_content_flat.append(_content)
+        children = {'': contents}
+        """map of the paths of the dirs to the lists of their children"""
+
+        dir_nodes = {}
+        """map of the paths of the dirs to their Content objects"""
+
+        def children_of(dirname):
+            retval = children.get(dirname)
+            if retval is None:
+                # the dir was not seen yet
+                parent, basename = os.path.split(dirname)
+                node = Content('dir', basename, None)
+                node.subdir = retval = children[dirname] = []
+                dir_nodes[dirname] = node
+                children_of(parent).append(node)
+            return retval
+
+        for content in flat_content:
+            dirname, basename = os.path.split(content.name)
+
+            if content.type == 'dir' and content.name in dir_nodes:
+                node = dir_nodes[content.name]
+                if node.mtime is None:
+                    # created on the fly for the content of the dir
+                    node.mtime = content.mtime
+                    node.etag = content.etag
+                continue
+
+            node = Content(content.type, basename, content.mtime,
+                           etag=content.etag,
+                           size=content.size,
+                           checksum=content.checksum)
+            if content.type == 'dir':
+                node.subdir = children[content.name] = []
+                dir_nodes[content.name] = node
 
-                    content.subdir = self.crawl_fs_info(this_dir_content_flat)
-        else:
-            # no subdir content to be processed
-            pass
+            children_of(dirname).append(node)
 
         return contents
 
@@ -262,7 +570,7 @@ class Query(object):
         list all the paths
         """
         print('{} paths {}'.format('-'*50, '-'*50))
-        for fs_path in self.fs_paths:
+        for fs_path in sorted(self.fs_paths):
             print(fs_path)
         print('{} end paths {}'.format('-'*50, '-'*50))
 
@@ -272,7 +580,7 @@ class Query(object):
         """
         print('{} urls {}'.format('-'*50, '-'*50))
         print('found {} items'.format(len(self.fs_paths)))
-        for fs_path, (_, download_url) in self.fs_paths.items():
+        for fs_path, (_, download_url) in self.sorted_fs_paths():
             print(fs_path, download_url)
         print('{} end urls {}'.format('-'*50, '-'*50))
 
@@ -306,27 +614,26 @@ class Query(object):
 
     def _get_file_system_paths(self, contents):
         """
-        recursively traverse the content tree and generate the path of the
-        content.
+        traverse the content tree depth first and generate the path of the
+        files. The tree is walked with an explicit stack of (path prefix,
+        iterator) pairs so each path is built once.
+
+        :return: list of (content, path) pairs
         """
         conents_paths = []
-        for content in contents:
-            if content.subdir:
-                self.depth += 1
-
-                def foo(x):
-                    _content, path = x
-                    return _content, content.name + '/' + path
-
-                conents_paths.extend(
-                    map(foo,
-                        self._get_file_system_paths(content.subdir))
-                )
+        stack = [('', iter(contents))]
+        while stack:
+            prefix, iterator = stack[-1]
+            for content in iterator:
+                if content.subdir:
+                    stack.append((prefix + content.name + '/',
+                                  iter(content.subdir)))
+                    break
+                elif not content.type == 'dir':
+                    conents_paths.append((content, prefix + content.name))
             else:
-                if not content.type == 'dir':
-                    conents_paths.append((content, content.name))
+                stack.pop()
 
-        self.depth -= 1
         return conents_paths
 
     @staticmethod
@@ -352,36 +659,168 @@ class Query(object):
         """
         generate the owncloud download urls of all the content.
         """
-        fs_paths = self.get_file_system_paths()
-        download_urls = []
-
-        for content, fs_path in fs_paths:
-            dir_path = os.path.dirname(fs_path)
-            basename = os.path.basename(fs_path)
-
-            download_url = 'download?path={dir_path}&files={fname}'.format(
-                dir_path=dir_path.replace('/', '%2F'),
-                fname=basename
-            )
-            download_urls.append(download_url)
+        return [
+            self._get_download_url(fs_path)
+            for _, fs_path in self.get_file_system_paths()
+        ]
 
-        return map(lambda x: self._url + '/' + x, download_urls)
+    def _get_download_url(self, fs_path):
+        """return the download url of a path relative to the root url"""
+        dir_path, basename = os.path.split(fs_path)
+        return '{}/download?path={}&files={}'.format(
+            self._url,
+            dir_path.replace('/', '%2F'),
+            basename
+        )
 
     def write_cache(self):
         """
-        write the content to a cache pickle file pointed to by "cache" in the
-        configuration file
+        record the etags of the remote collections and the filter of the
+        content in the sync state. The synced files are recorded in the state
+        as soon as they are downloaded. The etags of the collections that
+        contain files that failed to sync are not recorded so that these
+        collections are listed again by the next sync, and neither are the
+        validators of the index file.
+
+        The state is also the previous listing of the next sync, the files
+        of the state that are not in the listing of this sync (deleted on
+        the remote, or dropped from the relisted collections) are removed
+        from it.
+        """
+        if self.sync_plan is not None and self.sync_plan.deleted:
+            self.cache.delete_many(self.sync_plan.deleted)
+
+        failed_dirs = set()
+        for fs_path in self.summary['failed']:
+            dirname = os.path.dirname(fs_path)
+            while dirname != '':
+                failed_dirs.add(dirname)
+                dirname = os.path.dirname(dirname)
+            failed_dirs.add('')
+
+        self.cache.set_dir_etags({
+            dirname: etag for dirname, etag in self.dir_etags.items()
+            if dirname not in failed_dirs
+        })
+        self.cache.set_meta('include_regex', self.include_regex)
+
+        if self.index_validators is not None:
+            # an index whose files did not all sync must be read again
+            validators = self.index_validators
+            if self.summary['failed']:
+                validators = {}
+            self.cache.set_meta('index_etag', validators.get('etag'))
+            self.cache.set_meta('index_last_modified',
+                                validators.get('last_modified'))
+
+        if self.shard is not None:
+            self.cache.set_meta('shard', '{}/{}'.format(*self.shard))
+            self.cache.set_meta('shard_method', self._shard_method)
+            self.cache.set_meta('listing', self.listing_digest)
+        print('updated the sync state:\n\t{}'.format(self.cache.path))
+
+    def get_state_path(self, fragment=True):
+        """
+        return the path of the sync state database. It is the value of
+        "state" in the LocalStorage section of the configuration file if it
+        is set, otherwise the path of "cache" with the .sqlite extension.
+        The state fragment of a shard has the suffix '.shard-i-of-N'.
+
+        :param bool fragment: if False the path of the state of the whole
+         content is returned even if a shard is synced
+        :return: str
+        """
+        if self.config.has_option('LocalStorage', 'state'):
+            state_path = expanduser(self.config.get('LocalStorage', 'state'))
+        else:
+            cache_path = expanduser(self.config.get('LocalStorage', 'cache'))
+            state_path = os.path.splitext(cache_path)[0] + '.sqlite'
+        if fragment and self.shard is not None:
+            state_path += FRAGMENT_SUFFIX.format(*self.shard)
+        return state_path
+
+    def merge_state(self):
+        """
+        merge the state fragments of the shards of a sync into the sync
+        state, the fragments are removed. The fragments of all the shards
+        0..N-1 of the sync must be there and each one must record a complete
+        sync of its shard.
+
+        Only the files of its shard are taken from a fragment. With the
+        'hash' method the shard of each file is computed again. Packing by
+        size needs the whole listing, the fragment of a shard holds only the
+        files of its slice (see _select_shard) and all the shards must have
+        synced the same listing. The etags of the collections are dropped if
+        the shards did not list the same content.
+
+        :return: dict with the 'fragments' merged and the number of 'files'
         """
-        cache_path = self.config.get('LocalStorage', 'cache')
-        with open(os.path.expanduser(cache_path), 'wb') as fobj:
-            pickle.dump(self.contents, fobj)
-        print('wrote cache file:\n\t{}'.format(fobj.name))
+        state_path = self.get_state_path(fragment=False)
+        dirname, basename = os.path.split(state_path)
+        shards = {}
+        for name in os.listdir(dirname):
+            if not name.startswith(basename):
+                continue
+            match = FRAGMENT_REGEX.match(name[len(basename):])
+            if match is not None:
+                shard = tuple(int(group) for group in match.groups())
+                shards[shard] = os.path.join(dirname, name)
+
+        all_n_shards = set(n_shards for _, n_shards in shards)
+        if len(all_n_shards) != 1:
+            raise ValueError(
+                'expected the state fragments of the shards of one sync, '
+                'found {}'.format(sorted(shards.values())))
+        n_shards = all_n_shards.pop()
+        missing = [index for index in range(n_shards)
+                   if (index, n_shards) not in shards]
+        if missing:
+            raise ValueError('the state fragments of the shards {} of {} are '
+                             'missing'.format(missing, n_shards))
+        fragments = [shards[(index, n_shards)] for index in range(n_shards)]
+
+        fragment_meta = []
+        for fragment in fragments:
+            state = SyncState(fragment)
+            try:
+                fragment_meta.append({key: state.get_meta(key)
+                                      for key in FRAGMENT_META})
+            finally:
+                state.close()
+            if fragment_meta[-1]['shard'] is None:
+                raise ValueError('the shard of {} did not complete its sync'
+                                 .format(fragment))
+
+        methods = set(meta['shard_method'] for meta in fragment_meta)
+        if len(methods) != 1:
+            raise ValueError('the shards were selected with different '
+                             'methods {}'.format(sorted(methods)))
+        method = methods.pop()
+        same_listing = len(set(meta['listing']
+                               for meta in fragment_meta)) == 1
+        if method == 'size' and not same_listing:
+            raise ValueError('the shards packed by size did not sync the '
+                             'same listing, sync all the shards again')
+
+        owns = None
+        if method == 'hash':
+            owns = lambda index, fs_path: hash_shard(fs_path,
+                                                     n_shards) == index
+
+        n_files = self.cache.merge_fragments(fragments, owns=owns,
+                                             keep_dir_etags=same_listing,
+                                             exclude_meta=FRAGMENT_META)
+        for fragment in fragments:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(fragment + suffix):
+                    os.remove(fragment + suffix)
+        return dict(fragments=fragments, files=n_files)
 
     @staticmethod
     def from_cache(config):
         """
-        read the content to a cache pickle file pointed to by "cache" variable
-        in the configuration file
+        read the content of a cache pickle file, written by older versions,
+        pointed to by "cache" variable in the configuration file
 
         :return: Query object
         """
@@ -394,120 +833,237 @@ class Query(object):
 
         if os.path.isfile(cache_path):
             print('loading cache from {}'.format(cache_path))
-            contents = pickle.load(open(cache_path, 'rb'))
+            cache = pickle.load(open(cache_path, 'rb'))
+            # caches written by older versions hold only the contents
+            if not isinstance(cache, dict):
+                cache = dict(contents=cache)
         else:
             print('cache file not found:\n\t{}'.format(cache_path))
-            contents = []
+            cache = dict(contents=[])
 
-        retval.contents = contents
+        retval.contents = cache['contents']
+        retval.dir_etags = cache.get('dir_etags', {})
+        retval.include_regex = cache.get('include_regex')
         retval.hash()
         return retval
 
     def setup_cache(self):
         """
-        Set the cache attribute to the content of the cache pickle file and
-        set up the cache object by loading the cache info from disk.
+        Set the cache attribute to the sync state stored on disk. If the
+        state is empty and a cache pickle file written by older versions
+        exists its content is imported into the state.
         """
-        print('setting up the cache object')
-        self.cache = Query.from_cache(self.config_path)
+        state_path = self.get_state_path()
+        print('opening the sync state {}'.format(state_path))
+        if not os.path.isdir(os.path.dirname(state_path)):
+            os.makedirs(os.path.dirname(state_path))
+        self.cache = SyncState(state_path)
+
+        if self.shard is not None:
+            # the fragment is filled once the shard is selected
+            return
+
+        cache_path = expanduser(self.config.get('LocalStorage', 'cache'))
+        if (self.cache.empty() and cache_path != state_path and
+                os.path.isfile(cache_path)):
+            print('importing the cache file {}'.format(cache_path))
+            legacy = Query.from_cache(self.config_path)
+            self.cache.upsert_many(
+                (fs_path, content)
+                for fs_path, (content, _) in legacy.fs_paths.items()
+            )
+            self.cache.set_dir_etags(legacy.dir_etags)
+            self.cache.set_meta('include_regex', legacy.include_regex)
 
     def hash(self):
         """
-        set the fs_path dictionary by hashing all the fs_path and mapping them
-        to the content and the url.
+        set self.fs_paths, the map of the paths of the files of the content
+        tree to the content and the url. The files are kept in a Manifest
+        sorted by path, see manifest.ManifestPaths.
         """
-        self.fs_paths = {
-            path: (content, url) for
-            (content, path), url in zip(self.get_file_system_paths(),
-                                        self.get_download_urls())
-        }
+        manifest = Manifest()
+        for content, path in self.get_file_system_paths():
+            manifest.append(content, path)
+        self.fs_paths = ManifestPaths(manifest.sorted(),
+                                      self._get_download_url)
+
+    def _download(self, fs_path, download_url, content, controller=None,
+                  hedger=None):
+        """create the local dir of fs_path (or its parent dir) and download
+        the file
 
-    def _update_local_cache_file(self, fs_path, download_url, content, dry):
-        """syncronize the download_url
-        
         :param fs_path: the path relative to the data dir
         :param download_url: the download url
         :param content: the content object
+        :param controller: the AIMDController the outcome of the download
+         is reported to, if any
+        :param hedger: the Hedger the download is registered with, if any
+        :return: True if the content was synced successfully
         """
         local_data_dir = expanduser(self.config.get('LocalStorage', 'datadir'))
         local_abs_path = os.path.join(local_data_dir, fs_path)
         local_abs_dir = os.path.dirname(local_abs_path)
 
-        def safe_makedirs(dir_path):
-            self._condition.acquire()
-            if not os.path.isdir(dir_path):
-                os.makedirs(dir_path)
-            self._condition.release()
-
         # if content is a directory, create it
-        if not dry:
-            if content.type == 'dir':
-                safe_makedirs(local_abs_path)
-            else:
-                safe_makedirs(local_abs_dir)
-
-                # download and update the cache if the download is successfull
-                if download_file(download_url, local_abs_path):
-                    self._condition.acquire()
-                    self.fs_paths[fs_path] = (content, download_url)
-                    self._condition.release()
+        if content.type == 'dir':
+            safe_makedirs(local_abs_path)
+            return True
+
+        safe_makedirs(local_abs_dir)
+        download = Download(download_url, local_abs_path,
+                            session=self.transport,
+                            etag=content.etag,
+                            mtime=content.mtime,
+                            size=content.size,
+                            checksum=content.checksum,
+                            **self.download_options)
+        race = None
+        if hedger is not None:
+            race = hedger.start(fs_path, download,
+                                (download_url, local_abs_path, content))
+
+        start = time.time()
+        success = download.run()
+        if race is not None:
+            hedger.stop(fs_path, download, success)
+            race.finish(download, success)
+            # a hedged duplicate may have completed first
+            success = race.wait()
+            download = race.winner or download
+        if controller is not None:
+            controller.record((content.size or 0) if success else 0,
+                              time.time() - start,
+                              status_code=download.status_code,
+                              success=success)
+        if not success:
+            return False
+
+        # record the digests computed during the download along with the
+        # ones published by the server
+        checksums = parse_checksums(content.checksum)
+        checksums.update(download.checksums)
+        content.checksum = format_checksums(checksums)
+        return True
+
+    def _start_hedge(self, hedger, controller=None):
+        """
+        start a duplicate download of a straggler in the calling thread.
+        With an AIMDController the duplicate takes one of its slots, no
+        download is hedged while they are all taken.
 
-    def cache_file_is_in_localdir(self, fs_path):
+        :param hedger: the Hedger of the sync
+        :param controller: the AIMDController of the sync, if any
+        :return: True if a download was hedged
         """
-        if the file fs_path exists is local_dir True is returned else false is
-        
-        :return: bool
+        if controller is not None and not controller.try_acquire():
+            return False
+        try:
+            straggler = hedger.straggler()
+            if straggler is None:
+                return False
+            _, race, args = straggler
+            self._hedge_download(race, *args, controller=controller)
+            return True
+        finally:
+            if controller is not None:
+                controller.release()
+
+    def _hedge_download(self, race, download_url, local_abs_path, content,
+                        controller=None):
         """
-        local_data_dir = expanduser(self.config.get('LocalStorage', 'datadir'))
-        local_abs_path = os.path.join(local_data_dir, fs_path)
+        download a straggler again over a fresh connection, the first of the
+        two downloads that completes is kept
 
-        retval = True if os.path.exists(local_abs_path) else False
-        return retval
-
-    def _sync_file(self, fs_path, url, content, dry):
+        :param race: the Race object of the straggler
+        :param download_url: the download url
+        :param local_abs_path: the local path of the file
+        :param content: the content object
+        :param controller: the AIMDController the outcome of the duplicate
+         download is reported to, if any
         """
-        Syncronzie a file at "url" to local fs_path
-
-        the file at "download_url" to local path "fs_path" using
-        metadata from the object "content"
+        download = Download(download_url, local_abs_path,
+                            part_path=local_abs_path + HEDGE_SUFFIX,
+                            etag=content.etag,
+                            mtime=content.mtime,
+                            size=content.size,
+                            checksum=content.checksum,
+                            **self.download_options)
+        if not race.add(download):
+            return
+        print('hedging the slow download of {}'.format(download_url))
+        start = time.time()
+        success = download.run()
+        race.finish(download, success)
+        if controller is not None:
+            # a duplicate cancelled because the other download completed
+            # first did not fail
+            controller.record(download.transferred, time.time() - start,
+                              status_code=download.status_code,
+                              success=success or download.cancelled)
+
+    def _record_download(self, fs_path, content, success, summary=None,
+                         synced=None):
+        """update the cache if the download is successfull, otherwise add
+        fs_path to the failed items of the summary
 
         :param fs_path: the path relative to the data dir
-        :param url: the download url
         :param content: the content object
+        :param success: the return value of self._download
+        :param dict summary: the summary of the sync worker, see
+         update_summary
+        :param list synced: if not None the (fs_path, content) pair is
+         appended to it instead of being recorded in the cache right away
         """
-        if fs_path not in self.cache.fs_paths:
-            # new file no found in cache
-            # download the download_url to fs_path
-            print('file not in local cache: {}\n'.format(fs_path))
-            self._update_local_cache_file(fs_path, url, content, dry)
-            self.update_summary('new', url)
-        elif fs_path in self.cache.fs_paths:
-            # file exists in cache db but has a more recent mtime on remote
-            cache_content, _ = self.cache.fs_paths[fs_path]
-            self.update_summary('modified', url)
-
-            if not self.cache_file_is_in_localdir(fs_path):
-                print('file in local cache but not in '
-                      'local data dir: {}\n'.format(fs_path))
-                self._update_local_cache_file(
-                    fs_path, url, content, dry)
-                return
-
-            if cache_content.mtime != content.mtime:
-                # download the download_url to fs_path
-                print('file in local data dir but is modified: {}\n'.format(
-                    fs_path))
-                self._update_local_cache_file(
-                    fs_path, url, content, dry)
-            else:
-                # nothing to do
-                pass
+        if content.type == 'dir':
+            return
+        if not success:
+            self.update_summary('failed', fs_path, summary)
+        elif synced is not None:
+            synced.append((fs_path, content))
         else:
-            # i wonder why it should reach here, raise exception anyway
-            msg = 'idk why execution should reach here, might be interesting'
-            raise RuntimeError(msg)
+            self.cache.upsert(fs_path, content)
+
+    def make_plan(self):
+        """
+        compare self.fs_paths to the sync state and to the files of the local
+        data dir. The data dir is scanned only if files were synced before.
+
+        :return: SyncPlan
+        """
+        local_paths = None
+        if not self.cache.empty():
+            local_data_dir = expanduser(
+                self.config.get('LocalStorage', 'datadir'))
+            local_paths = set(
+                fs_path
+                for fs_path, _ in scan_files(local_data_dir, stat=False))
+
+        return diff(self.sorted_fs_paths(), self.cache.contents(),
+                    local_paths)
+
+    def scheduled_items(self, plan, policy=None):
+        """
+        return the transfers of a plan in the order they are synced
+
+        :param plan: the SyncPlan
+        :param str policy: the scheduling policy, by default the value of
+         'schedule' in the [Download] section of the configuration or 'lpt'
+        :return: list of (priority, fs_path, url, content)
+        """
+        return schedule(plan.transfers(), policy or self._schedule)
+
+    def retry_delay(self, attempt):
+        """
+        return the delay before the retry of a download that failed
+        'attempt' times
+
+        :param int attempt: the number of failed attempts, at least 1
+        :return: float: the delay in seconds
+        """
+        return min(self._backoff * 2 ** (attempt - 1), self._max_backoff)
 
-    def sync(self, n_threads=10, dry=True):
+    def sync(self, n_threads=10, dry=True, engine=None, max_in_flight=None,
+             policy=None, adaptive=None, hedge=None):
         """
         Syncronize local cache with the remote content
 
@@ -519,29 +1075,142 @@ class Query(object):
         :param int n_threads: number of simultaneous downloads  
         :param bool dry: if True, the sync process is simulated without
          actually downloading data
+        :param str engine: 'thread' (one thread per simultaneous download),
+         'asyncio' (the sync is driven by an event loop) or 'process' (one
+         worker process per simultaneous download, the state is updated by
+         the calling process). By default the value of 'engine' in the
+         [Download] section of the configuration or 'thread'.
+        :param int max_in_flight: the maximum number of simultaneous downloads
+         of the asyncio engine, by default the value of 'max_in_flight' in
+         the [Download] section or n_threads.
+        :param str policy: the order of the downloads, 'lpt' (largest
+         first), 'spt' (smallest first), 'mixed' or 'path'. By default the
+         value of 'schedule' in the [Download] section or 'lpt'.
+        :param bool adaptive: if True the thread engine starts with n_threads
+         simultaneous downloads and adjusts their number from the throughput,
+         the latency and the errors of the downloads, between the
+         'min_threads' and 'max_threads' values of the [Download] section.
+         By default the value of 'adaptive' in the [Download] section.
+
+        :param bool hedge: if True, once the work queue is empty the idle
+         threads of the thread engine start a duplicate download of the
+         transfers that are much slower than the median, the first one that
+         completes is kept. By default the value of 'hedge' in the [Download]
+         section or True. With adaptive the duplicate downloads count against
+         the limit of simultaneous downloads.
+
+        A failed (or stalled) download is put back on the work queue after a
+        delay that doubles at each attempt, it is recorded as failed after
+        'retries' retries (see the [Download] section).
+
+        The files to download are decided before any download starts, see
+        make_plan. The plan is kept in self.sync_plan.
         """
-        def worker(_work_producer):
-            while True:
-                self._condition.acquire()
-                try:
-                    args = _work_producer.next()
-                except StopIteration:
-                    args = None
-                self._condition.release()
-
-                if args is not None:
-                    args += (dry,)
-                    self._sync_file(*args)
-                else:
-                    break
-
-        def work_producer():
-            for fs_path, (content, download_url) in self.fs_paths.items():
-                yield fs_path, download_url, content
+        engine = engine or self._sync_engine
+        if engine not in ('thread', 'asyncio', 'process'):
+            raise ValueError('unknown sync engine {}'.format(engine))
+
+        plan = self.sync_plan = self.make_plan()
+        for change_type in CHANGE_TYPES:
+            for _, url, _ in getattr(plan, change_type):
+                self.update_summary(change_type, url)
+        print(plan.report())
+
+        if dry:
+            return
+
+        if engine == 'asyncio':
+            AsyncioSyncEngine(
+                self,
+                max_in_flight=max_in_flight or self._max_in_flight or n_threads,
+                policy=policy,
+                plan=plan
+            ).run()
+            self.write_cache()
+            return
+        elif engine == 'process':
+            ProcessSyncEngine(
+                self,
+                plan,
+                n_processes=n_threads,
+                policy=policy
+            ).run()
+            self.write_cache()
+            return
+
+        items = self.scheduled_items(plan, policy)
+        self.make_parent_dirs(fs_path for _, fs_path, _, _ in items)
+
+        # the items are (not_before, attempt, priority, fs_path, url,
+        # content), the retries come after all the first attempts and are
+        # ordered by the time they are due
+        work = Queue.PriorityQueue()
+        for item in items:
+            work.put((0, 0) + item)
+
+        controller = None
+        if self._adaptive if adaptive is None else adaptive:
+            controller = AIMDController(
+                initial=n_threads,
+                min_limit=self._min_threads,
+                max_limit=self._max_threads or 4 * n_threads)
+            n_threads = controller.max_limit
+
+        hedger = None
+        if self._hedge if hedge is None else hedge:
+            hedger = Hedger(**self._hedge_options)
+
+        # the workers keep their own summary and batch their state updates,
+        # they share nothing but the work queue
+        def worker():
+            summary = dict((key, []) for key in self.summary)
+            synced = []
+            try:
+                while True:
+                    delay = HEDGE_POLL_INTERVAL
+                    try:
+                        item = work.get_nowait()
+                    except Queue.Empty:
+                        if hedger is None or not hedger.running():
+                            break
+                        item = None
+                    if item is not None and item[0] > time.time():
+                        # a retry waits in the queue until it is due, the
+                        # worker stays free for the other work meanwhile
+                        work.put(item)
+                        delay = min(item[0] - time.time(), delay)
+                        item = None
+                    if item is None:
+                        if hedger is None or \
+                                not self._start_hedge(hedger, controller):
+                            time.sleep(max(delay, 0))
+                        continue
+                    _, attempt, _, fs_path, download_url, content = item
+                    if controller is not None:
+                        controller.acquire()
+                    try:
+                        success = self._download(fs_path, download_url,
+                                                 content, controller, hedger)
+                    finally:
+                        if controller is not None:
+                            controller.release()
+                    if not success and attempt < self._retries:
+                        delay = self.retry_delay(attempt + 1)
+                        print('retrying {} in {:.0f}s'.format(fs_path, delay))
+                        work.put((time.time() + delay, attempt + 1) +
+                                 item[2:])
+                        continue
+                    self._record_download(fs_path, content, success, summary,
+                                          synced)
+                    if len(synced) >= STATE_BATCH_SIZE:
+                        self.cache.upsert_many(synced)
+                        del synced[:]
+            finally:
+                self.cache.upsert_many(synced)
+                self.merge_summary(summary)
 
-        producer = work_producer()
         threads = [
-            threading.Thread(target=worker, args=(producer,))
+            threading.Thread(target=worker)
             for _ in range(n_threads)
         ]
 
@@ -550,8 +1219,133 @@ class Query(object):
         for thread in threads:
             thread.join()
 
-        if not dry:
-            self.write_cache()
+        if hedger is not None and hedger.n_hedged > 0:
+            print('hedged {} slow downloads'.format(hedger.n_hedged))
+
+        if controller is not None:
+            print('the number of simultaneous downloads settled at {} '
+                  '(last {})'.format(controller.settled_limit(),
+                                     controller.limit))
+
+        self.write_cache()
+
+    def verify(self, deep=False, n_processes=None):
+        """
+        check the files of the local data dir against the sync state
+
+        :param bool deep: if True all the files are hashed, otherwise only
+         the files whose size or mtime do not match the state are hashed
+        :param int n_processes: the number of processes that check the
+         files, by default the number of cores
+        :return: dict that maps the status ('ok', 'missing', 'corrupted' and
+         'unverified') to the lists of paths relative to the data dir
+        """
+        local_data_dir = expanduser(self.config.get('LocalStorage', 'datadir'))
+
+        return verify_files(
+            (
+                (os.path.join(local_data_dir, content.name), content)
+                for content in self.cache.contents()
+            ),
+            n_processes=n_processes,
+            deep=deep
+        )
+
+    def reindex(self, checksums=False):
+        """
+        rebuild the sync state from the files already present in the local
+        data dir instead of downloading them again.
+
+        The data dir is scanned and a local file is recorded as synced if
+        its size is the one of the remote file and its mtime is the one of
+        the remote file. If checksums is True, a file whose mtime differs is
+        hashed and recorded if its digest matches the checksum published by
+        the server. The files that are not recorded are downloaded by the
+        next sync.
+
+        :param bool checksums: if True use the checksums of the server for
+         the files whose mtime does not match
+        :return: dict that maps 'adopted', 'modified' and 'missing' to the
+         lists of the paths of the remote files
+        """
+        local_data_dir = expanduser(self.config.get('LocalStorage', 'datadir'))
+
+        print('scanning {}'.format(local_data_dir))
+        local_files = dict(scan_files(local_data_dir))
+
+        report = dict(adopted=[], modified=[], missing=[])
+        adopted = []
+        for fs_path, (content, _) in self.sorted_fs_paths():
+            stat_result = local_files.get(fs_path)
+            if stat_result is None:
+                report['missing'].append(fs_path)
+            elif self._matches_local_file(
+                    os.path.join(local_data_dir, fs_path), content,
+                    stat_result, checksums):
+                report['adopted'].append(fs_path)
+                adopted.append((fs_path, content))
+            else:
+                report['modified'].append(fs_path)
+
+        self.cache.clear()
+        # an unchanged index must not skip the files that were not adopted
+        self.cache.set_meta('index_etag', None)
+        self.cache.set_meta('index_last_modified', None)
+        self.cache.upsert_many(adopted)
+        self.cache.set_meta('include_regex', self.include_regex)
+        print('recorded {} files in the sync state:\n\t{}'.format(
+            len(adopted), self.cache.path))
+
+        return report
+
+    @staticmethod
+    def _matches_local_file(local_abs_path, content, stat_result, checksums):
+        """
+        return True if the local file is the same as the remote content.
+        A file that matches by checksum gets the mtime of the remote file.
+
+        :param local_abs_path: the path of the local file
+        :param content: the Content object of the remote file
+        :param stat_result: the stat of the local file
+        :param bool checksums: if True, compare the checksums when the
+         mtimes differ
+        :return: bool
+        """
+        if content.size is not None and stat_result.st_size != content.size:
+            return False
+
+        if content.mtime is not None and \
+                int(stat_result.st_mtime) == content.mtime:
+            return True
+
+        remote_checksums = parse_checksums(content.checksum)
+        algorithms = [
+            algorithm for algorithm in sorted(remote_checksums)
+            if algorithm.lower() in hashlib.algorithms
+        ]
+        if not checksums or not algorithms:
+            return False
+
+        if hash_file(local_abs_path, algorithms) != {
+                algorithm: remote_checksums[algorithm]
+                for algorithm in algorithms}:
+            return False
+
+        if content.mtime is not None:
+            os.utime(local_abs_path, (content.mtime, content.mtime))
+        return True
+
+    def make_parent_dirs(self, fs_paths):
+        """
+        create the unique parent directories of fs_paths in the local data
+        dir, in sorted order so that each one is created once
+
+        :param fs_paths: iterable of paths relative to the data dir
+        """
+        local_data_dir = expanduser(self.config.get('LocalStorage', 'datadir'))
+        for dirname in sorted(set(os.path.dirname(fs_path)
+                                  for fs_path in fs_paths)):
+            safe_makedirs(os.path.join(local_data_dir, dirname))
 
     def generate_wget_bash_script(self, script_path):
         """
@@ -561,7 +1355,7 @@ class Query(object):
         """
         with open(script_path, 'w') as fobj:
             fobj.write('#!/usr/bin/env bash\n')
-            for fs_path, (_, url) in self.fs_paths.items():
+            for fs_path, (_, url) in self.sorted_fs_paths():
                 fobj.write('mkdir -p {}\n'.format(os.path.dirname(fs_path)))
                 fobj.write('wget "{url}" -O {fs_path}\n'.format(
                     url=url,
@@ -1,9 +1,9 @@
 from __future__ import print_function
+import os
 import re
-import StringIO
 import time
 import hashlib
-from collections import OrderedDict
+import email.utils
 
 from lxml import etree
 
@@ -32,19 +32,33 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 requests.packages.urllib3.disable_warnings(InsecurePlatformWarning)
 requests.packages.urllib3.disable_warnings(SNIMissingWarning)
 
+from pytest_ds.download import download_file, download_file_to_buffer
+
 
 
 class Content(object):
     """
     Storage for items/content.
+
+    Millions of instances are created for large trees, so the attributes are
+    slotted and the modification time and the size are kept as integers.
     """
-    def __init__(self, content_type, name, mtime):
+    __slots__ = ('type', 'name', 'mtime', 'etag', 'size', 'checksum',
+                 'subdir')
+
+    def __init__(self, content_type, name, mtime, etag=None, size=None,
+                 checksum=None):
         """
         constructor
 
         :param content_type: type of content (dir, file, symlink...) 
         :param name: the name of the content (e.g the file name)
-        :param mtime: the last modification time
+        :param mtime: the last modification time, the number of seconds
+         since the epoch or a date string as in the http headers
+        :param etag: the entity tag of the content on the server
+        :param size: the size in bytes
+        :param checksum: the checksum(s) of the content in the owncloud
+         format e.g 'MD5:abcd... SHA1:ef01...'
         """
         self.type = content_type
         """the type of the cotent dir/file """
@@ -52,18 +66,55 @@ class Content(object):
         self.name = name
         """the name of the content (e.g. filename)"""
 
-        self.mtime = mtime
-        """the last modification time """
+        self.mtime = to_epoch(mtime)
+        """the last modification time in seconds since the epoch"""
 
-        self.subdir = []
-        """the content of the object if it is a subdir"""
+        self.etag = etag
+        """the entity tag of the content on the server"""
 
-        self.msize = None    # not used
+        self.size = None if size is None else int(size)
         """the size of the in bytes"""
 
-        self.md5 = None      # not used
-        """the md5sum of the file"""
+        self.checksum = checksum
+        """the checksum(s) of the file"""
+
+        self.subdir = None
+        """the content of the object if it is a subdir"""
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        if not isinstance(other, Content):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
 
+    def __setstate__(self, state):
+        # instances pickled by older versions have msize and md5 attributes
+        # and a string mtime
+        state = dict(state)
+        state.setdefault('size', state.pop('msize', None))
+        state.setdefault('checksum', state.pop('md5', None))
+        state['mtime'] = to_epoch(state.get('mtime'))
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+
+def to_epoch(mtime):
+    """convert a modification time to the number of seconds since the epoch
+
+    :param mtime: None, the number of seconds (int or str) or a date as in the
+     http headers e.g 'Tue, 14 Mar 2017 10:15:42 GMT'
+    :return: int or None
+    """
+    if mtime is None or isinstance(mtime, (int, long)):
+        return mtime
+    if mtime.isdigit():
+        return int(mtime)
+    return int(email.utils.mktime_tz(email.utils.parsedate_tz(mtime)))
 
 
 class HtlmSourceFetcherHeadless(object):
@@ -208,56 +259,6 @@ class ElementsFinder(object):
             return []
 
 
-def download_file_to_buffer(url, auth=None):
-    """
-    taken from http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
-    """
-    print('downloading {}'.format(url))
-    try:
-        request = requests.get(url, stream=True, auth=auth, verify=False)
-        _buffer = StringIO.StringIO()
-        for chunk in request.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                _buffer.write(chunk)
-        _buffer.seek(0)
-    except Exception as e:
-        print('download failed...')
-        print(e)
-        return None
-    else:
-        return _buffer.read()
-
-def download_file(url, local_url, auth=None):
-    """
-    taken from http://stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
-    """
-    print('downloading {} to {}'.format(url, local_url))
-    try:
-        request = requests.get(url, stream=True, auth=auth, verify=False)
-        with open(local_url, 'wb') as fobj:
-            for chunk in request.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    fobj.write(chunk)
-    except Exception as e:
-        print('download failed...')
-        print(e)
-        return False
-    else:
-        return True
-
-
-def sort_dict_by_key(in_dict):
-    """return the input dictionary as an ordered dictionary sorted by key
-    
-    :param value: a dictionary
-    :return: ordered dictionary 
-    """
-    retval = OrderedDict()
-    for key in sorted(in_dict):
-        retval[key] = in_dict[key]
-    return retval
-
-
 def calculate_md5sum(path, expected_md5sum=None):
     """
     Compute the md5sum of a file located a 'path'
@@ -286,3 +287,19 @@ def calculate_md5sum(path, expected_md5sum=None):
             raise AssertionError(msg)
     else:
         return local_md5sum
+
+
+def safe_makedirs(dir_path):
+    """
+    create the directory dir_path and its parents if they do not exist. It
+    is not an error if another thread creates them at the same time.
+
+    :param str dir_path: the path of the directory
+    """
+    if os.path.isdir(dir_path):
+        return
+    try:
+        os.makedirs(dir_path)
+    except OSError:
+        if not os.path.isdir(dir_path):
+            raise
@@ -0,0 +1,132 @@
+"""
+Verification of a synced data dir against the sync state.
+
+The files are checked by a pool of processes, so hashing is spread over all
+the cores instead of being bound to one by the GIL. The files are mapped in
+memory and hashed in one call, which avoids copying them through small read
+buffers. By default a file whose size and modification time match the state
+is not hashed (the modification time is set to the one of the remote file
+when it is downloaded).
+"""
+import os
+import mmap
+import hashlib
+import multiprocessing
+
+from pytest_ds.download import parse_checksums
+
+
+CHUNK_SIZE = 16 * 1024 ** 2
+"""the size of the reads of the files that can not be mapped in memory"""
+
+
+def hash_file(path, algorithms):
+    """
+    compute the digests of the file at path
+
+    :param path: the path of the file
+    :param algorithms: the names of hashlib algorithms e.g ['MD5']
+    :return: dict that maps the (upper case) algorithms to the hex digests
+    """
+    hashes = [hashlib.new(algorithm.lower()) for algorithm in algorithms]
+
+    with open(path, 'rb') as fobj:
+        try:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error, EnvironmentError):
+            # empty files and special files can not be mapped
+            data = None
+
+        if data is not None:
+            try:
+                for _hash in hashes:
+                    _hash.update(data)
+            finally:
+                data.close()
+        else:
+            while True:
+                chunk = fobj.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                for _hash in hashes:
+                    _hash.update(chunk)
+
+    return {
+        algorithm.upper(): _hash.hexdigest()
+        for algorithm, _hash in zip(algorithms, hashes)
+    }
+
+
+def verify_file(args):
+    """
+    verify a single file against its recorded state
+
+    :param args: the tuple (fs_path, abs_path, size, mtime, checksum, deep)
+    :return: (status, fs_path) where the status is 'ok', 'missing',
+     'corrupted' or 'unverified' (the file could not be checked since no
+     checksum is recorded)
+    """
+    fs_path, abs_path, size, mtime, checksum, deep = args
+
+    try:
+        stat_result = os.stat(abs_path)
+    except OSError:
+        return 'missing', fs_path
+
+    if size is not None and stat_result.st_size != size:
+        return 'corrupted', fs_path
+
+    if not deep and mtime is not None and \
+            int(stat_result.st_mtime) == mtime and size is not None:
+        return 'ok', fs_path
+
+    checksums = parse_checksums(checksum)
+    algorithms = [
+        algorithm for algorithm in sorted(checksums)
+        if algorithm.lower() in hashlib.algorithms
+    ]
+    if not algorithms:
+        return 'unverified', fs_path
+
+    digests = hash_file(abs_path, algorithms)
+    for algorithm in algorithms:
+        if digests[algorithm] != checksums[algorithm]:
+            return 'corrupted', fs_path
+
+    return 'ok', fs_path
+
+
+def verify(items, n_processes=None, deep=False):
+    """
+    verify the files 'items' in a pool of processes
+
+    :param items: iterable of (abs_path, Content) pairs, the name of the
+     Content objects are the paths relative to the data dir
+    :param int n_processes: the number of processes, by default the number
+     of cores
+    :param bool deep: if True the files are hashed even if their size and
+     mtime match the recorded ones
+    :return: dict that maps the status ('ok', 'missing', 'corrupted' and
+     'unverified') to the lists of paths
+    """
+    retval = dict(ok=[], missing=[], corrupted=[], unverified=[])
+
+    work = (
+        (content.name, abs_path, content.size, content.mtime,
+         content.checksum, deep)
+        for abs_path, content in items
+    )
+
+    pool = multiprocessing.Pool(processes=n_processes)
+    try:
+        for status, fs_path in pool.imap_unordered(verify_file, work,
+                                                   chunksize=16):
+            retval[status].append(fs_path)
+    finally:
+        pool.close()
+        pool.join()
+
+    for paths in retval.values():
+        paths.sort()
+
+    return retval
@@ -0,0 +1,98 @@
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import pytest
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """serve the files of the server with support for Range requests"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path not in self.server.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        data = self.server.files[self.path]
+        etag = self.server.etags.get(self.path, '"1"')
+        start, end = 0, len(data)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and (if_range is None or if_range == etag):
+            first, last = range_header.replace('bytes=', '').split('-')
+            start = int(first)
+            end = int(last) + 1 if last else len(data)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end - 1, len(data)))
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        # simulate a server that stops sending data
+        time.sleep(self.server.delays.get(self.path, 0))
+
+        # simulate a connection that drops after 'truncate' bytes
+        truncate = self.server.truncate.pop(self.path, None)
+        if truncate is not None:
+            self.wfile.write(data[start:start + truncate])
+            self.close_connection = 1
+            return
+
+        # simulate a slow connection that pauses after the first kilobyte
+        pause = self.server.pauses.pop(self.path, None)
+        if pause is not None:
+            self.wfile.write(data[start:start + 1024])
+            self.wfile.flush()
+            time.sleep(pause)
+            start = min(start + 1024, end)
+
+        self.wfile.write(data[start:end])
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           RangeRequestHandler)
+        self.files = {}
+        self.etags = {}
+        self.truncate = {}
+        self.delays = {}
+        self.pauses = {}
+        self.requests = []
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+
+@pytest.fixture
+def http_server():
+    server = HTTPServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,80 @@
+import pytest
+
+from pytest_ds import concurrency
+from pytest_ds.concurrency import AIMDController
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """a clock that advances by one second at each reading"""
+    now = [0.0]
+
+    def time():
+        now[0] += 1.0
+        return now[0]
+
+    monkeypatch.setattr(concurrency.time, 'time', time)
+
+
+def test_that_the_limit_grows_with_the_throughput(clock):
+
+    controller = AIMDController(initial=4, max_limit=6, interval=1)
+
+    for n_bytes in [100, 200, 300, 400, 500]:
+        controller.record(n_bytes, 1.0)
+
+    assert controller.limit == 6
+    assert controller.settled_limit() == 6
+
+
+def test_that_the_limit_is_cut_when_the_server_is_overloaded(clock):
+
+    controller = AIMDController(initial=8, min_limit=3, interval=1)
+
+    controller.record(100, 1.0, status_code=503)
+    assert controller.limit == 4
+
+    controller.record(100, 1.0, status_code=429)
+    assert controller.limit == 3
+
+
+def test_that_an_increase_without_gain_is_reverted(clock):
+
+    controller = AIMDController(initial=4, interval=1)
+
+    controller.record(1000, 1.0)
+    assert controller.limit == 5
+    controller.record(500, 1.0)
+    assert controller.limit == 4
+
+
+def test_that_a_degraded_latency_cuts_the_limit(clock):
+
+    controller = AIMDController(initial=8, interval=1)
+
+    controller.record(1000, 1.0)
+    assert controller.limit == 9
+    controller.record(1000, 10.0)
+    assert controller.limit == 4
+
+
+def test_that_the_limit_bounds_the_running_downloads():
+
+    controller = AIMDController(initial=2)
+
+    controller.acquire()
+    controller.acquire()
+    assert controller._in_flight == 2
+    controller.release()
+    controller.acquire()
+    assert controller._in_flight == 2
+
+
+def test_that_a_slot_is_not_waited_for_by_try_acquire():
+
+    controller = AIMDController(initial=1)
+
+    assert controller.try_acquire()
+    assert not controller.try_acquire()
+    controller.release()
+    assert controller.try_acquire()
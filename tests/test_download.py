@@ -0,0 +1,186 @@
+import os
+import time
+import hashlib
+import threading
+
+import pytest
+
+from pytest_ds.download import (
+    Download,
+    PART_SUFFIX,
+    VALIDATOR_SUFFIX,
+    preallocate,
+    StalledError,
+    download_file,
+    parse_checksums)
+
+
+def test_that_an_interrupted_download_is_resumed(http_server, tmpdir):
+
+    data = os.urandom(100000)
+    http_server.files['/data.bin'] = data
+    http_server.truncate['/data.bin'] = 30000
+
+    local_path = str(tmpdir.join('data.bin'))
+    url = http_server.url('/data.bin')
+
+    assert not download_file(url, local_path, etag='"1"', buffer_size=4096)
+    assert not os.path.exists(local_path)
+    assert os.path.getsize(local_path + '.part') == 30000
+
+    assert download_file(url, local_path, etag='"1"', buffer_size=4096)
+    assert open(local_path, 'rb').read() == data
+    assert not os.path.exists(local_path + '.part')
+
+    path, headers = http_server.requests[-1]
+    assert headers['range'] == 'bytes=30000-'
+
+
+def test_that_the_partial_file_holds_only_the_received_bytes(
+        http_server, tmpdir):
+
+    data = os.urandom(100000)
+    http_server.files['/data.bin'] = data
+    http_server.pauses['/data.bin'] = 1
+
+    local_path = str(tmpdir.join('data.bin'))
+    thread = threading.Thread(target=download_file, args=(
+        http_server.url('/data.bin'), local_path), kwargs=dict(
+            etag='"1"', size=len(data), buffer_size=1024))
+    thread.start()
+    time.sleep(0.5)
+
+    # a download killed now is resumed from the size of the partial file
+    assert os.path.getsize(local_path + PART_SUFFIX) == 1024
+    thread.join()
+    assert open(local_path, 'rb').read() == data
+
+
+def test_that_a_partial_download_of_a_modified_file_is_restarted(
+        http_server, tmpdir):
+
+    http_server.files['/data.bin'] = os.urandom(1000)
+    http_server.truncate['/data.bin'] = 500
+
+    local_path = str(tmpdir.join('data.bin'))
+    url = http_server.url('/data.bin')
+
+    assert not download_file(url, local_path, etag='"1"')
+    assert os.path.getsize(local_path + PART_SUFFIX) == 500
+
+    # the file changed on the remote before the download is resumed, the
+    # listing of the next sync holds the new etag
+    data = os.urandom(1000)
+    http_server.files['/data.bin'] = data
+    http_server.etags['/data.bin'] = '"2"'
+
+    assert download_file(url, local_path, etag='"2"', mtime=1489486542)
+    assert open(local_path, 'rb').read() == data
+    assert os.path.getmtime(local_path) == 1489486542
+    assert 'range' not in http_server.requests[-1][1]
+    assert not os.path.exists(local_path + PART_SUFFIX + VALIDATOR_SUFFIX)
+
+
+def test_that_large_files_are_downloaded_in_segments(http_server, tmpdir):
+
+    data = os.urandom(100001)
+    http_server.files['/data.bin'] = data
+
+    local_path = str(tmpdir.join('data.bin'))
+
+    assert download_file(http_server.url('/data.bin'), local_path,
+                         size=len(data), segments=4, segment_threshold=1000)
+    assert open(local_path, 'rb').read() == data
+
+    ranges = sorted(headers['range'] for _, headers in http_server.requests)
+    assert ranges == [
+        'bytes=0-25000', 'bytes=25001-50001', 'bytes=50002-75002',
+        'bytes=75003-100000']
+
+
+def test_that_the_disk_blocks_of_a_file_are_preallocated(tmpdir):
+
+    path = str(tmpdir.join('data.bin'))
+    size = 1024 ** 2
+
+    with open(path, 'wb') as fobj:
+        preallocate(fobj, 0, size)
+        stat_result = os.fstat(fobj.fileno())
+
+    if stat_result.st_size == 0:
+        pytest.skip('posix_fallocate is not supported here')
+    assert stat_result.st_size == size
+    assert stat_result.st_blocks * 512 >= size
+
+
+def test_that_a_failed_segmented_download_leaves_no_partial_file(
+        http_server, tmpdir):
+
+    local_path = str(tmpdir.join('data.bin'))
+
+    assert not download_file(http_server.url('/data.bin'), local_path,
+                             size=100000, segments=4, segment_threshold=1000)
+    assert not os.path.exists(local_path + PART_SUFFIX)
+
+
+def test_that_the_digests_are_computed_while_downloading(http_server, tmpdir):
+
+    data = os.urandom(100000)
+    http_server.files['/data.bin'] = data
+    http_server.truncate['/data.bin'] = 30000
+
+    local_path = str(tmpdir.join('data.bin'))
+    url = http_server.url('/data.bin')
+
+    assert not download_file(url, local_path, etag='"1"')
+
+    download = Download(url, local_path, etag='"1"', buffer_size=4096,
+                        digests=['md5', 'sha1'])
+    assert download.run()
+    assert download.checksums == {
+        'MD5': hashlib.md5(data).hexdigest(),
+        'SHA1': hashlib.sha1(data).hexdigest(),
+    }
+
+    segmented = Download(url, str(tmpdir.join('segmented.bin')),
+                         size=len(data), segments=4, segment_threshold=1000,
+                         digests=['md5'])
+    http_server.truncate.clear()
+    assert segmented.run()
+    assert segmented.checksums == {'MD5': hashlib.md5(data).hexdigest()}
+
+
+def test_that_a_download_with_a_wrong_checksum_fails(http_server, tmpdir):
+
+    http_server.files['/data.bin'] = b'data'
+    local_path = str(tmpdir.join('data.bin'))
+
+    assert not download_file(http_server.url('/data.bin'), local_path,
+                             digests=['md5'], checksum='MD5:0123 ADLER32:1')
+    assert not os.path.exists(local_path)
+    assert not os.path.exists(local_path + '.part')
+
+    checksum = 'SHA1:{} MD5:{}'.format(hashlib.sha1(b'data').hexdigest(),
+                                       hashlib.md5(b'data').hexdigest())
+    assert download_file(http_server.url('/data.bin'), local_path,
+                         digests=['md5'], checksum=checksum)
+    assert parse_checksums(checksum)['MD5'] == hashlib.md5(b'data').hexdigest()
+
+
+def test_that_stalled_downloads_are_aborted(http_server, tmpdir):
+
+    http_server.files['/data.bin'] = os.urandom(100000)
+    http_server.delays['/slow.bin'] = 2
+    http_server.files['/slow.bin'] = b'slow'
+
+    # the server does not send the body within the read timeout
+    local_path = str(tmpdir.join('slow.bin'))
+    assert not download_file(http_server.url('/slow.bin'), local_path,
+                             timeout=(1, 0.2))
+
+    # the throughput is below the minimum
+    local_path = str(tmpdir.join('data.bin'))
+    download = Download(http_server.url('/data.bin'), local_path,
+                        buffer_size=4096, min_speed=10 ** 12, stall_window=0)
+    with pytest.raises(StalledError):
+        download._download()
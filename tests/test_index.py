@@ -0,0 +1,202 @@
+import os
+import gzip
+import io
+import hashlib
+import ConfigParser
+
+from pytest_ds.tree import Query
+from pytest_ds.index import (
+    parse_index_line,
+    format_index_line,
+    iter_lines,
+    fetch_index,
+    read_index,
+    write_index)
+from pytest_ds.state import SyncState
+from pytest_ds.utils import Content
+
+
+INDEX = '''##directory##4096##1489485000##a##
+##regular file##3##1489485001##a/x.txt##
+##regular file##5##1489485002##a/b/y.txt##
+##directory##4096##1489485003##a/b##
+##regular file##7##1489485004##z.txt##
+'''
+
+
+def test_that_an_index_line_is_parsed():
+
+    content = parse_index_line('##regular file##12##1489485001##a/b c.txt##')
+
+    assert content.type == 'file'
+    assert content.name == 'a/b c.txt'
+    assert content.size == 12
+    assert content.mtime == 1489485001
+
+
+def test_that_the_tree_is_built_from_the_index_lines():
+
+    flat_content = [parse_index_line(line) for line in INDEX.splitlines()]
+    query = Query(setup_cache=False)
+
+    query.contents = query.crawl_fs_info(flat_content)
+
+    assert [content.name for content in query.contents] == ['a', 'z.txt']
+    a = query.contents[0]
+    assert [content.name for content in a.subdir] == ['x.txt', 'b']
+    # the dir 'a/b' is listed after its content
+    assert a.subdir[1].mtime == 1489485003
+    assert [(content.size, path)
+            for content, path in query.get_file_system_paths()] == [
+        (3, 'a/x.txt'), (5, 'a/b/y.txt'), (7, 'z.txt')]
+    # the input is not modified
+    assert [content.name for content in flat_content] == [
+        'a', 'a/x.txt', 'a/b/y.txt', 'a/b', 'z.txt']
+
+
+def test_that_the_missing_dirs_are_created():
+
+    query = Query(setup_cache=False)
+
+    query.contents = query.crawl_fs_info(
+        [Content('file', 'a/b/c.txt', 1, size=1)])
+
+    assert [path for _, path in query.get_file_system_paths()] == [
+        'a/b/c.txt']
+
+
+def gzip_compress(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fobj:
+        fobj.write(data)
+    return buf.getvalue()
+
+
+def test_that_the_lines_of_a_compressed_stream_are_split():
+
+    data = gzip_compress(INDEX)
+    chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+
+    assert list(iter_lines(chunks)) == INDEX.splitlines()
+    assert list(iter_lines([INDEX[:10], INDEX[10:]])) == INDEX.splitlines()
+    assert list(iter_lines(['a'])) == ['a']
+
+
+def test_that_an_unchanged_index_is_not_downloaded_again(http_server):
+
+    http_server.files['/index.txt.gz'] = gzip_compress(INDEX)
+    http_server.etags['/index.txt.gz'] = '"abc"'
+
+    lines, validators = fetch_index(http_server.url('/index.txt.gz'))
+
+    assert list(lines) == INDEX.splitlines()
+    assert validators['etag'] == '"abc"'
+
+    lines, validators = fetch_index(http_server.url('/index.txt.gz'),
+                                    etag=validators['etag'])
+
+    assert lines is None
+    assert http_server.requests[-1][1]['if-none-match'] == '"abc"'
+
+
+def test_that_the_content_is_read_from_the_index_url(http_server, tmpdir):
+
+    path = '/download?path=&files=index.txt'
+    http_server.files[path] = INDEX
+    query = Query(setup_cache=False)
+    query._url = http_server.url('')
+    query.config = ConfigParser.ConfigParser()
+    query.config.add_section('RemoteDataSource')
+    query.config.set('RemoteDataSource', 'index_file', 'index.txt')
+    query.cache = SyncState(str(tmpdir.join('state.sqlite')))
+
+    query.contents = query._setup_content_from_index_url()
+    query.hash()
+
+    assert sorted(query.fs_paths) == ['a/b/y.txt', 'a/x.txt', 'z.txt']
+    assert query.index_validators['etag'] == '"1"'
+
+    query.write_cache()
+
+    assert query._setup_content_from_index_url() is None
+    assert http_server.requests[-1][1]['if-none-match'] == '"1"'
+
+
+def test_that_a_line_with_checksums_is_parsed_and_formatted():
+
+    line = '##regular file##12##1489485001##a/b##c.txt##MD5:0a1b SHA1:2c3d##'
+
+    content = parse_index_line(line)
+
+    assert content.name == 'a/b##c.txt'
+    assert content.checksum == 'MD5:0a1b SHA1:2c3d'
+    assert format_index_line(content) == line
+
+
+def test_that_the_index_of_a_dir_is_written(tmpdir):
+
+    root = tmpdir.mkdir('root')
+    root.mkdir('a').mkdir('b').join('y.txt').write('yy')
+    root.join('a', 'x.txt').write('x')
+    root.join('z.txt').write('zzz')
+    index_path = str(tmpdir.join('index.txt.gz'))
+
+    report = write_index(str(root), index_path, n_threads=2,
+                         algorithms=['md5'], n_processes=2)
+
+    assert report == dict(dirs=2, files=3, hashed=3)
+    contents = list(read_index(index_path))
+    assert [(content.type, content.name) for content in contents] == [
+        ('dir', 'a'), ('dir', 'a/b'), ('file', 'a/b/y.txt'),
+        ('file', 'a/x.txt'), ('file', 'z.txt')]
+    assert contents[-1].size == 3
+    assert contents[-1].checksum == 'MD5:' + hashlib.md5('zzz').hexdigest()
+
+    # only the modified file is hashed again
+    root.join('z.txt').write('zzzz')
+
+    report = write_index(str(root), index_path, algorithms=['md5'],
+                         previous=index_path)
+
+    assert report['hashed'] == 1
+    assert list(read_index(index_path))[-1].checksum == \
+        'MD5:' + hashlib.md5('zzzz').hexdigest()
+
+
+def test_that_an_index_written_in_its_dir_does_not_list_itself(tmpdir):
+
+    tmpdir.join('x.txt').write('x')
+    index_path = str(tmpdir.join('index.txt'))
+
+    write_index(str(tmpdir), index_path)
+    report = write_index(str(tmpdir), index_path, previous=index_path)
+
+    assert report['files'] == 1
+    assert [content.name for content in read_index(index_path)] == ['x.txt']
+
+
+def test_that_the_index_is_read_again_after_a_reindex(http_server, tmpdir):
+
+    http_server.files['/download?path=&files=index.txt'] = INDEX
+    query = Query(setup_cache=False)
+    query._url = http_server.url('')
+    query.config = ConfigParser.ConfigParser()
+    query.config.add_section('RemoteDataSource')
+    query.config.set('RemoteDataSource', 'index_file', 'index.txt')
+    query.config.add_section('LocalStorage')
+    query.config.set('LocalStorage', 'datadir', str(tmpdir.join('data')))
+    query.cache = SyncState(str(tmpdir.join('state.sqlite')))
+
+    query.contents = query._setup_content_from_index_url()
+    query.hash()
+    query.write_cache()
+
+    path = tmpdir.join('data', 'z.txt')
+    path.write('zzzzzzz', ensure=True)
+    os.utime(str(path), (1489485004, 1489485004))
+    report = query.reindex()
+
+    assert report['adopted'] == ['z.txt']
+    # the files that were not adopted are listed by the next sync
+    assert query._setup_content_from_index_url() is not None
+    assert 'if-none-match' not in http_server.requests[-1][1]
@@ -0,0 +1,53 @@
+from pytest_ds.manifest import Manifest, ManifestPaths, select_items
+from pytest_ds.utils import Content
+
+
+def test_that_the_manifest_stores_and_restores_contents():
+
+    contents = [
+        Content('file', 'b/c.txt', 3, etag='c', size=30),
+        Content('file', 'a.txt', 1, etag='a', size=10),
+        Content('file', 'b/b.txt', 2),
+        Content('dir', 'b', None),
+        Content('file', 'b0.txt', 4, checksum='md5:abc'),
+    ]
+
+    manifest = Manifest.from_contents(contents)
+
+    assert len(manifest) == 5
+    assert list(manifest) == contents
+    assert manifest.dirs == ['b', '']
+
+    manifest = manifest.sorted()
+    assert list(manifest.paths()) == [
+        'a.txt', 'b', 'b/b.txt', 'b/c.txt', 'b0.txt']
+    assert [content.name for content in manifest.below('b')] == [
+        'b/b.txt', 'b/c.txt']
+    assert len(list(manifest.below(''))) == 5
+
+
+def test_that_the_manifest_is_a_map_of_the_paths():
+
+    contents = [Content('file', 'b/{}.txt'.format(index), index, size=index)
+                for index in range(3)]
+    fs_paths = ManifestPaths(Manifest.from_contents(contents).sorted(),
+                             lambda fs_path: 'url/' + fs_path)
+
+    assert len(fs_paths) == 3
+    assert 'b/1.txt' in fs_paths
+    assert 'b/3.txt' not in fs_paths
+    assert fs_paths['b/2.txt'] == (contents[2], 'url/b/2.txt')
+    assert list(fs_paths.iteritems())[0] == ('b/0.txt',
+                                             (contents[0], 'url/b/0.txt'))
+
+    selected = select_items(fs_paths, lambda fs_path, item: item[0].size > 0)
+    assert isinstance(selected, ManifestPaths)
+    assert list(selected) == ['b/1.txt', 'b/2.txt']
+
+
+def test_that_mtimes_are_converted_to_seconds_since_the_epoch():
+
+    assert Content('file', 'a', 'Tue, 14 Mar 2017 10:15:42 GMT').mtime == \
+        1489486542
+    assert Content('file', 'a', '1489486542').mtime == 1489486542
+    assert Content('file', 'a', None).mtime is None
@@ -0,0 +1,195 @@
+import time
+from io import BytesIO
+
+import pytest
+
+from lxml import etree
+
+from pytest_ds.data_sources.owncloud import WebdavDataSource
+from pytest_ds.state import SyncState
+
+
+MULTISTATUS = b"""<?xml version="1.0"?>
+<d:multistatus xmlns:d="DAV:" xmlns:s="http://sabredav.org/ns" xmlns:oc="http://owncloud.org/ns">
+ <d:response>
+  <d:href>/public.php/webdav/</d:href>
+  <d:propstat>
+   <d:prop>
+    <d:getlastmodified>Tue, 14 Mar 2017 10:00:00 GMT</d:getlastmodified>
+    <d:getetag>"root"</d:getetag>
+   </d:prop>
+   <d:status>HTTP/1.1 200 OK</d:status>
+  </d:propstat>
+ </d:response>
+ <d:response>
+  <d:href>/public.php/webdav/data.dat</d:href>
+  <d:propstat>
+   <d:prop>
+    <d:getlastmodified>Tue, 14 Mar 2017 10:15:42 GMT</d:getlastmodified>
+    <d:getetag>"data"</d:getetag>
+    <oc:checksums>
+     <oc:checksum>SHA1:da39a3ee5e6b4b0d3255bfef95601890afd80709</oc:checksum>
+    </oc:checksums>
+   </d:prop>
+   <d:status>HTTP/1.1 200 OK</d:status>
+  </d:propstat>
+  <d:propstat>
+   <d:prop>
+    <oc:fileid/>
+   </d:prop>
+   <d:status>HTTP/1.1 404 Not Found</d:status>
+  </d:propstat>
+ </d:response>
+ <d:response>
+  <d:href>/public.php/webdav/test_dir1/</d:href>
+  <d:propstat>
+   <d:prop>
+    <d:getlastmodified>Tue, 14 Mar 2017 10:16:00 GMT</d:getlastmodified>
+    <d:getetag>"dir1"</d:getetag>
+   </d:prop>
+   <d:status>HTTP/1.1 200 OK</d:status>
+  </d:propstat>
+ </d:response>
+ <d:response>
+  <d:href>/public.php/webdav/test_dir1/mini.txt</d:href>
+  <d:propstat>
+   <d:prop>
+    <d:getlastmodified>Tue, 14 Mar 2017 10:16:00 GMT</d:getlastmodified>
+    <d:getetag>"mini"</d:getetag>
+   </d:prop>
+   <d:status>HTTP/1.1 200 OK</d:status>
+  </d:propstat>
+ </d:response>
+</d:multistatus>
+"""
+
+
+def test_that_the_propfind_response_is_parsed_incrementally():
+
+    contents = list(
+        WebdavDataSource.generate_flat_content(
+            WebdavDataSource.parse_xml_content(BytesIO(MULTISTATUS))))
+
+    names_types = [(content.name, content.type) for content in contents]
+
+    assert names_types == [
+        ('', 'dir'),
+        ('data.dat', 'file'),
+        ('test_dir1', 'dir'),
+        ('test_dir1/mini.txt', 'file'),
+    ]
+    assert contents[1].mtime == 1489486542
+    assert contents[1].checksum == \
+        'SHA1:da39a3ee5e6b4b0d3255bfef95601890afd80709'
+
+
+class FakeWebdavDataSource(WebdavDataSource):
+    """serve the Depth: 1 listings of an in memory tree"""
+
+    TREE = {
+        '': ['a.txt', 'dir1/', 'dir2/'],
+        'dir1': ['dir1/b.txt', 'dir1/sub/'],
+        'dir1/sub': ['dir1/sub/c.txt'],
+        'dir2': ['dir2/d.txt'],
+    }
+
+    def __init__(self, etags=None, *args, **kwargs):
+        super(FakeWebdavDataSource, self).__init__(*args, **kwargs)
+        self.etags = etags or {}
+        self.requests = []
+
+    def ls_dir(self, dirname, depth=1):
+        self.requests.append((dirname, depth))
+        hrefs = [dirname + '/' if dirname else '']
+        if depth != 0:
+            hrefs += self.TREE[dirname]
+        return self.generate_flat_content(
+            ('/public.php/webdav/' + href,
+             etree.fromstring(
+                 '<prop xmlns="DAV:"><getetag>{}</getetag></prop>'.format(
+                     self.etags.get(href.rstrip('/'), 'x'))))
+            for href in hrefs
+        )
+
+
+def test_that_the_crawl_lists_all_the_files_breadth_first():
+
+    source = FakeWebdavDataSource(url='https://foo.bar', token='x',
+                                  dirname='y')
+
+    fs_paths = source.ls_url(recursive=True, crawl_threads=3)
+
+    assert sorted(fs_paths) == [
+        'a.txt', 'dir1/b.txt', 'dir1/sub/c.txt', 'dir2/d.txt']
+
+
+def test_that_collections_with_unchanged_etags_are_not_listed(tmpdir):
+
+    etags = {'': '1', 'dir1': '1', 'dir1/sub': '1', 'dir2': '1'}
+    source = FakeWebdavDataSource(etags=dict(etags), url='https://foo.bar',
+                                  token='x', dirname='y')
+    fs_paths = source.ls_url(recursive=True, crawl_threads=2)
+    assert source.dir_etags == etags
+
+    known = SyncState(str(tmpdir.join('state.sqlite')))
+    known.upsert_many((fs_path, content)
+                      for fs_path, (content, _) in fs_paths.items())
+    known.set_dir_etags(source.dir_etags)
+
+    # nothing changed, only the root is requested
+    source.requests = []
+    assert source.ls_url(recursive=True, known=known) == fs_paths
+    assert source.requests == [('', 0)]
+
+    # something changed in dir1/sub, dir2 is not listed
+    source.etags.update({'': '2', 'dir1': '2', 'dir1/sub': '2'})
+    source.requests = []
+    assert sorted(
+        source.ls_url(recursive=True, crawl_threads=2, known=known)
+    ) == sorted(fs_paths)
+    assert sorted(source.requests) == [
+        ('', 0), ('', 1), ('dir1', 1), ('dir1/sub', 1)]
+    assert source.dir_etags == dict(etags, **{'': '2', 'dir1': '2',
+                                              'dir1/sub': '2'})
+
+
+def test_that_the_skipped_collections_are_not_listed():
+
+    source = FakeWebdavDataSource(url='https://foo.bar', token='x',
+                                  dirname='y')
+
+    fs_paths = source.ls_url(recursive=True, crawl_threads=2,
+                             skip=lambda content: content.name == 'dir1')
+
+    assert sorted(fs_paths) == ['a.txt', 'dir2/d.txt']
+    assert sorted(source.requests) == [('', 1), ('dir2', 1)]
+    assert sorted(source.dir_etags) == ['', 'dir2']
+
+
+class FailingWebdavDataSource(FakeWebdavDataSource):
+    """a wide tree whose first subdirectory can not be listed"""
+
+    TREE = dict(
+        [('', ['d{}/'.format(index) for index in range(20)])] +
+        [('d{}'.format(index), []) for index in range(20)])
+
+    def ls_dir(self, dirname, depth=1):
+        if dirname:
+            time.sleep(0.05)
+        if dirname == 'd0':
+            self.requests.append((dirname, depth))
+            raise IOError('PROPFIND failed')
+        return super(FailingWebdavDataSource, self).ls_dir(dirname, depth)
+
+
+def test_that_the_crawl_stops_at_the_first_error():
+
+    source = FailingWebdavDataSource(url='https://foo.bar', token='x',
+                                     dirname='y')
+
+    with pytest.raises(IOError):
+        source.ls_url(recursive=True, crawl_threads=1)
+    time.sleep(0.5)
+
+    # the pending collections are dropped
+    assert len(source.requests) < 5
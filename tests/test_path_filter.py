@@ -0,0 +1,49 @@
+import pytest
+
+from pytest_ds.utils import Content
+from pytest_ds.path_filter import PathFilter, literal_prefix
+
+
+@pytest.mark.parametrize('pattern, prefix', [
+    ('dir1/foo', 'dir1/foo'),
+    ('dir2/foo/.*/data', 'dir2/foo/'),
+    ('dir3/foo/*.jpg', 'dir3/foo'),
+    (r'dir4/a\.b/c', 'dir4/a.b/c'),
+    (r'dir5/\d+', 'dir5/'),
+    ('dir6|dir7', ''),
+    ('.*', ''),
+])
+def test_the_literal_prefixes_of_the_patterns(pattern, prefix):
+    assert literal_prefix(pattern) == prefix
+
+
+def test_that_the_files_are_selected_in_a_single_pass():
+
+    path_filter = PathFilter(include=['dir1/.*', 'dir2/foo/.*/data'],
+                             exclude=[r'.*\.tmp$'],
+                             min_size=10,
+                             newer_than='Tue, 14 Mar 2017 10:00:00 GMT')
+
+    def selected(name, size=100, mtime=1489486542):
+        return path_filter(Content('file', name, mtime, size=size))
+
+    assert selected('dir1/a.dat')
+    assert selected('dir2/foo/bar/data')
+    assert not selected('dir2/foo/bar/other')
+    assert not selected('dir3/a.dat')
+    assert not selected('dir1/a.tmp')
+    assert not selected('dir1/a.dat', size=1)
+    assert not selected('dir1/a.dat', mtime=1489485599)
+
+
+def test_that_the_collections_outside_the_prefixes_are_pruned():
+
+    path_filter = PathFilter(include=['dir1/foo', 'dir2/foo/.*/data'])
+
+    assert path_filter.may_contain('dir1')
+    assert path_filter.may_contain('dir1/foo')
+    assert path_filter.may_contain('dir1/foobar')
+    assert path_filter.may_contain('dir2/foo/bar')
+    assert not path_filter.may_contain('dir1/bar')
+    assert not path_filter.may_contain('dir3')
+    assert PathFilter(exclude=['dir1']).may_contain('dir3')
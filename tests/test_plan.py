@@ -0,0 +1,34 @@
+from pytest_ds.utils import Content
+from pytest_ds.plan import diff
+
+
+def remote_item(fs_path, mtime, size=10):
+    return fs_path, (Content('file', fs_path, mtime, size=size),
+                     'url/' + fs_path)
+
+
+def test_that_the_remote_content_is_compared_to_the_state():
+
+    remote = [remote_item('a', 1), remote_item('b', 2, size=5),
+              remote_item('c', 1), remote_item('e', 1, size=7)]
+    synced = [Content('file', name, 1) for name in ['a', 'b', 'c', 'd', 'f']]
+
+    plan = diff(remote, synced, local_paths={'a', 'b', 'd'})
+
+    assert [fs_path for fs_path, _, _ in plan.new] == ['e']
+    assert [fs_path for fs_path, _, _ in plan.modified] == ['b']
+    assert [fs_path for fs_path, _, _ in plan.missing] == ['c']
+    assert plan.deleted == ['d', 'f']
+    assert plan.n_unchanged == 1
+    assert len(plan) == 3
+    assert plan.n_bytes('new') == 7
+    assert plan.n_bytes('modified') == 5
+    assert [fs_path for fs_path, _ in plan.transfers()] == ['b', 'c', 'e']
+
+
+def test_that_everything_is_new_without_state():
+
+    plan = diff([remote_item('a', 1), remote_item('b', 1)], [])
+
+    assert len(plan.new) == 2
+    assert plan.deleted == []
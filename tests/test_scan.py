@@ -0,0 +1,17 @@
+import os
+
+from pytest_ds.scan import scan_files
+
+
+def test_that_the_paths_of_the_files_are_scanned_without_stat(tmpdir):
+
+    tmpdir.mkdir('a').join('x.txt').write('x')
+    tmpdir.join('y.txt').write('yy')
+    os.symlink(str(tmpdir.join('y.txt')), str(tmpdir.join('link.txt')))
+
+    stats = dict(scan_files(str(tmpdir)))
+    paths = dict(scan_files(str(tmpdir), stat=False))
+
+    assert sorted(stats) == sorted(paths) == ['a/x.txt', 'link.txt', 'y.txt']
+    assert stats['y.txt'].st_size == 2
+    assert set(paths.values()) <= {None}
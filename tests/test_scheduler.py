@@ -0,0 +1,31 @@
+import pytest
+
+from pytest_ds.utils import Content
+from pytest_ds.scheduler import schedule
+
+
+ITEMS = [
+    (name, (Content('file', name, 0, size=size), 'url/' + name))
+    for name, size in [('a', 10), ('b', 1), ('c', 30), ('d', None), ('e', 20)]
+]
+
+
+@pytest.mark.parametrize('policy, expected', [
+    ('lpt', ['c', 'e', 'a', 'b', 'd']),
+    ('spt', ['d', 'b', 'a', 'e', 'c']),
+    ('mixed', ['c', 'd', 'e', 'b', 'a']),
+    ('path', ['a', 'b', 'c', 'd', 'e']),
+])
+def test_that_the_items_are_ordered_by_policy(policy, expected):
+
+    scheduled = schedule(ITEMS, policy)
+
+    assert [fs_path for _, fs_path, _, _ in scheduled] == expected
+    assert [priority for priority, _, _, _ in scheduled] == list(range(5))
+    assert scheduled[0][2] == 'url/' + expected[0]
+
+
+def test_that_an_unknown_policy_is_rejected():
+
+    with pytest.raises(ValueError):
+        schedule(ITEMS, 'fifo')
@@ -0,0 +1,130 @@
+import ConfigParser
+
+import pytest
+
+from pytest_ds.tree import Query
+from pytest_ds.utils import Content
+from pytest_ds.shard import parse_shard, select_shard
+
+
+FS_PATHS = {
+    'file_{}'.format(index): (Content('file', 'file_{}'.format(index), 0,
+                                      size=index * 100), 'url')
+    for index in range(50)
+}
+
+
+def test_that_the_shard_is_parsed():
+
+    assert parse_shard('1/4') == (1, 4)
+    for value in ['4/4', '-1/4', '1', 'a/b']:
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+@pytest.mark.parametrize('method', ['hash', 'size'])
+def test_that_the_shards_partition_the_content(method):
+
+    shards = [select_shard(FS_PATHS, index, 3, method) for index in range(3)]
+
+    assert sum(len(shard) for shard in shards) == len(FS_PATHS)
+    assert set().union(*shards) == set(FS_PATHS)
+    assert select_shard(FS_PATHS, 1, 3, method) == shards[1]
+
+    if method == 'size':
+        loads = [sum(item[0].size for item in shard.values())
+                 for shard in shards]
+        assert max(loads) - min(loads) <= 4900
+
+
+def make_query(tmpdir, shard, method='hash'):
+    query = Query(setup_cache=False)
+    query.config = ConfigParser.ConfigParser()
+    query.config.add_section('LocalStorage')
+    query.config.set('LocalStorage', 'state',
+                     str(tmpdir.join('state.sqlite')))
+    query.config.set('LocalStorage', 'cache', str(tmpdir.join('cache.pkl')))
+    query.shard = shard
+    query._shard_method = method
+    query.setup_cache()
+    return query
+
+
+def sync_shard(tmpdir, shard, mtime, method='hash', n_files=10):
+    """select the shard of a listing whose files have the mtime 'mtime' and
+    record them as synced in the fragment of the shard"""
+    query = make_query(tmpdir, shard, method)
+    query.fs_paths = {
+        fs_path: (Content('file', fs_path, mtime, size=len(fs_path)), 'url')
+        for fs_path in ['{}.bin'.format(index) for index in range(n_files)]
+    }
+    query._select_shard()
+    query.cache.upsert_many((fs_path, content)
+                            for fs_path, (content, _) in query.fs_paths.items())
+    query.dir_etags = {'': str(n_files)}
+    query.write_cache()
+    query.cache.close()
+    return query
+
+
+def test_that_the_fragments_of_the_shards_are_merged(tmpdir):
+
+    state = make_query(tmpdir, None).cache
+    state.upsert_many(('{}.bin'.format(index),
+                       Content('file', '{}.bin'.format(index), 1))
+                      for index in range(10))
+    state.close()
+
+    shards = [sync_shard(tmpdir, (index, 2), 2) for index in range(2)]
+
+    # a new fragment starts from the files of its shard in the state
+    fragment = make_query(tmpdir, (0, 2)).cache
+    assert sorted(content.name for content in fragment.contents()) == \
+        sorted(shards[0].fs_paths)
+    # a file of shard 0 left behind in the fragment of shard 1
+    stale = sorted(shards[0].fs_paths)[0]
+    fragment.close()
+    fragment = make_query(tmpdir, (1, 2)).cache
+    fragment.upsert(stale, Content('file', stale, 1))
+    fragment.close()
+
+    query = make_query(tmpdir, None)
+    report = query.merge_state()
+
+    assert report['files'] == 10
+    assert len(report['fragments']) == 2
+    assert [content.mtime for content in query.cache.contents()] == [2] * 10
+    assert query.cache.dir_etags == {'': '10'}
+    assert query.cache.get_meta('shard') is None
+    assert tmpdir.listdir(lambda path: 'shard' in path.basename) == []
+
+
+def test_that_the_fragments_of_all_the_shards_are_required(tmpdir):
+
+    sync_shard(tmpdir, (0, 2), 1)
+    with pytest.raises(ValueError):
+        make_query(tmpdir, None).merge_state()
+
+    sync_shard(tmpdir, (1, 3), 1)
+    sync_shard(tmpdir, (2, 3), 1)
+    with pytest.raises(ValueError):
+        make_query(tmpdir, None).merge_state()
+    assert len(tmpdir.listdir(lambda path: 'shard' in path.basename)) == 3
+
+
+def test_that_the_shards_must_list_the_same_content(tmpdir):
+
+    sync_shard(tmpdir, (0, 2), 1, method='size')
+    sync_shard(tmpdir, (1, 2), 1, method='size', n_files=11)
+    with pytest.raises(ValueError):
+        make_query(tmpdir, None).merge_state()
+
+    shards = [sync_shard(tmpdir, (index, 2), 1, n_files=n_files)
+              for index, n_files in enumerate([10, 11])]
+    query = make_query(tmpdir, None)
+    query.merge_state()
+
+    # the etags of the collections do not describe the merged files
+    assert [content.name for content in query.cache.contents()] == sorted(
+        set(shards[0].fs_paths) | set(shards[1].fs_paths))
+    assert query.cache.dir_etags == {}
@@ -0,0 +1,101 @@
+import pytest
+
+from pytest_ds.state import SyncState
+from pytest_ds.utils import Content
+
+
+def test_that_the_sync_state_can_be_updated_and_queried(tmpdir):
+
+    state = SyncState(str(tmpdir.join('state.sqlite')))
+    assert state.empty()
+
+    state.upsert('a.txt', Content('file', 'a.txt', 1, etag='1'))
+    state.upsert_many([
+        ('dir1/b.txt', Content('file', 'dir1/b.txt', 2)),
+        ('dir1/sub/c.txt', Content('file', 'dir1/sub/c.txt', 3)),
+        ('dir10/d.txt', Content('file', 'dir10/d.txt', 4)),
+    ])
+    state.upsert('a.txt', Content('file', 'a.txt', 5, etag='2', size=10))
+
+    assert not state.empty()
+    assert len(state) == 4
+    assert state.get('a.txt').mtime == 5
+    assert state.get('a.txt').etag == '2'
+    assert state.get('a.txt').size == 10
+    assert state.get('foo.txt') is None
+
+    assert [content.name for content in state.contents('dir1')] == [
+        'dir1/b.txt', 'dir1/sub/c.txt']
+
+    state.set_dir_etags({'': '1', 'dir1': '2', 'dir1/sub': '3'})
+    state.set_meta('include_regex', 'dir1/.*')
+    state.close()
+
+    state = SyncState(str(tmpdir.join('state.sqlite')))
+    assert state.unchanged(Content('dir', 'dir1', None, etag='2'))
+    assert not state.unchanged(Content('dir', 'dir1', None, etag='4'))
+    assert [
+        (content.type, content.name) for content in state.subtree('dir1')
+    ] == [('dir', 'dir1/sub'), ('file', 'dir1/b.txt'),
+          ('file', 'dir1/sub/c.txt')]
+    assert state.get_meta('include_regex') == 'dir1/.*'
+    assert state.get_meta('foo') is None
+
+
+def test_that_the_state_fragments_are_merged(tmpdir):
+
+    paths = []
+    for index, dir_etags in enumerate([{'': '1', 'a': '2'},
+                                       {'': '1', 'a': '3'}]):
+        path = str(tmpdir.join('state.sqlite.shard-{}-of-2'.format(index)))
+        fragment = SyncState(path)
+        fragment.upsert('a/{}.txt'.format(index),
+                        Content('file', 'a/{}.txt'.format(index), index))
+        fragment.set_dir_etags(dir_etags)
+        fragment.set_meta('include_regex', 'a/.*')
+        fragment.close()
+        paths.append(path)
+    state = SyncState(str(tmpdir.join('state.sqlite')))
+    state.upsert('a/old.txt', Content('file', 'a/old.txt', 0))
+
+    assert state.merge_fragments(paths) == 2
+
+    assert [content.name for content in state.contents()] == [
+        'a/0.txt', 'a/1.txt']
+    assert state.dir_etags == {'': '1'}
+    assert state.get_meta('include_regex') == 'a/.*'
+
+
+def test_that_only_the_files_of_a_shard_are_merged_from_its_fragment(tmpdir):
+
+    paths = []
+    for index, mtime in enumerate([2, 1]):
+        path = str(tmpdir.join('state.sqlite.shard-{}-of-2'.format(index)))
+        fragment = SyncState(path)
+        fragment.upsert('a.txt', Content('file', 'a.txt', mtime))
+        fragment.close()
+        paths.append(path)
+    state = SyncState(str(tmpdir.join('state.sqlite')))
+
+    owns = lambda index, fs_path: index == 0
+    assert state.merge_fragments(paths, owns=owns) == 1
+
+    assert state.get('a.txt').mtime == 2
+
+
+def test_that_a_failed_merge_leaves_the_state_unchanged(tmpdir):
+
+    path = str(tmpdir.join('state.sqlite.shard-0-of-1'))
+    fragment = SyncState(path)
+    fragment.upsert('a.txt', Content('file', 'a.txt', 1))
+    fragment.close()
+    state = SyncState(str(tmpdir.join('state.sqlite')))
+    state.upsert('b.txt', Content('file', 'b.txt', 1))
+
+    def owns(index, fs_path):
+        raise ValueError('interrupted')
+
+    with pytest.raises(ValueError):
+        state.merge_fragments([path], owns=owns)
+
+    assert [content.name for content in state.contents()] == ['b.txt']
@@ -0,0 +1,318 @@
+import os
+import time
+import hashlib
+import ConfigParser
+
+import pytest
+
+from pytest_ds import tree
+from pytest_ds.tree import Query
+from pytest_ds.state import SyncState
+from pytest_ds.utils import Content
+from pytest_ds.asyncio_engine import ASYNCIO_IS_AVAILABLE
+from pytest_ds.download import Download
+from pytest_ds.hedge import Hedger
+from pytest_ds.concurrency import AIMDController
+
+
+def make_query(http_server, tmpdir, files):
+    """create a Query of the files served by http_server that syncs them
+    to tmpdir/data"""
+    query = Query(setup_cache=False)
+    query.config = ConfigParser.ConfigParser()
+    query.config.add_section('LocalStorage')
+    query.config.set('LocalStorage', 'datadir', str(tmpdir.join('data')))
+    query.cache = SyncState(str(tmpdir.join('state.sqlite')))
+
+    query.fs_paths = {}
+    for fs_path, data in files.items():
+        http_server.files['/' + fs_path] = data
+        content = Content('file', fs_path, 1489486542, etag='"1"',
+                          size=len(data))
+        query.fs_paths[fs_path] = (content, http_server.url('/' + fs_path))
+    return query
+
+
+@pytest.mark.parametrize('engine', ['thread', 'asyncio', 'process'])
+def test_that_the_sync_engines_download_the_new_files(
+        http_server, tmpdir, engine):
+
+    if engine == 'asyncio' and not ASYNCIO_IS_AVAILABLE:
+        pytest.skip('trollius is not installed')
+
+    files = {
+        'a/{}.bin'.format(index): os.urandom(1000 + index)
+        for index in range(20)
+    }
+    query = make_query(http_server, tmpdir, files)
+
+    query.sync(n_threads=4, dry=False, engine=engine)
+
+    for fs_path, data in files.items():
+        assert tmpdir.join('data', fs_path).read('rb') == data
+        assert query.cache.get(fs_path) == query.fs_paths[fs_path][0]
+    assert len(query.summary['new']) == len(files)
+    assert query.summary['failed'] == []
+
+
+def test_that_the_asyncio_engine_records_the_failed_downloads(
+        http_server, tmpdir):
+
+    if not ASYNCIO_IS_AVAILABLE:
+        pytest.skip('trollius is not installed')
+
+    query = make_query(http_server, tmpdir, {'a.bin': b'a', 'b.bin': b'b'})
+    del http_server.files['/b.bin']
+    query._backoff = 0.01
+
+    query.sync(dry=False, engine='asyncio', max_in_flight=2)
+
+    assert query.summary['failed'] == ['b.bin']
+    assert 'a.bin' in query.cache
+    assert 'b.bin' not in query.cache
+
+
+@pytest.mark.parametrize('engine', ['thread', 'process'])
+def test_that_the_digests_are_recorded_in_the_state(
+        http_server, tmpdir, engine):
+
+    query = make_query(http_server, tmpdir, {'a.bin': b'a'})
+    query.download_options = dict(digests=['md5'])
+
+    query.sync(n_threads=1, dry=False, engine=engine)
+
+    assert query.cache.get('a.bin').checksum == 'MD5:{}'.format(
+        hashlib.md5(b'a').hexdigest())
+
+
+def test_that_reindex_adopts_the_files_of_the_data_dir(http_server, tmpdir):
+
+    files = {'a/same.bin': b'same', 'a/touched.bin': b'touched',
+             'modified.bin': b'modified', 'missing.bin': b'missing'}
+    query = make_query(http_server, tmpdir, files)
+    content = query.fs_paths['a/touched.bin'][0]
+    content.checksum = 'MD5:{}'.format(hashlib.md5(b'touched').hexdigest())
+
+    for fs_path in ['a/same.bin', 'a/touched.bin', 'modified.bin']:
+        path = tmpdir.join('data', fs_path)
+        path.write(files[fs_path], 'wb', ensure=True)
+        os.utime(str(path), (1489486542, 1489486542))
+    tmpdir.join('data', 'modified.bin').write(b'MODIFIED', 'wb')
+    os.utime(str(tmpdir.join('data', 'a', 'touched.bin')), (0, 0))
+
+    report = query.reindex()
+    assert report == dict(adopted=['a/same.bin'],
+                          modified=['a/touched.bin', 'modified.bin'],
+                          missing=['missing.bin'])
+
+    report = query.reindex(checksums=True)
+    assert report['adopted'] == ['a/same.bin', 'a/touched.bin']
+    assert len(query.cache) == 2
+    assert os.path.getmtime(str(tmpdir.join('data', 'a', 'touched.bin'))) == \
+        1489486542
+
+    query.sync(dry=False)
+    assert sorted(path for path, _ in http_server.requests) == [
+        '/missing.bin', '/modified.bin']
+
+
+def test_that_the_adaptive_sync_downloads_all_the_files(http_server, tmpdir):
+
+    files = {'{}.bin'.format(index): os.urandom(100) for index in range(20)}
+    query = make_query(http_server, tmpdir, files)
+
+    query.sync(n_threads=2, dry=False, adaptive=True)
+
+    for fs_path, data in files.items():
+        assert tmpdir.join('data', fs_path).read('rb') == data
+    assert len(query.cache) == len(files)
+
+
+@pytest.mark.parametrize('engine', ['thread', 'asyncio'])
+def test_that_failed_downloads_are_retried(http_server, tmpdir, engine):
+
+    if engine == 'asyncio' and not ASYNCIO_IS_AVAILABLE:
+        pytest.skip('trollius is not installed')
+
+    data = os.urandom(10000)
+    query = make_query(http_server, tmpdir, {'a.bin': data, 'b.bin': b'b'})
+    query._backoff = 0.01
+    http_server.truncate['/a.bin'] = 100
+
+    query.sync(dry=False, engine=engine)
+
+    assert tmpdir.join('data', 'a.bin').read('rb') == data
+    assert query.summary['failed'] == []
+    assert [path for path, _ in http_server.requests].count('/a.bin') == 2
+
+
+def test_that_the_stragglers_are_hedged(http_server, tmpdir):
+
+    files = {'{}.bin'.format(index): os.urandom(1000) for index in range(8)}
+    files['slow.bin'] = os.urandom(1000000)
+    query = make_query(http_server, tmpdir, files)
+    query._hedge_options = dict(factor=0.5, min_elapsed=0.2)
+    http_server.pauses['/slow.bin'] = 2
+
+    query.sync(n_threads=4, dry=False, policy='lpt')
+
+    assert tmpdir.join('data', 'slow.bin').read('rb') == files['slow.bin']
+    assert [path for path, _ in http_server.requests].count('/slow.bin') == 2
+    assert query.summary['failed'] == []
+    assert len(query.cache) == len(files)
+    assert sorted(os.listdir(str(tmpdir.join('data')))) == sorted(files)
+
+
+def test_that_only_the_changed_files_are_synced_again(http_server, tmpdir):
+
+    files = {'a.bin': b'a', 'b.bin': b'b', 'c.bin': b'c'}
+    query = make_query(http_server, tmpdir, files)
+    query.sync(n_threads=2, dry=False)
+
+    query.summary = dict((key, []) for key in query.summary)
+    query.fs_paths['b.bin'][0].mtime += 1
+    tmpdir.join('data', 'c.bin').remove()
+    del query.fs_paths['a.bin']
+    n_requests = len(http_server.requests)
+
+    query.sync(n_threads=2, dry=True)
+
+    assert query.summary['new'] == []
+    assert query.summary['modified'] == [query.fs_paths['b.bin'][1]]
+    assert query.summary['missing'] == [query.fs_paths['c.bin'][1]]
+    assert query.sync_plan.deleted == ['a.bin']
+    assert len(http_server.requests) == n_requests
+
+
+def test_that_the_process_engine_records_the_failed_downloads(
+        http_server, tmpdir):
+
+    query = make_query(http_server, tmpdir, {'a.bin': b'a', 'b.bin': b'b'})
+    del http_server.files['/b.bin']
+    query._retries = 1
+    query._backoff = 0.01
+
+    query.sync(n_threads=2, dry=False, engine='process')
+
+    assert query.summary['failed'] == ['b.bin']
+    assert 'a.bin' in query.cache
+    assert 'b.bin' not in query.cache
+    assert [path for path, _ in http_server.requests].count('/b.bin') == 2
+
+
+def test_that_the_asyncio_engine_frees_the_slot_during_the_retry_delay(
+        http_server, tmpdir):
+
+    if not ASYNCIO_IS_AVAILABLE:
+        pytest.skip('trollius is not installed')
+
+    query = make_query(http_server, tmpdir, {'a.bin': b'a', 'b.bin': b'b'})
+    del http_server.files['/a.bin']
+    query._retries = 1
+    query._backoff = 0.5
+
+    query.sync(dry=False, engine='asyncio', max_in_flight=1, policy='path')
+
+    assert [path for path, _ in http_server.requests] == [
+        '/a.bin', '/b.bin', '/a.bin']
+
+
+def test_that_the_files_deleted_on_the_remote_leave_the_state(
+        http_server, tmpdir):
+
+    query = make_query(http_server, tmpdir, {'a.bin': b'a', 'b.bin': b'b'})
+    query.sync(n_threads=2, dry=False)
+    assert 'b.bin' in query.cache
+
+    del query.fs_paths['b.bin']
+    query.sync(n_threads=2, dry=False)
+
+    assert query.sync_plan.deleted == ['b.bin']
+    assert 'b.bin' not in query.cache
+    assert 'a.bin' in query.cache
+
+
+def test_that_the_hedges_take_a_slot_of_the_controller(http_server, tmpdir):
+
+    query = make_query(http_server, tmpdir, {'a.bin': b'a'})
+    del http_server.files['/a.bin']
+    content, url = query.fs_paths['a.bin']
+    local_path = str(tmpdir.join('a.bin'))
+
+    hedger = Hedger(factor=1, min_elapsed=0)
+    hedger._throughputs.append(1000.0)
+    download = Download(url, local_path)
+    download.started = time.time()
+    hedger.start('a.bin', download, (url, local_path, content))
+
+    controller = AIMDController(initial=2, interval=0)
+    controller.acquire()
+    controller.acquire()
+
+    # all the slots are taken by the running downloads
+    assert not query._start_hedge(hedger, controller)
+    assert hedger.n_hedged == 0
+
+    controller.release()
+    assert query._start_hedge(hedger, controller)
+    assert hedger.n_hedged == 1
+    assert controller._in_flight == 1
+    # the failure of the duplicate download cut the limit
+    assert controller.limit == 1
+
+
+def test_that_the_thread_engine_frees_the_worker_during_the_retry_delay(
+        http_server, tmpdir):
+
+    files = {'{}.bin'.format(index): os.urandom(1000) for index in range(8)}
+    files['slow.bin'] = os.urandom(1000000)
+    query = make_query(http_server, tmpdir, files)
+    del http_server.files['/0.bin']
+    query._retries = 1
+    query._backoff = 3
+    query._hedge_options = dict(factor=0.5, min_elapsed=0.2)
+    http_server.pauses['/slow.bin'] = 2
+
+    query.sync(n_threads=2, dry=False, policy='lpt')
+
+    # the straggler is hedged while the retry of 0.bin waits in the queue
+    assert [path for path, _ in http_server.requests].count('/slow.bin') == 2
+    assert query.summary['failed'] == ['0.bin']
+    assert [path for path, _ in http_server.requests].count('/0.bin') == 2
+
+
+def test_that_the_workers_merge_their_summaries_and_state_updates(
+        http_server, tmpdir, monkeypatch):
+
+    monkeypatch.setattr(tree, 'STATE_BATCH_SIZE', 3)
+    made_dirs = []
+
+    def safe_makedirs(dir_path):
+        if not os.path.isdir(dir_path):
+            made_dirs.append((dir_path, len(http_server.requests)))
+            os.makedirs(dir_path)
+
+    files = {
+        'd{}/e{}/{}.bin'.format(index % 3, index % 2, index): os.urandom(100)
+        for index in range(30)
+    }
+    query = make_query(http_server, tmpdir, files)
+    del http_server.files['/d0/e0/0.bin']
+    query._retries = 0
+    monkeypatch.setattr(tree, 'safe_makedirs', safe_makedirs)
+
+    query.sync(n_threads=8, dry=False)
+
+    # the parent dirs are created once, in order, before the downloads
+    data_dir = str(tmpdir.join('data'))
+    assert made_dirs == [
+        (os.path.join(data_dir, 'd{}/e{}'.format(index // 2, index % 2)), 0)
+        for index in range(6)]
+
+    assert sorted(query.summary['new']) == sorted(
+        url for _, url in query.fs_paths.values())
+    assert query.summary['failed'] == ['d0/e0/0.bin']
+    assert len(query.cache) == len(files) - 1
+    for fs_path, data in files.items():
+        if fs_path != 'd0/e0/0.bin':
+            assert tmpdir.join('data', fs_path).read('rb') == data
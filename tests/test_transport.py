@@ -0,0 +1,51 @@
+import threading
+import ConfigParser
+
+from pytest_ds.transport import Transport
+
+
+def test_that_each_thread_gets_its_own_session_on_the_shared_adapter(
+        http_server):
+
+    http_server.files['/a.txt'] = b'a'
+    transport = Transport(pool_size=2)
+    sessions = []
+
+    def worker():
+        sessions.append(transport.session)
+        assert transport.session is sessions[-1]
+        response = transport.get(http_server.url('/a.txt'))
+        assert response.content == b'a'
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(id(session) for session in sessions)) == 3
+    adapters = set(id(session.get_adapter('http://127.0.0.1'))
+                   for session in sessions)
+    assert adapters == {id(transport._adapter)}
+    assert len(http_server.requests) == 3
+    transport.close()
+
+
+def test_that_the_transport_is_configured_from_the_download_section():
+
+    config = ConfigParser.ConfigParser()
+    assert Transport.from_config(config).pool_size == 10
+
+    config.add_section('Download')
+    config.set('Download', 'threads', '4')
+    assert Transport.from_config(config).pool_size == 4
+
+    config.set('Download', 'pool_size', '6')
+    config.set('Download', 'max_retries', '2')
+    config.set('Download', 'keep_alive', 'no')
+    transport = Transport.from_config(config)
+
+    assert transport.pool_size == 6
+    assert transport.max_retries == 2
+    assert not transport.keep_alive
+    assert transport.session.headers['Connection'] == 'close'
@@ -0,0 +1,51 @@
+import os
+import hashlib
+
+from pytest_ds.utils import Content
+from pytest_ds.verify import verify, hash_file
+
+
+def test_that_hash_file_computes_the_digests(tmpdir):
+
+    data = os.urandom(10000)
+    path = tmpdir.join('data.bin')
+    path.write(data, 'wb')
+    tmpdir.join('empty.bin').write(b'', 'wb')
+
+    assert hash_file(str(path), ['MD5', 'SHA1']) == {
+        'MD5': hashlib.md5(data).hexdigest(),
+        'SHA1': hashlib.sha1(data).hexdigest(),
+    }
+    assert hash_file(str(tmpdir.join('empty.bin')), ['MD5']) == {
+        'MD5': hashlib.md5(b'').hexdigest()}
+
+
+def test_that_missing_and_corrupted_files_are_reported(tmpdir):
+
+    items = []
+    for name, data in [('ok', b'ok'), ('missing', b'missing'),
+                       ('corrupted', b'corrupted'), ('touched', b'touched')]:
+        path = tmpdir.join(name)
+        path.write(data, 'wb')
+        os.utime(str(path), (1489486542, 1489486542))
+        content = Content('file', name, 1489486542, size=len(data),
+                          checksum='MD5:{}'.format(hashlib.md5(data).hexdigest()))
+        items.append((str(path), content))
+
+    tmpdir.join('missing').remove()
+
+    # same size and mtime, only a deep verification detects it
+    tmpdir.join('corrupted').write(b'CORRUPTED', 'wb')
+    os.utime(str(tmpdir.join('corrupted')), (1489486542, 1489486542))
+
+    # a modified mtime triggers the hashing of the file
+    os.utime(str(tmpdir.join('touched')), (1489486543, 1489486543))
+
+    report = verify(items, n_processes=2)
+    assert report['ok'] == ['corrupted', 'ok', 'touched']
+    assert report['missing'] == ['missing']
+
+    report = verify(items, n_processes=2, deep=True)
+    assert report['ok'] == ['ok', 'touched']
+    assert report['corrupted'] == ['corrupted']
+    assert report['missing'] == ['missing']